@@ -0,0 +1,329 @@
+"""Benchmark the speed, memory use, and accuracy of the flyer analysis
+
+Runs the analysis used by the stream processor over synthetic videos with known
+ground truth (see flyeranalysis/synthetic_frames.py), and writes a JSON file of:
+
+    - the mean time spent in each stage of the analysis
+    - end-to-end throughput in frames per second (best of several repeats)
+    - the time it takes a new process to import the analysis modules
+    - peak memory use
+    - accuracy of the results against the ground truth
+
+The same seeds give the same frames, so results from different runs (or different
+versions of the code) can be compared with the --compare option.
+
+Typical usage:
+    python benchmarks/benchmark_analysis.py --output new.json --compare old.json
+"""
+
+# imports
+import sys
+import json
+import time
+import platform
+import pathlib
+import datetime
+import resource
+import subprocess
+import tracemalloc
+from io import BytesIO
+from argparse import ArgumentParser
+import numpy as np
+import cv2
+from PIL import Image
+from flyeranalysis.flyer_detection_core import (
+    FlyerDetectionCore,
+    STREAM_ANALYSIS_KWARGS,
+)
+from flyeranalysis.analysis_telemetry import AnalysisTelemetry
+from flyeranalysis.synthetic_frames import generate_video
+
+# Tolerances used to count results as accurate
+LEADING_ROW_TOLERANCE = 5
+RADIUS_RELATIVE_TOLERANCE = 0.05
+# Modules whose import time in a fresh process is measured
+IMPORT_TIMED_MODULES = (
+    "flyeranalysis.flyer_detection_core",
+    "flyeranalysis.flyer_detection",
+    "flyeranalysis.flyer_analysis_stream_processor",
+    "flyeranalysis.reanalysis_backfill",
+)
+
+
+def get_frames(n_videos, n_frames, seed):
+    "Return a list of (frame name, .bmp bytes, ground truth) tuples"
+    frames = []
+    for ivideo in range(n_videos):
+        for iframe, (frame, truth) in enumerate(
+            generate_video(n_frames, seed=seed + ivideo)
+        ):
+            bmp = BytesIO()
+            Image.fromarray(frame).save(bmp, format="BMP")
+            frames.append(
+                (f"Camera_{ivideo}_1_1_{iframe:04d}.bmp", bmp.getvalue(), truth)
+            )
+    return frames
+
+
+def analyze_all(frames, telemetry=None):
+    "Analyze every frame and return the list of results"
+    analyzer = FlyerDetectionCore(telemetry=telemetry)
+    return [
+        analyzer.analyze_frame(
+            frame_name, None, frame_bytes=frame_bytes, **STREAM_ANALYSIS_KWARGS
+        )[0]
+        for frame_name, frame_bytes, _ in frames
+    ]
+
+
+def time_stages(frames):
+    "Return the results and a dictionary of per-stage timing statistics"
+    telemetry = AnalysisTelemetry()
+    results = analyze_all(frames, telemetry)
+    stages = {
+        stage_name: {
+            "count": stats["count"],
+            "mean_ms": 1000 * stats["mean_seconds"],
+            "total_s": stats["total_seconds"],
+        }
+        for stage_name, stats in telemetry.to_dict()["stage_durations"].items()
+    }
+    return results, stages
+
+
+def time_throughput(frames, n_repeats):
+    "Return the best end-to-end frames per second over several repeats"
+    best = 0.0
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        analyze_all(frames)
+        best = max(best, len(frames) / (time.perf_counter() - start))
+    return {"frames_per_second": best, "n_repeats": n_repeats}
+
+
+def time_imports(n_repeats):
+    """Return the best time (over several repeats) for a new Python process to import
+    each of the analysis modules, which sets how quickly workers can start
+    """
+    import_times = {}
+    for module in IMPORT_TIMED_MODULES:
+        best = None
+        for _ in range(n_repeats):
+            seconds = float(
+                subprocess.run(
+                    [
+                        sys.executable,
+                        "-c",
+                        "import time; start = time.perf_counter(); "
+                        f"import {module}; print(time.perf_counter() - start)",
+                    ],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                    cwd=pathlib.Path(__file__).parent.parent,
+                ).stdout.strip()
+            )
+            best = seconds if best is None else min(best, seconds)
+        import_times[module] = {"import_seconds": best}
+    return import_times
+
+
+def measure_memory(frames):
+    "Return the peak traced Python/numpy memory while analyzing and the max RSS"
+    tracemalloc.start()
+    analyze_all(frames)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        max_rss_kb /= 1024
+    return {"peak_traced_mb": peak / 1024**2, "max_rss_mb": max_rss_kb / 1024}
+
+
+def get_accuracy(frames, results):
+    "Return a dictionary of accuracy statistics against the ground truth"
+    n_visible = n_found = n_false_positives = 0
+    errors = {
+        "leading_row": [],
+        "radius_relative": [],
+        "center_row": [],
+        "center_column": [],
+        "tilt": [],
+    }
+    exit_codes = {}
+    for (_, _, truth), result in zip(frames, results):
+        exit_codes[str(result.exit_code)] = exit_codes.get(str(result.exit_code), 0) + 1
+        visible = truth["true_leading_row"] is not None
+        n_visible += visible
+        if result.exit_code != 0:
+            continue
+        if not visible:
+            n_false_positives += 1
+            continue
+        n_found += 1
+        errors["leading_row"].append(result.leading_row - truth["true_leading_row"])
+        errors["radius_relative"].append(
+            (result.radius - truth["true_radius"]) / truth["true_radius"]
+        )
+        errors["center_row"].append(result.center_row - truth["true_center_row"])
+        errors["center_column"].append(
+            result.center_column - truth["true_center_column"]
+        )
+        if truth["true_tilt"] is not None:
+            errors["tilt"].append(result.tilt - truth["true_tilt"])
+    accuracy = {
+        "n_frames": len(frames),
+        "n_flyer_visible": n_visible,
+        "n_fit": n_found,
+        "fit_rate": n_found / n_visible if n_visible else None,
+        "n_false_positives": n_false_positives,
+        "exit_codes": exit_codes,
+    }
+    for name, values in errors.items():
+        abs_values = np.abs(values)
+        accuracy[f"{name}_median_abs_error"] = (
+            float(np.median(abs_values)) if len(values) else None
+        )
+        accuracy[f"{name}_p90_abs_error"] = (
+            float(np.percentile(abs_values, 90)) if len(values) else None
+        )
+    if n_found:
+        accuracy["leading_row_within_tolerance"] = float(
+            np.mean(np.abs(errors["leading_row"]) <= LEADING_ROW_TOLERANCE)
+        )
+        accuracy["radius_within_tolerance"] = float(
+            np.mean(np.abs(errors["radius_relative"]) <= RADIUS_RELATIVE_TOLERANCE)
+        )
+    return accuracy
+
+
+def get_metadata(options):
+    "Return a dictionary describing the benchmark run"
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=pathlib.Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,  # pylint: disable=no-member
+        "platform": platform.platform(),
+        "n_videos": options.n_videos,
+        "n_frames": options.n_frames,
+        "seed": options.seed,
+    }
+
+
+def flatten(results, prefix=""):
+    "Return a flat dictionary of the numeric values in a nested results dictionary"
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(old_results, new_results):
+    "Print the relative change in every metric between two sets of results"
+    old_flat = flatten({k: v for k, v in old_results.items() if k != "metadata"})
+    new_flat = flatten({k: v for k, v in new_results.items() if k != "metadata"})
+    print(
+        f"Comparing to {old_results['metadata']['timestamp']} "
+        f"(commit {old_results['metadata']['git_commit']}):"
+    )
+    for name in sorted(set(old_flat) | set(new_flat)):
+        old_value, new_value = old_flat.get(name), new_flat.get(name)
+        if old_value is None or new_value is None:
+            print(f"  {name:55s} {old_value!s:>12} -> {new_value!s:>12}")
+            continue
+        change = ""
+        if old_value != 0:
+            change = f"{100 * (new_value - old_value) / abs(old_value):+.1f}%"
+        print(f"  {name:55s} {old_value:12.4g} -> {new_value:12.4g} {change:>8}")
+
+
+def get_command_line_options(args=None):
+    """Return the command line options given an (optional) list of args
+
+    Args:
+        args: a list of arguments to pass to the parser instead of using sys.argv
+
+    Returns: A namespace of parsed arguments
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--output",
+        type=pathlib.Path,
+        default=pathlib.Path("benchmark_results.json"),
+        help="Path to the JSON file to write (default = benchmark_results.json)",
+    )
+    parser.add_argument(
+        "--compare",
+        type=pathlib.Path,
+        help="Path to a JSON file from a previous run to compare the results to",
+    )
+    parser.add_argument(
+        "--n_videos",
+        type=int,
+        default=5,
+        help="The number of synthetic videos to analyze (default = 5)",
+    )
+    parser.add_argument(
+        "--n_frames",
+        type=int,
+        default=50,
+        help="The number of frames in each synthetic video (default = 50)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="The random seed for the first video (default = 0)",
+    )
+    parser.add_argument(
+        "--n_repeats",
+        type=int,
+        default=3,
+        help="The number of times to repeat the throughput measurement (default = 3)",
+    )
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    "Run the benchmarks from the command line"
+    options = get_command_line_options(args)
+    frames = get_frames(options.n_videos, options.n_frames, options.seed)
+    results, stages = time_stages(frames)
+    benchmark = {
+        "metadata": get_metadata(options),
+        "throughput": time_throughput(frames, options.n_repeats),
+        "startup": time_imports(options.n_repeats),
+        "stages": stages,
+        "memory": measure_memory(frames),
+        "accuracy": get_accuracy(frames, results),
+    }
+    options.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(options.output, "w") as fp:
+        json.dump(benchmark, fp, indent=2)
+    print(
+        f"Analyzed {len(frames)} frames at "
+        f"{benchmark['throughput']['frames_per_second']:.1f} frames/s; "
+        f"wrote results to {options.output}"
+    )
+    if options.compare is not None:
+        with open(options.compare, "r") as fp:
+            compare(json.load(fp), benchmark)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""A compact binary format for the analysis image of a flyer detection result
+
+The analysis image is a full-frame overlay whose only information is the fitted
+circle, the edge points used for the fit, and the filtered edge mask outside of the
+fitted disk (anything inside the disk is drawn over). An artifact stores just
+those pieces:
+
+    header: magic bytes, format version, image shape, fit center and radius, and
+        the numbers of edge points and mask runs
+    flyer_row, flyer_column: the edge points used for the fit (uint16)
+    mask runs: run lengths of the row-major flattened mask outside of the disk,
+        alternating between runs of False and True and starting with False (uint32)
+
+and the overlay is redrawn exactly from them on demand.
+"""
+
+# imports
+import struct
+import numpy as np
+from .flyer_detection_core import FlyerDetectionCore
+
+MAGIC = b"FLYA"
+VERSION = 1
+HEADER = struct.Struct("<4sBIIdddII")
+MASK_LEVEL_CUTOFF = 127
+
+
+def is_analysis_artifact(data):
+    "Return True if some bytes hold an analysis artifact (rather than an old .npz)"
+    return data is not None and data[: len(MAGIC)] == MAGIC
+
+
+def encode_analysis_artifact(result):
+    """Return the bytes of the artifact for a "FlyerCharacteristics" result object
+
+    Args:
+        result: a successful result with its analysis image
+
+    Returns: the artifact bytestring (None if the result has no analysis image)
+    """
+    analysis_image = result.analysis_image
+    if analysis_image is None:
+        return None
+    n_rows, n_cols = analysis_image.shape
+    # in the drawn overlay, the disk is at most level 99 and the filtered edges are
+    # at least level 253, so thresholding between them recovers the edge mask
+    # outside of the disk (and any edges inside the disk are drawn over anyway)
+    mask = analysis_image > MASK_LEVEL_CUTOFF
+    runs = _get_run_lengths(mask.ravel())
+    flyer_row = np.asarray(result.flyer_row, dtype=np.uint16)
+    flyer_column = np.asarray(result.flyer_column, dtype=np.uint16)
+    header = HEADER.pack(
+        MAGIC,
+        VERSION,
+        n_rows,
+        n_cols,
+        result.center_row,
+        result.center_column,
+        result.radius,
+        len(flyer_row),
+        len(runs),
+    )
+    return b"".join(
+        (header, flyer_row.tobytes(), flyer_column.tobytes(), runs.tobytes())
+    )
+
+
+def decode_analysis_artifact(data):
+    """Reconstruct the analysis image from the bytes of an artifact
+
+    Args:
+        data: the artifact bytestring
+
+    Returns: the analysis image as a uint8 array
+
+    Raises:
+        ValueError: the bytes aren't an artifact of a version that can be read
+    """
+    (
+        n_rows,
+        n_cols,
+        center_row,
+        center_column,
+        radius,
+        flyer_row,
+        flyer_column,
+        runs,
+    ) = _unpack_analysis_artifact(data)
+    mask = np.repeat(np.arange(len(runs)) % 2 == 1, runs).reshape(n_rows, n_cols)
+    img2 = np.zeros((n_rows, n_cols))
+    img2[mask] = 255
+    return FlyerDetectionCore().draw_analysis_image(
+        img2,
+        center_row,
+        center_column,
+        radius,
+        flyer_row.astype(np.intp),
+        flyer_column.astype(np.intp),
+    )
+
+
+def get_analysis_artifact_edge_points(data):
+    """Return the edge points used for the fit in an artifact, without redrawing it
+
+    Args:
+        data: the artifact bytestring
+
+    Returns: a (flyer_row, flyer_column) tuple of integer arrays
+
+    Raises:
+        ValueError: the bytes aren't an artifact of a version that can be read
+    """
+    _, _, _, _, _, flyer_row, flyer_column, _ = _unpack_analysis_artifact(data)
+    return flyer_row.astype(np.intp), flyer_column.astype(np.intp)
+
+
+def _unpack_analysis_artifact(data):
+    """Return the image shape, fit center and radius, edge points, and mask run
+    lengths stored in an artifact
+    """
+    if not is_analysis_artifact(data):
+        raise ValueError("ERROR: bytes do not hold an analysis artifact!")
+    (
+        _,
+        version,
+        n_rows,
+        n_cols,
+        center_row,
+        center_column,
+        radius,
+        n_points,
+        n_runs,
+    ) = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError(
+            f"ERROR: analysis artifact version {version} can't be read "
+            f"(expected version {VERSION})"
+        )
+    offset = HEADER.size
+    flyer_row = np.frombuffer(data, dtype=np.uint16, count=n_points, offset=offset)
+    offset += flyer_row.nbytes
+    flyer_column = np.frombuffer(data, dtype=np.uint16, count=n_points, offset=offset)
+    offset += flyer_column.nbytes
+    runs = np.frombuffer(data, dtype=np.uint32, count=n_runs, offset=offset)
+    return (
+        n_rows,
+        n_cols,
+        center_row,
+        center_column,
+        radius,
+        flyer_row,
+        flyer_column,
+        runs,
+    )
+
+
+def _get_run_lengths(flat_mask):
+    "Return the lengths of alternating runs of False and True in a flat boolean array"
+    change_indices = np.flatnonzero(flat_mask[1:] != flat_mask[:-1]) + 1
+    boundaries = np.concatenate(([0], change_indices, [flat_mask.size]))
+    runs = np.diff(boundaries)
+    if flat_mask.size > 0 and flat_mask[0]:
+        runs = np.concatenate(([0], runs))
+    return runs.astype(np.uint32)
@@ -0,0 +1,204 @@
+"""An opt-in, on-disk cache of flyer analysis results
+
+Results are keyed by a hash of the raw frame bytes together with a hash of the
+analysis parameters and the version of the analysis code, so re-running an analysis
+with identical settings on frames that have already been analyzed can skip decoding,
+filtering, and fitting entirely.
+"""
+
+# imports
+import os
+import json
+import pathlib
+import hashlib
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+from .flyer_detection_core import FlyerCharacteristics
+
+
+@lru_cache(maxsize=None)
+def get_analysis_code_version():
+    """Return a string identifying the version of the flyer analysis code
+
+    Changes to the analysis source files invalidate every previously-cached result.
+    """
+    code_hash = hashlib.sha256()
+    for filename in AnalysisCache.ANALYSIS_SOURCE_FILES:
+        code_hash.update((pathlib.Path(__file__).parent / filename).read_bytes())
+    return code_hash.hexdigest()
+
+
+class AnalysisCache:
+    """A size-bounded, least-recently-used cache of analysis results stored on disk
+
+    Each cached result is a single small .npz file. Entries are evicted (oldest access
+    first) whenever the total size of the cache exceeds max_bytes. Access times are
+    recorded as file modification times, so LRU ordering survives across runs and can
+    be shared by several processes using the same directory. Safe to use from several
+    threads at once.
+
+    Args:
+        cache_dir: path to the directory holding the cache (created if necessary)
+        max_bytes: the maximum total size of all cached entries, in bytes
+    """
+
+    DEF_MAX_BYTES = 1024**3
+    ENTRY_SUFFIX = ".npz"
+    # The source files whose contents determine the analysis code version
+    ANALYSIS_SOURCE_FILES = ("flyer_detection_core.py",)
+    # Result attributes stored in each entry (rel_filepath and newimg_loc depend on
+    # where the frame was read from/written to, not on its contents)
+    SCALAR_FIELDS = (
+        "exit_code",
+        "radius",
+        "center_row",
+        "center_column",
+        "leading_row",
+        "tilt",
+    )
+    ARRAY_FIELDS = ("flyer_row", "flyer_column", "analysis_image")
+
+    @property
+    def total_bytes(self):
+        "The total size of all entries currently in the cache"
+        return self.__total_bytes
+
+    def __init__(self, cache_dir, max_bytes=DEF_MAX_BYTES):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.n_hits = 0
+        self.n_misses = 0
+        self.__lock = threading.Lock()
+        # sizes of every entry in the cache by key, from least to most recently used
+        self.__entry_sizes = OrderedDict()
+        self.__total_bytes = 0
+        entries = []
+        for entry_path in self.cache_dir.glob(f"*/*{self.ENTRY_SUFFIX}"):
+            try:
+                stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, entry_path.stem, stat.st_size))
+        for _, key, size in sorted(entries):
+            self.__entry_sizes[key] = size
+            self.__total_bytes += size
+
+    def __len__(self):
+        return len(self.__entry_sizes)
+
+    @staticmethod
+    def get_key(frame_bytes, params):
+        """Return the cache key for a frame given its raw bytes and a dictionary of
+        the parameters used to analyze it
+        """
+        frame_hash = hashlib.sha256(frame_bytes).hexdigest()
+        params_str = json.dumps(
+            {"params": params, "code_version": get_analysis_code_version()},
+            sort_keys=True,
+            default=str,
+        )
+        params_hash = hashlib.sha256(params_str.encode()).hexdigest()
+        return f"{frame_hash}-{params_hash[:16]}"
+
+    def get(self, key):
+        """Return the dictionary of result fields cached under the given key
+        (or None if there is no entry for the key)
+        """
+        entry_path = self.__get_entry_path(key)
+        try:
+            with open(entry_path, "rb") as entry_file:
+                entry_bytes = entry_file.read()
+            os.utime(entry_path)
+        except FileNotFoundError:
+            with self.__lock:
+                self.n_misses += 1
+                self.__remove_from_index(key)
+            return None
+        with self.__lock:
+            self.n_hits += 1
+            if key in self.__entry_sizes:
+                self.__entry_sizes.move_to_end(key)
+            else:
+                # the entry was added by another process sharing the directory
+                self.__entry_sizes[key] = len(entry_bytes)
+                self.__total_bytes += len(entry_bytes)
+        fields = {}
+        with np.load(BytesIO(entry_bytes), allow_pickle=False) as entry:
+            for name in self.SCALAR_FIELDS + self.ARRAY_FIELDS:
+                fields[name] = None
+                if name in entry.files:
+                    value = entry[name]
+                    fields[name] = value.item() if value.ndim == 0 else value
+            fields["touches_last_row"] = bool(entry["touches_last_row"])
+        return fields
+
+    def get_result(self, key, rel_filepath):
+        """Return a (FlyerCharacteristics, touches_last_row) tuple for a cached result
+        (or (None, None) if there is no entry for the key)
+        """
+        fields = self.get(key)
+        if fields is None:
+            return None, None
+        result = FlyerCharacteristics()
+        result.rel_filepath = rel_filepath
+        for name in self.SCALAR_FIELDS + self.ARRAY_FIELDS:
+            setattr(result, name, fields[name])
+        return result, fields["touches_last_row"]
+
+    def put(self, key, result, touches_last_row):
+        """Add a "FlyerCharacteristics" result to the cache under the given key,
+        evicting least recently used entries if the cache grows too large
+        """
+        arrays = {"touches_last_row": np.array(bool(touches_last_row))}
+        for name in self.SCALAR_FIELDS + self.ARRAY_FIELDS:
+            value = getattr(result, name)
+            if value is not None:
+                arrays[name] = np.asarray(value)
+        mem_stream = BytesIO()
+        np.savez_compressed(mem_stream, **arrays)
+        entry_bytes = mem_stream.getvalue()
+        entry_path = self.__get_entry_path(key)
+        entry_path.parent.mkdir(exist_ok=True)
+        tmp_path = entry_path.with_name(
+            f"{entry_path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        with open(tmp_path, "wb") as tmp_file:
+            tmp_file.write(entry_bytes)
+        os.replace(tmp_path, entry_path)
+        with self.__lock:
+            self.__remove_from_index(key)
+            self.__entry_sizes[key] = len(entry_bytes)
+            self.__total_bytes += len(entry_bytes)
+            self.__evict()
+
+    def clear(self):
+        "Remove every entry from the cache"
+        with self.__lock:
+            for key in list(self.__entry_sizes):
+                self.__delete_entry(key)
+
+    def __get_entry_path(self, key):
+        return self.cache_dir / key[:2] / f"{key}{self.ENTRY_SUFFIX}"
+
+    def __remove_from_index(self, key):
+        "Must be called while holding the lock"
+        size = self.__entry_sizes.pop(key, None)
+        if size is not None:
+            self.__total_bytes -= size
+
+    def __delete_entry(self, key):
+        "Must be called while holding the lock"
+        self.__remove_from_index(key)
+        try:
+            os.remove(self.__get_entry_path(key))
+        except FileNotFoundError:
+            pass
+
+    def __evict(self):
+        "Must be called while holding the lock"
+        while self.__total_bytes > self.max_bytes and len(self.__entry_sizes) > 1:
+            self.__delete_entry(next(iter(self.__entry_sizes)))
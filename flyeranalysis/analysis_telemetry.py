@@ -0,0 +1,113 @@
+"""Aggregated timing and outcome statistics for flyer detection results
+
+Pass an AnalysisTelemetry object to Flyer_Detection to record how long each stage of
+the analysis takes for every frame, how many function evaluations the circle fits
+need, and how often each exit code and exception type comes up. The aggregated
+histograms can be dumped to a JSON file and compared between runs.
+"""
+
+# imports
+import json
+import pathlib
+import threading
+from bisect import bisect_left
+from collections import Counter
+
+
+class AnalysisTelemetry:
+    """Histograms of per-stage durations and counts of analysis outcomes
+
+    Safe to use from several threads at once.
+    """
+
+    # Upper edges (in seconds) of the duration histogram buckets. Durations longer
+    # than the last edge go in an overflow bucket.
+    DURATION_BUCKET_EDGES = (
+        1e-5,
+        2e-5,
+        5e-5,
+        1e-4,
+        2e-4,
+        5e-4,
+        1e-3,
+        2e-3,
+        5e-3,
+        1e-2,
+        2e-2,
+        5e-2,
+        1e-1,
+        2e-1,
+        5e-1,
+        1.0,
+        2.0,
+        5.0,
+    )
+
+    def __init__(self):
+        self.n_frames = 0
+        self.exit_codes = Counter()
+        self.exception_types = Counter()
+        self.n_fit_evaluations = Counter()
+        self.__stage_durations = {}
+        self.__lock = threading.Lock()
+
+    def record(self, result):
+        'Add the telemetry from one "FlyerCharacteristics" result to the totals'
+        with self.__lock:
+            self.n_frames += 1
+            self.exit_codes[result.exit_code] += 1
+            if result.exception_type is not None:
+                self.exception_types[result.exception_type] += 1
+            if result.n_fit_evaluations is not None:
+                self.n_fit_evaluations[result.n_fit_evaluations] += 1
+            for stage_name, duration in (result.stage_times or {}).items():
+                self.__add_duration(stage_name, duration)
+
+    def to_dict(self):
+        "Return a JSON-serializable dictionary of all of the aggregated telemetry"
+        with self.__lock:
+            stages = {}
+            for stage_name, stats in self.__stage_durations.items():
+                stages[stage_name] = {
+                    "count": stats["count"],
+                    "total_seconds": stats["total"],
+                    "mean_seconds": stats["total"] / stats["count"],
+                    "max_seconds": stats["max"],
+                    "bucket_upper_edges_seconds": list(self.DURATION_BUCKET_EDGES)
+                    + ["inf"],
+                    "bucket_counts": list(stats["bucket_counts"]),
+                }
+            return {
+                "n_frames": self.n_frames,
+                "exit_codes": {
+                    str(code): n for code, n in sorted(self.exit_codes.items(), key=str)
+                },
+                "exception_types": dict(self.exception_types.most_common()),
+                "n_fit_evaluations": {
+                    str(nfev): n for nfev, n in sorted(self.n_fit_evaluations.items())
+                },
+                "stage_durations": stages,
+            }
+
+    def dump_json(self, filepath):
+        "Write the aggregated telemetry to a JSON file"
+        filepath = pathlib.Path(filepath)
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        with open(filepath, "w") as fp:
+            json.dump(self.to_dict(), fp, indent=2)
+
+    def __add_duration(self, stage_name, duration):
+        "Must be called while holding the lock"
+        stats = self.__stage_durations.get(stage_name)
+        if stats is None:
+            stats = {
+                "count": 0,
+                "total": 0.0,
+                "max": 0.0,
+                "bucket_counts": [0] * (len(self.DURATION_BUCKET_EDGES) + 1),
+            }
+            self.__stage_durations[stage_name] = stats
+        stats["count"] += 1
+        stats["total"] += duration
+        stats["max"] = max(stats["max"], duration)
+        stats["bucket_counts"][bisect_left(self.DURATION_BUCKET_EDGES, duration)] += 1
@@ -0,0 +1,592 @@
+"""Render annotated animations (.gif or .mp4) of the analysis of a video's frames
+
+Each frame of an animation is the camera frame overlaid with the fitted circle, the
+edge points used for the fit, and the frame's radius and tilt. Frames can come from
+a directory of .bmp files (which are analyzed while rendering), from the results and
+images stored in the database, or from any stream of (image, result) pairs.
+
+Frames are rendered in a pool of threads and encoded in order as soon as they're
+ready, with a bounded number of frames in flight, so memory use doesn't grow with
+the length of the video. GIFs are written with a fixed palette (gray levels plus the
+overlay colors) so they can be written one frame at a time, and MP4s are written
+with OpenCV.
+
+Typical usage:
+    python -m flyeranalysis.animation [output.gif] --input_dir [directory of frames]
+    python -m flyeranalysis.animation [output.mp4] --db [connection_string] --metadata_link_id [ID]
+"""
+
+# imports
+import os
+import pathlib
+import logging
+from io import BytesIO
+from collections import deque
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from PIL import Image, GifImagePlugin
+from sqlalchemy import create_engine, select
+from .flyer_detection_core import (
+    FlyerDetectionCore,
+    FlyerCharacteristics,
+    STREAM_ANALYSIS_KWARGS,
+)
+from .analysis_artifact import (
+    is_analysis_artifact,
+    get_analysis_artifact_edge_points,
+)
+from .flyer_analysis_entry import FlyerAnalysisEntry
+from .flyer_image_entry import FlyerImageEntry
+from .video_summary_entry import VideoSummaryEntry
+from .image_store import get_image_store
+
+# Overlay colors (RGB)
+CIRCLE_COLOR = (255, 0, 0)
+EDGE_POINT_COLOR = (255, 165, 0)
+TEXT_COLOR = (255, 255, 0)
+TEXT_BACKGROUND = (0, 0, 0)
+TEXT_FONT = cv2.FONT_HERSHEY_SIMPLEX
+TEXT_SCALE = 0.45
+# Fitted circles larger than this (in pixels) aren't drawn
+MAX_DRAWN_RADIUS = 1e6
+DEF_FPS = 10
+
+
+def render_frame(img, result):
+    """Return an annotated animation frame for a camera frame and its analysis result
+
+    Args:
+        img: the camera frame as a (grayscale or RGB) image array
+        result: the frame's "FlyerCharacteristics" result. The circle is drawn if it
+            has a fit, and the edge points are drawn if it has flyer_row and
+            flyer_column.
+
+    Returns: the annotated frame as an RGB uint8 array
+    """
+    img = np.asarray(img)
+    if img.dtype != np.uint8:
+        img = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    frame = (
+        cv2.cvtColor(img, cv2.COLOR_GRAY2RGB) if img.ndim == 2 else img[..., :3].copy()
+    )
+    has_fit = result.radius is not None and np.isfinite(result.radius)
+    if has_fit and result.radius <= MAX_DRAWN_RADIUS:
+        # cv2 draws with fixed-point coordinates with 4 fractional bits
+        cv2.circle(
+            frame,
+            (round(16 * result.center_column), round(16 * result.center_row)),
+            round(16 * result.radius),
+            CIRCLE_COLOR,
+            1,
+            cv2.LINE_AA,
+            shift=4,
+        )
+    if result.flyer_row is not None and result.flyer_column is not None:
+        flyer_row = np.asarray(result.flyer_row, dtype=np.intp)
+        flyer_column = np.asarray(result.flyer_column, dtype=np.intp)
+        in_frame = (
+            (flyer_row >= 0)
+            & (flyer_row < frame.shape[0])
+            & (flyer_column >= 0)
+            & (flyer_column < frame.shape[1])
+        )
+        frame[flyer_row[in_frame], flyer_column[in_frame]] = EDGE_POINT_COLOR
+    if has_fit:
+        text = f"radius = {result.radius:.1f} px"
+        if result.tilt is not None:
+            text += f", tilt = {np.degrees(result.tilt):.2f} deg"
+    else:
+        text = f"no fit (exit code {result.exit_code})"
+    (text_width, text_height), baseline = cv2.getTextSize(
+        text, TEXT_FONT, TEXT_SCALE, 1
+    )
+    cv2.rectangle(
+        frame, (0, 0), (text_width + 8, text_height + baseline + 8), TEXT_BACKGROUND, -1
+    )
+    cv2.putText(
+        frame,
+        text,
+        (4, text_height + 4),
+        TEXT_FONT,
+        TEXT_SCALE,
+        TEXT_COLOR,
+        1,
+        cv2.LINE_AA,
+    )
+    return frame
+
+
+class AnimationRenderer:
+    """Renders annotated frames in a pool of threads and encodes them in order
+
+    Frames are added with add_frame (given an image and its result) or
+    add_frame_from (given a function that returns them, which is called in one of
+    the rendering threads). Once max_pending frames are in flight, adding another
+    one blocks until the oldest one has been encoded. Use as a context manager, or
+    call close when done adding frames to finish writing the file.
+
+    Args:
+        output_path: path to the .gif or .mp4 file to write
+        fps: the number of frames per second in the animation
+        n_threads: the number of threads rendering frames (default = number of CPUs)
+        max_pending: the maximum number of frames in flight at once
+            (default = 2 * n_threads)
+        loop: the number of times a GIF should loop (0 means forever)
+
+    Raises:
+        ValueError: the output file extension isn't .gif or .mp4
+    """
+
+    FILE_SUFFIXES = (".gif", ".mp4")
+
+    def __init__(
+        self, output_path, *, fps=DEF_FPS, n_threads=None, max_pending=None, loop=0
+    ):
+        self.output_path = pathlib.Path(output_path)
+        if self.output_path.suffix.lower() not in self.FILE_SUFFIXES:
+            raise ValueError(
+                f"ERROR: can't write an animation to {self.output_path} "
+                f"(expected a file ending in one of {', '.join(self.FILE_SUFFIXES)})"
+            )
+        self.fps = fps
+        self.loop = loop
+        self.n_threads = n_threads if n_threads is not None else os.cpu_count()
+        self.max_pending = (
+            max_pending if max_pending is not None else 2 * self.n_threads
+        )
+        self.n_frames = 0
+        self.__executor = ThreadPoolExecutor(
+            max_workers=self.n_threads, thread_name_prefix="AnimationRenderer"
+        )
+        self.__pending = deque()
+        self.__encoder = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.__abort()
+
+    def add_frame(self, img, result):
+        "Add a camera frame and its FlyerCharacteristics result to the animation"
+        self.__submit(render_frame, img, result)
+
+    def add_frame_from(self, get_frame, *args):
+        """Add a frame to the animation given a function (called in a rendering
+        thread with *args) that returns its (image, result) pair
+        """
+        self.__submit(_render_frame_from, get_frame, *args)
+
+    def close(self):
+        "Encode every frame that's in flight and finish writing the file"
+        try:
+            while self.__pending:
+                self.__encode(self.__pending.popleft().result())
+        except Exception:
+            self.__abort()
+            raise
+        self.__executor.shutdown(wait=True)
+        if self.__encoder is not None:
+            self.__encoder.close()
+            self.__encoder = None
+
+    def __submit(self, function, *args):
+        self.__pending.append(self.__executor.submit(function, *args))
+        while len(self.__pending) > self.max_pending:
+            self.__encode(self.__pending.popleft().result())
+
+    def __encode(self, frame):
+        if self.__encoder is None:
+            self.output_path.parent.mkdir(parents=True, exist_ok=True)
+            if self.output_path.suffix.lower() == ".gif":
+                self.__encoder = _GifEncoder(
+                    self.output_path, frame.shape, self.fps, self.loop
+                )
+            else:
+                self.__encoder = _Mp4Encoder(self.output_path, frame.shape, self.fps)
+        self.__encoder.write(frame)
+        self.n_frames += 1
+
+    def __abort(self):
+        for future in self.__pending:
+            future.cancel()
+        self.__pending.clear()
+        self.__executor.shutdown(wait=True)
+        if self.__encoder is not None:
+            self.__encoder.close()
+            self.__encoder = None
+
+
+class _GifEncoder:
+    "Writes RGB frames to a GIF file one at a time using a fixed palette"
+
+    N_GRAY_LEVELS = 248
+
+    def __init__(self, output_path, frame_shape, fps, loop):
+        self.frame_shape = frame_shape
+        self.duration = round(1000 / fps)
+        self.loop = loop
+        self.__fp = open(output_path, "wb")
+        self.__wrote_header = False
+        gray_levels = np.linspace(0, 255, self.N_GRAY_LEVELS).round().astype(np.uint8)
+        colors = [(level, level, level) for level in gray_levels]
+        colors += [CIRCLE_COLOR, EDGE_POINT_COLOR, TEXT_COLOR]
+        colors += [(0, 0, 0)] * (256 - len(colors))
+        self.__palette = Image.new("P", (1, 1))
+        self.__palette.putpalette(np.asarray(colors, dtype=np.uint8).tobytes())
+
+    def write(self, frame):
+        "Quantize an RGB frame to the palette and append it to the file"
+        if frame.shape != self.frame_shape:
+            raise ValueError(
+                f"ERROR: frames with different shapes ({self.frame_shape} and "
+                f"{frame.shape}) can't be written to the same animation!"
+            )
+        img = Image.fromarray(frame).quantize(
+            palette=self.__palette, dither=Image.Dither.NONE
+        )
+        if not self.__wrote_header:
+            header, _ = GifImagePlugin.getheader(
+                img, info={"loop": self.loop, "optimize": False}
+            )
+            self.__fp.write(b"".join(header))
+            self.__wrote_header = True
+        for data in GifImagePlugin.getdata(img, duration=self.duration):
+            self.__fp.write(data)
+
+    def close(self):
+        "Write the GIF trailer and close the file"
+        if self.__wrote_header:
+            self.__fp.write(b";")
+        self.__fp.close()
+
+
+class _Mp4Encoder:
+    "Writes RGB frames to an MP4 file one at a time"
+
+    FOURCC = "mp4v"
+
+    def __init__(self, output_path, frame_shape, fps):
+        self.frame_shape = frame_shape
+        self.__writer = cv2.VideoWriter(
+            str(output_path),
+            cv2.VideoWriter_fourcc(*self.FOURCC),
+            fps,
+            (frame_shape[1], frame_shape[0]),
+        )
+        if not self.__writer.isOpened():
+            raise OSError(f"ERROR: failed to open {output_path} to write a video")
+
+    def write(self, frame):
+        "Append an RGB frame to the video"
+        if frame.shape != self.frame_shape:
+            raise ValueError(
+                f"ERROR: frames with different shapes ({self.frame_shape} and "
+                f"{frame.shape}) can't be written to the same animation!"
+            )
+        self.__writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+
+    def close(self):
+        "Finish writing the video"
+        self.__writer.release()
+
+
+def render_animation_from_results(frames, output_path, **kwargs):
+    """Render an animation from a stream of (image, result) pairs
+
+    Args:
+        frames: an iterable of (camera frame image array, FlyerCharacteristics) pairs
+        output_path: path to the .gif or .mp4 file to write
+        kwargs: other keyword arguments are passed to AnimationRenderer
+
+    Returns: the number of frames in the animation
+    """
+    with AnimationRenderer(output_path, **kwargs) as renderer:
+        for img, result in frames:
+            renderer.add_frame(img, result)
+    return renderer.n_frames
+
+
+def render_animation_from_directory(
+    input_dir, output_path, *, first_frame=None, last_frame=None, **kwargs
+):
+    """Analyze and render an animation of the .bmp frames in a directory
+
+    Frames are analyzed with the same settings used for frames whose results go
+    to the database, in the rendering threads.
+
+    Args:
+        input_dir: path to the directory of .bmp frames
+        output_path: path to the .gif or .mp4 file to write
+        first_frame: the index of the first frame to include
+        last_frame: the index of the last frame to include
+        kwargs: other keyword arguments are passed to AnimationRenderer
+
+    Returns: the number of frames in the animation
+    """
+    analyzer = FlyerDetectionCore()
+    frame_paths = [
+        frame_path
+        for frame_path in sorted(pathlib.Path(input_dir).glob("*.bmp"))
+        if _in_frame_range(frame_path, first_frame, last_frame)
+    ]
+    with AnimationRenderer(output_path, **kwargs) as renderer:
+        for frame_path in frame_paths:
+            renderer.add_frame_from(
+                _analyze_frame_bytes, analyzer, frame_path, frame_path.read_bytes()
+            )
+    return renderer.n_frames
+
+
+def render_animation_from_db(
+    db_connection_str,
+    output_path,
+    *,
+    metadata_link_id=None,
+    rel_filepath_prefix=None,
+    first_frame=None,
+    last_frame=None,
+    image_store=None,
+    chunk_size=100,
+    **kwargs,
+):
+    """Render an animation of one video's frames from the results and images in the
+    database
+
+    The edge points are drawn for frames whose analysis images are stored as
+    compact artifacts (frames with older .npz analysis images only get the circle).
+
+    Args:
+        db_connection_str: SQLAlchemy connection string for the database
+        output_path: path to the .gif or .mp4 file to write
+        metadata_link_id: render the frames linked to this metadata_links ID
+        rel_filepath_prefix: render the frames whose relative filepaths start with
+            this string (i.e. the video's directory)
+        first_frame: the index of the first frame to include
+        last_frame: the index of the last frame to include
+        image_store: where images are kept if they're not stored inline in the
+            database (a string accepted by image_store.get_image_store)
+        chunk_size: the number of rows to read from the database at once
+        kwargs: other keyword arguments are passed to AnimationRenderer
+
+    Returns: the number of frames in the animation
+
+    Raises:
+        ValueError: neither metadata_link_id nor rel_filepath_prefix was given
+    """
+    if metadata_link_id is None and rel_filepath_prefix is None:
+        raise ValueError(
+            "ERROR: a metadata_link_id or rel_filepath_prefix is needed to select "
+            "the frames of a video!"
+        )
+    image_store = get_image_store(image_store)
+    stmt = select(
+        FlyerAnalysisEntry.rel_filepath,
+        FlyerAnalysisEntry.exit_code,
+        FlyerAnalysisEntry.radius,
+        FlyerAnalysisEntry.tilt,
+        FlyerAnalysisEntry.leading_row,
+        FlyerAnalysisEntry.center_row,
+        FlyerAnalysisEntry.center_column,
+        FlyerImageEntry.camera_image,
+        FlyerImageEntry.camera_image_key,
+        FlyerImageEntry.camera_image_checksum,
+        FlyerImageEntry.analysis_image,
+        FlyerImageEntry.analysis_image_key,
+        FlyerImageEntry.analysis_image_checksum,
+    ).join(FlyerImageEntry, FlyerImageEntry.analysis_result_ID == FlyerAnalysisEntry.ID)
+    if metadata_link_id is not None:
+        stmt = stmt.where(FlyerAnalysisEntry.metadata_link_ID == metadata_link_id)
+    if rel_filepath_prefix is not None:
+        stmt = stmt.where(
+            FlyerAnalysisEntry.rel_filepath.startswith(rel_filepath_prefix)
+        )
+    stmt = stmt.order_by(FlyerAnalysisEntry.rel_filepath)
+    engine = create_engine(db_connection_str)
+    try:
+        with engine.connect() as conn, AnimationRenderer(
+            output_path, **kwargs
+        ) as renderer:
+            rows = conn.execution_options(
+                stream_results=True, yield_per=chunk_size
+            ).execute(stmt)
+            for row in rows:
+                if row.camera_image is None and row.camera_image_key is None:
+                    continue
+                if not _in_frame_range(row.rel_filepath, first_frame, last_frame):
+                    continue
+                renderer.add_frame_from(_decode_db_row, row, image_store)
+    finally:
+        engine.dispose()
+    return renderer.n_frames
+
+
+def _render_frame_from(get_frame, *args):
+    "Render the frame for the (image, result) pair returned by get_frame(*args)"
+    return render_frame(*get_frame(*args))
+
+
+def _analyze_frame_bytes(analyzer, frame_path, frame_bytes):
+    "Return the (image, result) pair for the raw bytes of a frame's image file"
+    img = np.asarray(Image.open(BytesIO(frame_bytes)))
+    result, _ = analyzer.analyze_frame(
+        frame_path, None, img=img, **STREAM_ANALYSIS_KWARGS
+    )
+    return img, result
+
+
+def _decode_db_row(row, image_store):
+    "Return the (image, result) pair for a row of results and images from the DB"
+    camera_image = _get_row_image_bytes(row, "camera_image", image_store)
+    result = FlyerCharacteristics()
+    for name in (
+        "rel_filepath",
+        "exit_code",
+        "radius",
+        "tilt",
+        "leading_row",
+        "center_row",
+        "center_column",
+    ):
+        setattr(result, name, getattr(row, name))
+    analysis_image = _get_row_image_bytes(row, "analysis_image", image_store)
+    if is_analysis_artifact(analysis_image):
+        result.flyer_row, result.flyer_column = get_analysis_artifact_edge_points(
+            analysis_image
+        )
+    return np.asarray(Image.open(BytesIO(camera_image))), result
+
+
+def _get_row_image_bytes(row, column, image_store):
+    "Return the bytes of one of the images in a row, reading it from the image store if necessary"
+    data = getattr(row, column)
+    key = getattr(row, f"{column}_key")
+    if data is not None or key is None:
+        return data
+    if image_store is None:
+        raise ValueError(
+            f"ERROR: the {column} for {row.rel_filepath} is kept in an image store, "
+            "but no image store was given to read it from!"
+        )
+    return image_store.get(key, checksum=getattr(row, f"{column}_checksum"))
+
+
+def _in_frame_range(rel_filepath, first_frame, last_frame):
+    "Return True if a frame's index is within an (optional) range"
+    if first_frame is None and last_frame is None:
+        return True
+    frame_index = VideoSummaryEntry.get_frame_index(rel_filepath)
+    if frame_index is None:
+        return False
+    if first_frame is not None and frame_index < first_frame:
+        return False
+    return last_frame is None or frame_index <= last_frame
+
+
+def get_command_line_options(args=None):
+    """Return the command line options given an (optional) list of args
+
+    Args:
+        args: a list of arguments to pass to the parser instead of using sys.argv
+
+    Returns: A namespace of parsed arguments
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "output_path",
+        type=pathlib.Path,
+        help="Path to the .gif or .mp4 file to write",
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        "--input_dir",
+        type=pathlib.Path,
+        help="A directory of .bmp frames to analyze and render",
+    )
+    source.add_argument(
+        "--db",
+        dest="db_connection_str",
+        help="The SQLAlchemy connection string for a database of results to render",
+    )
+    parser.add_argument(
+        "--metadata_link_id",
+        type=int,
+        help="Render the frames in the database linked to this metadata_links ID",
+    )
+    parser.add_argument(
+        "--rel_filepath_prefix",
+        help=(
+            "Render the frames in the database whose relative filepaths start with "
+            "this string (i.e. the video's directory)"
+        ),
+    )
+    parser.add_argument(
+        "--image_store",
+        help=(
+            "Where images are kept if they're not stored inline in the database: "
+            'a path to a local/shared directory, or an "s3://bucket/prefix" URL'
+        ),
+    )
+    parser.add_argument(
+        "--first_frame",
+        type=int,
+        help="The index of the first frame to include",
+    )
+    parser.add_argument(
+        "--last_frame",
+        type=int,
+        help="The index of the last frame to include",
+    )
+    parser.add_argument(
+        "--fps",
+        type=float,
+        default=DEF_FPS,
+        help=f"The number of frames per second in the animation (default = {DEF_FPS})",
+    )
+    parser.add_argument(
+        "--n_threads",
+        type=int,
+        default=None,
+        help="The number of threads rendering frames (default = number of CPUs)",
+    )
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    "Render an animation from the command line"
+    options = get_command_line_options(args)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(name)s %(asctime)s] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    logger = logging.getLogger("AnimationRenderer")
+    kwargs = {
+        "first_frame": options.first_frame,
+        "last_frame": options.last_frame,
+        "fps": options.fps,
+        "n_threads": options.n_threads,
+    }
+    if options.input_dir is not None:
+        n_frames = render_animation_from_directory(
+            options.input_dir, options.output_path, **kwargs
+        )
+    else:
+        n_frames = render_animation_from_db(
+            options.db_connection_str,
+            options.output_path,
+            metadata_link_id=options.metadata_link_id,
+            rel_filepath_prefix=options.rel_filepath_prefix,
+            image_store=options.image_store,
+            **kwargs,
+        )
+    logger.info("Wrote %d frames to %s", n_frames, options.output_path)
+
+
+if __name__ == "__main__":
+    main()
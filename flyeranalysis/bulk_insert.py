@@ -0,0 +1,129 @@
+"""Bulk inserts of rows into SQL tables, using the fastest method for each kind of DB
+
+    - Microsoft SQL Server: batches of rows are sent with executemany. Engines created
+      with the keyword arguments from get_engine_kwargs use pyodbc's
+      "fast_executemany", which sends each batch as an array of parameters instead of
+      making a round trip for every row.
+    - PostgreSQL: batches of rows are streamed with "COPY ... FROM STDIN" (with either
+      psycopg2 or psycopg 3).
+    - SQLite (and any other DB): batches of rows are sent with executemany, all in the
+      caller's transaction.
+
+Works with any SQLAlchemy Table, including the tables of the ORM classes (e.g.
+FlyerAnalysisEntry.__table__).
+"""
+
+# imports
+import io
+import datetime
+from sqlalchemy import insert
+from sqlalchemy.engine import make_url
+
+# The default maximum number of rows to send to the DB at once
+DEF_CHUNK_SIZE = 10000
+
+
+def get_engine_kwargs(connection_str):
+    """Return extra keyword arguments for sqlalchemy.create_engine that make bulk
+    inserts and updates faster for the DB in a connection string
+
+    Args:
+        connection_str: the SQLAlchemy connection string for the DB
+
+    Returns: a dictionary of keyword arguments (empty if none are needed)
+    """
+    url = make_url(connection_str)
+    kwargs = {}
+    if url.get_backend_name() == "mssql" and url.get_driver_name() == "pyodbc":
+        kwargs["fast_executemany"] = True
+    return kwargs
+
+
+def bulk_insert(conn, table, rows, *, chunk_size=DEF_CHUNK_SIZE, logger=None):
+    """Insert rows into a table through an open connection, without committing
+
+    Args:
+        conn: an open SQLAlchemy Connection (the rows are added in its transaction)
+        table: the SQLAlchemy Table to insert the rows into
+        rows: a list of dictionaries of column values. Keys that aren't columns in the
+            table are ignored, and columns that are only missing from some of the rows
+            are inserted as NULL in those rows.
+        chunk_size: the maximum number of rows to send to the DB at once
+        logger: a logger to send a (debug) progress message to after every chunk
+
+    Returns: the number of rows inserted
+    """
+    rows = list(rows)
+    if len(rows) < 1:
+        return 0
+    row_keys = set().union(*rows)
+    column_names = [column.name for column in table.columns if column.name in row_keys]
+    insert_chunk = _execute_many
+    if conn.dialect.name == "postgresql" and conn.dialect.driver in (
+        "psycopg2",
+        "psycopg",
+    ):
+        insert_chunk = _copy
+    n_inserted = 0
+    for start in range(0, len(rows), chunk_size):
+        chunk = [
+            {name: row.get(name) for name in column_names}
+            for row in rows[start : start + chunk_size]
+        ]
+        insert_chunk(conn, table, column_names, chunk)
+        n_inserted += len(chunk)
+        if logger is not None:
+            logger.debug(
+                "Inserted %d of %d rows into the %s table",
+                n_inserted,
+                len(rows),
+                table.name,
+            )
+    return n_inserted
+
+
+def _execute_many(conn, table, column_names, rows):
+    "Insert a chunk of rows with a single executemany"
+    conn.execute(insert(table), rows)
+
+
+def _copy(conn, table, column_names, rows):
+    "Insert a chunk of rows into a PostgreSQL table with COPY ... FROM STDIN"
+    preparer = conn.dialect.identifier_preparer
+    columns_str = ", ".join(preparer.quote(name) for name in column_names)
+    sql = (
+        f"COPY {preparer.format_table(table)} ({columns_str}) "
+        "FROM STDIN WITH (FORMAT csv)"
+    )
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(",".join(_get_copy_field(row[name]) for name in column_names))
+        buffer.write("\n")
+    # use the DBAPI connection underneath the SQLAlchemy one, so the rows are still
+    # added in the same transaction
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        if conn.dialect.driver == "psycopg2":
+            buffer.seek(0)
+            cursor.copy_expert(sql, buffer)
+        else:
+            with cursor.copy(sql) as copy:
+                copy.write(buffer.getvalue())
+    finally:
+        cursor.close()
+
+
+def _get_copy_field(value):
+    """Return a value formatted as a field for COPY in CSV format (NULL is an unquoted
+    empty field, and everything else is quoted so empty strings stay empty strings)
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        value = "t" if value else "f"
+    elif isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        value = value.isoformat()
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        value = f"\\x{bytes(value).hex()}"
+    value = str(value).replace('"', '""')
+    return f'"{value}"'
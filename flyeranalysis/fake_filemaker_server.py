@@ -0,0 +1,368 @@
+"""A local stand-in for the FileMaker Data API, for testing FileMakerToSQL
+
+Serves records from memory through the parts of the FileMaker Data API that
+FileMakerToSQL uses (logging in and out, and getting pages of records from a layout).
+It responds the same way a real FileMaker Server does, including returning error 401
+for a layout with no records and error 105 for a layout that doesn't exist.
+
+fmrest only allows plain http connections to URLs ending in ":3000", so the server
+listens on port 3000 by default.
+
+Typical usage:
+    python -m flyeranalysis.fake_filemaker_server [records_json_file]
+
+where the JSON file maps each layout name to a list of dictionaries of field values.
+Then, in another terminal:
+    python -m flyeranalysis.filemaker_to_sql [connection_string] http://127.0.0.1:3000
+"""
+
+# imports
+import re
+import json
+import time
+import uuid
+import base64
+import pathlib
+import threading
+from argparse import ArgumentParser
+from urllib.parse import urlsplit, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeFileMakerServer:
+    """Serves records for a set of layouts through a fake FileMaker Data API
+
+    Args:
+        records_by_layout: a dictionary mapping layout names to lists of dictionaries
+            of field values. Every record is given a recordId (starting from 1 in each
+            layout) and a modId of 0.
+        host: the interface to serve on
+        port: the port to serve on
+        database: the name of the database that can be logged in to
+        username, password: the credentials that are accepted (any credentials are
+            accepted if these are None)
+        response_delay: seconds to wait before responding to each request for
+            records (to imitate the latency of a real server)
+    """
+
+    DEF_PORT = 3000
+    API_PATH_REGEX = re.compile(
+        r"^/fmi/data/(?P<version>v\w+)/databases/(?P<database>[^/]+)"
+        r"(?:/sessions(?:/(?P<token>[^/]*))?"
+        r"|/layouts/(?P<layout>[^/]+)/records)$"
+    )
+
+    @property
+    def url(self):
+        "The URL to give fmrest (or FileMakerToSQL.connect_to_dbs) to reach the server"
+        host, port = self.__server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __init__(
+        self,
+        records_by_layout,
+        *,
+        host="127.0.0.1",
+        port=DEF_PORT,
+        database="Laser Shock",
+        username=None,
+        password=None,
+        response_delay=0.0,
+    ):
+        self.database = database
+        self.username = username
+        self.password = password
+        self.response_delay = response_delay
+        self.layouts = {
+            layout: [
+                {"recordId": str(irec + 1), "modId": "0", "fieldData": dict(fields)}
+                for irec, fields in enumerate(records)
+            ]
+            for layout, records in records_by_layout.items()
+        }
+        # the number of requests made for pages of records, keyed by layout name
+        self.n_record_requests = {layout: 0 for layout in self.layouts}
+        self.__tokens = set()
+        self.__lock = threading.Lock()
+        self.__server = ThreadingHTTPServer((host, port), _get_handler(self))
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(
+            target=self.__server.serve_forever, daemon=True
+        )
+
+    def start(self):
+        "Start serving in a background thread"
+        self.__thread.start()
+
+    def stop(self):
+        "Stop serving and close the socket"
+        self.__server.shutdown()
+        self.__server.server_close()
+        if self.__thread.is_alive():
+            self.__thread.join()
+
+    def serve_forever(self):
+        "Serve in the current thread until interrupted"
+        try:
+            self.__server.serve_forever()
+        finally:
+            self.__server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def add_record(self, layout, field_data):
+        """Add a record to a layout the way FileMaker would (with the next recordId
+        and a modId of 0)
+
+        Returns: the new record's recordId
+        """
+        with self.__lock:
+            records = self.layouts.setdefault(layout, [])
+            self.n_record_requests.setdefault(layout, 0)
+            record_id = str(
+                max((int(rec["recordId"]) for rec in records), default=0) + 1
+            )
+            records.append(
+                {"recordId": record_id, "modId": "0", "fieldData": dict(field_data)}
+            )
+        return record_id
+
+    def edit_record(self, layout, record_id, field_data):
+        """Change some of the field values of a record and increment its modId the way
+        FileMaker would
+
+        Raises:
+            KeyError: the record doesn't exist
+        """
+        with self.__lock:
+            record = self.__get_record(layout, record_id)
+            record["fieldData"].update(field_data)
+            record["modId"] = str(int(record["modId"]) + 1)
+
+    def delete_record(self, layout, record_id):
+        """Delete a record from a layout
+
+        Raises:
+            KeyError: the record doesn't exist
+        """
+        with self.__lock:
+            self.layouts[layout].remove(self.__get_record(layout, record_id))
+
+    def handle(self, method, path, headers):
+        """Return the (HTTP status, response dictionary) for a request
+
+        Args:
+            method: the HTTP method of the request
+            path: the path of the request, including any query string
+            headers: the headers of the request
+
+        Returns: a tuple of the HTTP status code and the JSON-able response body
+        """
+        split_path = urlsplit(path)
+        match = self.API_PATH_REGEX.match(split_path.path)
+        if match is None:
+            return _error(404, 404, "Invalid FileMaker Data API path")
+        if unquote(match["database"]) != self.database:
+            return _error(500, 802, "Unable to open file")
+        if match["layout"] is None:
+            if method == "POST":
+                return self.__login(headers)
+            if method == "DELETE":
+                return self.__logout(unquote(match["token"] or ""))
+            return _error(405, 1630, "URL is invalid")
+        if method != "GET":
+            return _error(405, 1630, "URL is invalid")
+        if not self.__is_authorized(headers):
+            return _error(401, 952, "Invalid FileMaker Data API token (*)")
+        query = parse_qs(split_path.query)
+        if self.response_delay > 0:
+            time.sleep(self.response_delay)
+        return self.__get_records(
+            unquote(match["layout"]),
+            int(query.get("_offset", ["1"])[0]),
+            int(query.get("_limit", ["100"])[0]),
+        )
+
+    def __get_record(self, layout, record_id):
+        for record in self.layouts[layout]:
+            if record["recordId"] == str(record_id):
+                return record
+        raise KeyError(f'No record with recordId {record_id} in the "{layout}" layout')
+
+    def __login(self, headers):
+        authorization = headers.get("Authorization", "")
+        if self.username is not None or self.password is not None:
+            try:
+                scheme, credentials = authorization.split(" ", 1)
+                username, password = (
+                    base64.b64decode(credentials).decode().split(":", 1)
+                )
+            except ValueError:
+                scheme, username, password = None, None, None
+            if (
+                scheme != "Basic"
+                or username != self.username
+                or password != self.password
+            ):
+                return _error(401, 212, "Invalid user account and/or password")
+        token = uuid.uuid4().hex
+        with self.__lock:
+            self.__tokens.add(token)
+        return 200, _response({"token": token})
+
+    def __logout(self, token):
+        with self.__lock:
+            if token not in self.__tokens:
+                return _error(401, 952, "Invalid FileMaker Data API token (*)")
+            self.__tokens.remove(token)
+        return 200, _response({})
+
+    def __is_authorized(self, headers):
+        authorization = headers.get("Authorization", "")
+        if not authorization.startswith("Bearer "):
+            return False
+        with self.__lock:
+            return authorization[len("Bearer ") :] in self.__tokens
+
+    def __get_records(self, layout, offset, limit):
+        if layout not in self.layouts:
+            return _error(500, 105, "Layout is missing")
+        if offset < 1 or limit < 1:
+            return _error(500, 960, "Parameter is invalid")
+        with self.__lock:
+            self.n_record_requests[layout] += 1
+            records = self.layouts[layout]
+            page = records[offset - 1 : offset - 1 + limit]
+        if len(page) < 1:
+            return _error(500, 401, "No records match the request")
+        data = [{**record, "portalData": {}} for record in page]
+        data_info = {
+            "database": self.database,
+            "layout": layout,
+            "table": layout,
+            "totalRecordCount": len(records),
+            "foundCount": len(records),
+            "returnedCount": len(page),
+        }
+        return 200, _response({"dataInfo": data_info, "data": data})
+
+
+def _response(response):
+    return {"response": response, "messages": [{"code": "0", "message": "OK"}]}
+
+
+def _error(status, code, message):
+    return status, {
+        "response": {},
+        "messages": [{"code": str(code), "message": message}],
+    }
+
+
+def _get_handler(fake_server):
+    "Return a request handler class that passes requests to a FakeFileMakerServer"
+
+    class FakeFileMakerRequestHandler(BaseHTTPRequestHandler):
+        "Responds to FileMaker Data API requests"
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            "Respond to a GET request"
+            self.__respond("GET")
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            "Respond to a POST request"
+            self.__respond("POST")
+
+        def do_DELETE(self):  # pylint: disable=invalid-name
+            "Respond to a DELETE request"
+            self.__respond("DELETE")
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            "Don't log every request"
+
+        def __respond(self, method):
+            content_length = int(self.headers.get("Content-Length", 0))
+            if content_length > 0:
+                self.rfile.read(content_length)
+            status, response = fake_server.handle(method, self.path, self.headers)
+            body = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return FakeFileMakerRequestHandler
+
+
+def get_command_line_options(args=None):
+    """Return the command line options given an (optional) list of args
+
+    Args:
+        args: a list of arguments to pass to the parser instead of using sys.argv
+
+    Returns: A namespace of parsed arguments
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "records_file",
+        type=pathlib.Path,
+        help=(
+            "Path to a JSON file mapping layout names to lists of dictionaries of "
+            "field values"
+        ),
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="The interface to serve on (default = 127.0.0.1)",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=FakeFileMakerServer.DEF_PORT,
+        help=f"The port to serve on (default = {FakeFileMakerServer.DEF_PORT})",
+    )
+    parser.add_argument(
+        "--username",
+        help="The only username to accept (default = accept any credentials)",
+    )
+    parser.add_argument(
+        "--password",
+        help="The only password to accept (default = accept any credentials)",
+    )
+    parser.add_argument(
+        "--response_delay",
+        type=float,
+        default=0.0,
+        help="Seconds to wait before responding to each request for records (default = 0)",
+    )
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    "Serve the records in a JSON file until interrupted"
+    options = get_command_line_options(args)
+    with open(options.records_file, "r") as fp:
+        records_by_layout = json.load(fp)
+    server = FakeFileMakerServer(
+        records_by_layout,
+        host=options.host,
+        port=options.port,
+        username=options.username,
+        password=options.password,
+        response_delay=options.response_delay,
+    )
+    print(f"Serving {len(records_by_layout)} layouts at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
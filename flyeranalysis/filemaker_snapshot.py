@@ -0,0 +1,184 @@
+"""A local snapshot of the raw records in FileMaker layouts
+
+Lets FileMakerToSQL convert layouts without downloading every record again (or without
+connecting to FileMaker at all), which makes iterating on the SQL schema/transforms
+and running tests much faster.
+
+Each layout's records (the recordId, modId, and every field as returned by the
+FileMaker Data API) are stored in their own Parquet file. Every value is stored as
+JSON text, so the mix of numbers and strings FileMaker returns for a field comes back
+exactly as it was fetched. A manifest.json file records when each layout was fetched,
+how many records it had, and a hash of its contents.
+
+Reading and writing snapshots requires pyarrow.
+"""
+
+# imports
+import os
+import re
+import json
+import hashlib
+import pathlib
+import datetime
+import threading
+import pandas as pd
+
+
+class FileMakerSnapshot:
+    """A directory of snapshots of the records in FileMaker layouts
+
+    A layout's snapshot is "expired" once it's older than max_age. When converting,
+    FileMakerToSQL fetches a layout again if it isn't in the snapshot, if its snapshot
+    has expired, or if FileMaker reports a different number of records in it than the
+    snapshot has (which only takes a single one-record request to check). The Data API
+    can't tell whether records were edited without fetching them, so edits that don't
+    change the number of records in a layout are only picked up once the layout's
+    snapshot expires. Syncing exists to pick up those edits, so it always fetches
+    layouts from FileMaker when it can (and updates the snapshot with them). Safe to
+    use from several threads at once.
+
+    Args:
+        snapshot_dir: path to the directory holding the snapshot (created if necessary)
+        max_age: a datetime.timedelta (or number of seconds) after which a layout's
+            snapshot expires (default = one day, None means snapshots never expire)
+    """
+
+    MANIFEST_FILENAME = "manifest.json"
+    FILE_SUFFIX = ".parquet"
+    DEF_MAX_AGE = datetime.timedelta(days=1)
+
+    @property
+    def layouts(self):
+        "A list of the names of the layouts in the snapshot"
+        with self.__lock:
+            return list(self.__manifest)
+
+    def __init__(self, snapshot_dir, max_age=DEF_MAX_AGE):
+        try:
+            import pyarrow  # pylint: disable=import-outside-toplevel, unused-import
+        except ImportError as exc:
+            raise ImportError(
+                "ERROR: pyarrow is needed to read and write FileMaker snapshots. "
+                "You can install it with 'pip install flyeranalysis[export]'."
+            ) from exc
+        self.snapshot_dir = pathlib.Path(snapshot_dir)
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        if max_age is not None and not isinstance(max_age, datetime.timedelta):
+            max_age = datetime.timedelta(seconds=max_age)
+        self.max_age = max_age
+        self.__lock = threading.Lock()
+        self.__manifest = {}
+        manifest_path = self.snapshot_dir / self.MANIFEST_FILENAME
+        if manifest_path.is_file():
+            with open(manifest_path, "r") as fp:
+                self.__manifest = json.load(fp)
+
+    def __str__(self):
+        return f"{self.__class__.__name__}({self.snapshot_dir})"
+
+    def get_info(self, layout):
+        """Return a dictionary of the filename, fetch time ("fetched_at", a datetime),
+        number of records ("n_records"), and content hash ("content_hash") of a
+        layout's snapshot, or None if the layout isn't in the snapshot
+        """
+        with self.__lock:
+            info = self.__manifest.get(layout)
+        if info is None:
+            return None
+        return {
+            **info,
+            "fetched_at": datetime.datetime.fromisoformat(info["fetched_at"]),
+        }
+
+    def is_expired(self, layout):
+        "Return True if a layout isn't in the snapshot or its snapshot has expired"
+        info = self.get_info(layout)
+        if info is None:
+            return True
+        if self.max_age is None:
+            return False
+        return datetime.datetime.now() - info["fetched_at"] > self.max_age
+
+    def read(self, layout):
+        """Return a dataframe of the records in a layout's snapshot
+
+        Raises:
+            KeyError: the layout isn't in the snapshot
+        """
+        info = self.get_info(layout)
+        if info is None:
+            raise KeyError(f'The "{layout}" layout is not in {self}')
+        encoded_df = pd.read_parquet(self.snapshot_dir / info["filename"])
+        return pd.DataFrame(
+            {
+                column: [json.loads(value) for value in encoded_df[column]]
+                for column in encoded_df.columns
+            },
+            columns=list(encoded_df.columns),
+        )
+
+    def write(self, layout, records_df, fetched_at=None):
+        """Store the records from a layout, replacing any previous snapshot of it
+
+        The layout's file is only rewritten if its contents have changed, but its
+        fetch time is always updated.
+
+        Args:
+            layout: the name of the layout
+            records_df: a dataframe of the layout's records
+            fetched_at: the datetime when the records were fetched (default = now)
+
+        Returns: True if the layout's records changed (or are new to the snapshot)
+        """
+        if fetched_at is None:
+            fetched_at = datetime.datetime.now()
+        encoded_df = pd.DataFrame(
+            {
+                column: [
+                    json.dumps(value) for value in records_df[column].astype(object)
+                ]
+                for column in records_df.columns
+            },
+            columns=list(records_df.columns),
+            dtype=str,
+        )
+        content_hash = self.__get_content_hash(encoded_df)
+        previous_info = self.get_info(layout)
+        changed = previous_info is None or previous_info["content_hash"] != content_hash
+        filename = (
+            f"{re.sub(r'[^A-Za-z0-9]+', '_', layout).strip('_')}{self.FILE_SUFFIX}"
+        )
+        if changed:
+            filepath = self.snapshot_dir / filename
+            tmp_path = filepath.with_name(
+                f"{filepath.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+            )
+            encoded_df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, filepath)
+        with self.__lock:
+            self.__manifest[layout] = {
+                "filename": filename,
+                "fetched_at": fetched_at.isoformat(),
+                "n_records": int(records_df.shape[0]),
+                "content_hash": content_hash,
+            }
+            self.__write_manifest()
+        return changed
+
+    def __get_content_hash(self, encoded_df):
+        content_hash = hashlib.sha256()
+        content_hash.update(json.dumps(list(encoded_df.columns)).encode())
+        for column in encoded_df.columns:
+            for value in encoded_df[column]:
+                content_hash.update(value.encode())
+                content_hash.update(b"\n")
+        return content_hash.hexdigest()
+
+    def __write_manifest(self):
+        manifest_path = self.snapshot_dir / self.MANIFEST_FILENAME
+        tmp_path = manifest_path.with_name(
+            f"{manifest_path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        with open(tmp_path, "w") as fp:
+            json.dump(self.__manifest, fp, indent=2)
+        os.replace(tmp_path, manifest_path)
@@ -13,13 +13,20 @@ import json
 import getpass
 import datetime
 import warnings
+import threading
+import contextlib
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import numpy as np
+import pandas as pd
 from sqlalchemy import (
     create_engine,
     MetaData,
     Table,
     Column,
-    insert,
+    update,
+    delete,
+    bindparam,
     String,
     Float,
     Integer,
@@ -27,10 +34,12 @@ from sqlalchemy import (
     DateTime,
     select,
     and_,
-    or_,
     func,
 )
 import fmrest
+from fmrest.exceptions import FileMakerError
+from .bulk_insert import DEF_CHUNK_SIZE, bulk_insert, get_engine_kwargs
+from .filemaker_snapshot import FileMakerSnapshot
 
 
 class FileMakerToSQL:
@@ -60,10 +69,18 @@ class FileMakerToSQL:
     )
     FMREST_SERVER_EXTRA_KWARGS = {"verify_ssl": False, "api_version": "v1"}
     FM_DB_NAME = "Laser Shock"
+    # FileMaker error code returned when a layout has no records
+    FM_NO_RECORDS_ERROR_CODE = 401
+    DEF_PAGE_SIZE = 1000
+    # The bookkeeping table of the recordId and modId of every record added to the SQL DB
+    SYNC_TABLE_NAME = "filemaker_sync_watermarks"
+    DEF_N_THREADS = 4
     FM_LAYOUT_MAP_FILEPATH = (
         pathlib.Path(__file__).resolve().parent / "filemaker_layout_map.json"
     )
     TYPE_HIERARCHY = [float, int, str]
+    # Values that are treated as missing
+    NULL_VALUES = ["", " ", "N/A", "?"]
     TYPE_MAP = {
         str: String,
         float: Float,
@@ -104,27 +121,55 @@ class FileMakerToSQL:
         self.fm_ip_address = None
         self.fm_uname = None
         self.fm_pword = None
+        # FileMaker Server instances are reused within (but not shared between) threads
+        self.__thread_local = threading.local()
+        self.__fm_servers = []
+        self.__fm_servers_lock = threading.Lock()
+        # The Python type for each column of each layout, inferred once per conversion
+        self.__column_python_types = {}
+        # The snapshot used in the current conversion, the layouts in it that were
+        # fetched from FileMaker again, and whether layouts whose number of records
+        # hasn't changed can be read from it (only when converting, not syncing)
+        self.__snapshot = None
+        self.__fetched_layouts = set()
+        self.__reuse_unchanged_layouts = True
+        self.__chunk_size = DEF_CHUNK_SIZE
+        # Tables are added to the shared MetaData (and created) one at a time, and
+        # SQLite DBs are written to by one thread at a time
+        self.__meta_lock = threading.Lock()
+        self.__write_lock = contextlib.nullcontext()
 
-    def connect_to_dbs(self, connection_str, filemaker_ip, verbose=False):
+    def connect_to_dbs(
+        self, connection_str, filemaker_ip, verbose=False, username=None, password=None
+    ):
         """Initialize authentication information for the SQL and FileMaker DBs
 
         Creates a SQLAlchemy engine for interacting with the SQL DB. Gets the user's
-        JHED username and password and tests authenticating to a layout of the
-        FileMaker DB.
+        JHED username and password (if they're not given) and tests authenticating
+        to a layout of the FileMaker DB.
 
         Args:
             connection_str: The string for connecting to the output SQL DB using SQLAlchemy
             filemaker_ip: The IP Address from which the FileMaker DB is reachable
+                (https:// is assumed unless the address starts with http://). If None,
+                FileMaker isn't connected to, and records can only be converted from
+                a FileMakerSnapshot.
             verbose: If True, a verbose SQLAlchemy Engine will be created
+            username: The username for the FileMaker DB (prompted for if not given)
+            password: The password for the FileMaker DB (prompted for if not given)
 
         Raises:
             ValueError: Connecting to the SQL DB failed
             RuntimeError: Authenticating to the FileMaker DB failed
         """
         try:
-            self.engine = create_engine(connection_str, echo=verbose)
+            self.engine = create_engine(
+                connection_str, echo=verbose, **get_engine_kwargs(connection_str)
+            )
             self.meta = MetaData()
             self.meta.reflect(bind=self.engine)
+            if self.engine.dialect.name == "sqlite":
+                self.__write_lock = threading.Lock()
         except Exception as exc:
             errmsg = (
                 "ERROR: failed to connect to sql database "
@@ -132,21 +177,29 @@ class FileMakerToSQL:
             )
             self.__log_and_raise_exception(ValueError, errmsg, raise_from=exc)
         self.fm_ip_address = filemaker_ip
-        if not self.fm_ip_address.startswith("https://"):
+        if self.fm_ip_address is None:
+            return
+        if not self.fm_ip_address.startswith(("https://", "http://")):
             self.fm_ip_address = f"https://{self.fm_ip_address}"
-        self.fm_uname = input("Please enter your JHED username: ").rstrip()
-        self.fm_pword = getpass.getpass(
-            f"Please enter the JHED password for {self.fm_uname}: "
-        )
+        if username is None:
+            username = input("Please enter your JHED username: ").rstrip()
+        self.fm_uname = username
+        if password is None:
+            password = getpass.getpass(
+                f"Please enter the JHED password for {self.fm_uname}: "
+            )
+        self.fm_pword = password
         test_server = self.__get_filemaker_server(list(self.fm_layout_map.keys())[0])
         test_server.logout()
 
     def drop_tables(self):
-        "If any of the tables we're about to create exist already, drop them"
+        """If any of the tables we're about to create exist already, drop them (along
+        with the bookkeeping table used for incremental syncs)
+        """
         tables_to_drop = [
             self.meta.tables[tname]
             for tname in self.meta.tables
-            if tname in self.sql_db_table_names
+            if tname in self.sql_db_table_names + [self.SYNC_TABLE_NAME]
         ]
         if len(tables_to_drop) > 0:
             self.logger.warning(
@@ -157,58 +210,153 @@ class FileMakerToSQL:
         self.meta = MetaData()
         self.meta.reflect(bind=self.engine)
 
-    def convert(self):
+    def convert(
+        self,
+        page_size=DEF_PAGE_SIZE,
+        n_threads=DEF_N_THREADS,
+        chunk_size=DEF_CHUNK_SIZE,
+        snapshot=None,
+    ):
         """Dynamically creates tables and rows in them for every entry in each layout of
         the FileMaker DB
 
+        Records are fetched in pages of page_size records, using a pool of n_threads
+        threads shared by every page of every layout. Each layout's table is added by
+        another pool of n_threads threads as soon as all of its pages have arrived and
+        the tables its foreign keys refer to have been added (see
+        get_layout_dependencies), so independent layouts are added at the same time.
+
+        If a snapshot is given, layouts are read from it instead of FileMaker unless
+        they're missing from it, expired, or have a different number of records in
+        FileMaker (see FileMakerSnapshot), and any layouts fetched from FileMaker are
+        stored in it. Without a FileMaker connection every layout is read from the
+        snapshot.
+
+        Args:
+            page_size: The number of records to fetch from FileMaker in each request
+            n_threads: The maximum number of requests to FileMaker to make at once
+            chunk_size: The maximum number of rows to send to the SQL DB at once
+            snapshot: A FileMakerSnapshot of the layouts to use and update
+
+        Raises:
+            RuntimeError: Something went wrong when trying to add entries to a table,
+                or a layout isn't available from either FileMaker or the snapshot
+        """
+        self.__column_python_types = {}
+        self.__chunk_size = chunk_size
+        self.__snapshot = snapshot
+        self.__fetched_layouts = set()
+        self.__reuse_unchanged_layouts = True
+        _ = self.__get_sync_table()
+        try:
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                page_futures = self.__submit_page_fetches(executor, page_size)
+                self.__load_layouts(page_futures, self.__add_layout, n_threads)
+        finally:
+            self.__logout_filemaker_servers()
+        self.logger.info("Done!")
+
+    def sync(
+        self,
+        page_size=DEF_PAGE_SIZE,
+        n_threads=DEF_N_THREADS,
+        chunk_size=DEF_CHUNK_SIZE,
+        snapshot=None,
+    ):
+        """Add new records and update modified records in the tables for every layout
+        of the FileMaker DB, without dropping any tables
+
+        The recordId and modId of every record written to the SQL DB are kept in a
+        bookkeeping table. Each sync compares them to the records currently in
+        FileMaker, and only converts and writes the records that are new or whose
+        modId has changed (matching rows to update by their recordid column). Tables
+        for layouts that don't have one yet are created as in convert, and layouts
+        are synced in the same dependency order as in convert. Records that
+        have been deleted from FileMaker are logged, but their rows are left in place
+        so rows that refer to them don't break.
+
+        A snapshot can't show which records have been edited (their number doesn't
+        change), so with a FileMaker connection every layout is fetched again and
+        stored in the snapshot. Without one every layout is read from the snapshot.
+
+        Args:
+            page_size: The number of records to fetch from FileMaker in each request
+            n_threads: The maximum number of requests to FileMaker to make at once
+            chunk_size: The maximum number of rows to send to the SQL DB at once
+            snapshot: A FileMakerSnapshot of the layouts to use and update
+
         Raises:
-            RuntimeError: Something went wrong when trying to add entries to a table
+            RuntimeError: Something went wrong when trying to write entries to a table,
+                or a layout isn't available from either FileMaker or the snapshot
         """
+        self.__column_python_types = {}
+        self.__chunk_size = chunk_size
+        self.__snapshot = snapshot
+        self.__fetched_layouts = set()
+        self.__reuse_unchanged_layouts = False
+        _ = self.__get_sync_table()
+        try:
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                page_futures = self.__submit_page_fetches(executor, page_size)
+                self.__load_layouts(page_futures, self.__sync_layout, n_threads)
+        finally:
+            self.__logout_filemaker_servers()
+        self.logger.info("Done!")
+
+    def get_layout_dependencies(self):
+        """Return a dictionary of the set of other layouts whose tables each layout's
+        table refers to with foreign keys (from the "fk-" custom column annotations)
+
+        Raises:
+            RuntimeError: a foreign key refers to a table that isn't made from a layout
+                and doesn't exist in the SQL DB yet, or the dependencies are circular
+        """
+        layouts_by_table = {
+            map_dict["sql_table_name"]: layout
+            for layout, map_dict in self.fm_layout_map.items()
+        }
+        dependencies = {}
         for layout, map_dict in self.fm_layout_map.items():
-            self.logger.info('Adding entries from the "%s" FileMaker Layout', layout)
-            tablename = map_dict["sql_table_name"]
-            fms = self.__get_filemaker_server(layout_name=layout)
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                records_df = (fms.get_records(limit=100000)).to_df()
-            if records_df.shape[0] < 1:
-                warnmsg = (
-                    f"WARNING: found {records_df.shape[0]} records in the "
-                    f'"{layout}" layout! The "{tablename}" table will not be added.'
-                )
-                self.logger.warning(warnmsg)
-                continue
-            columns = self.__get_columns_from_fm_records(records_df, layout)
-            new_table = Table(
-                tablename,
-                self.meta,
-                *columns,
-            )
-            self.meta.create_all(bind=self.engine, tables=[new_table])
-            entry_sets = self.__get_entry_sets_from_fm_records(records_df, layout)
-            n_new_entries = 0
-            try:
-                with self.engine.connect() as conn:
-                    for entry_list in entry_sets.values():
-                        # if tablename == "launch_package":
-                        #     for entry in entry_list:
-                        #         n_new_entries += 1
-                        #         _ = conn.execute(insert(new_table), [entry])
-                        #         conn.commit()
-                        # else:
-                        n_new_entries += len(entry_list)
-                        _ = conn.execute(insert(new_table), entry_list)
-                    conn.commit()
-            except Exception as exc:
+            referred_tables = [
+                col_unique.split("-")[-1].split(".")[0]
+                for col_uniques in map_dict["custom_columns"].values()
+                for col_unique in col_uniques
+                if col_unique.startswith("fk")
+            ]
+            # the experiment layout also links to the metadata_links table
+            if layout == "Experiment":
+                referred_tables.append("metadata_links")
+            dependencies[layout] = set()
+            for tablename in referred_tables:
+                if tablename in layouts_by_table:
+                    if layouts_by_table[tablename] != layout:
+                        dependencies[layout].add(layouts_by_table[tablename])
+                elif tablename not in self.meta.tables:
+                    self.__log_and_raise_exception(
+                        RuntimeError,
+                        (
+                            f'ERROR: the table for the "{layout}" layout refers to '
+                            f"the {tablename} table, which doesn't exist!"
+                        ),
+                    )
+        # make sure there aren't any cycles
+        added = set()
+        while len(added) < len(dependencies):
+            ready = [
+                layout
+                for layout, parents in dependencies.items()
+                if layout not in added and parents <= added
+            ]
+            if len(ready) < 1:
                 self.__log_and_raise_exception(
                     RuntimeError,
-                    f"ERROR: failed adding entries to the {tablename} table!",
-                    raise_from=exc,
+                    (
+                        "ERROR: circular foreign key references between layouts "
+                        f"{', '.join(sorted(set(dependencies) - added))}"
+                    ),
                 )
-            self.logger.debug(
-                "Added %s entries to the %s table", n_new_entries, tablename
-            )
-        self.logger.info("Done!")
+            added.update(ready)
+        return dependencies
 
     @classmethod
     def get_command_line_options(cls, args=None):
@@ -226,13 +374,71 @@ class FileMakerToSQL:
         )
         parser.add_argument(
             "filemaker_ip",
-            help="The IP address from which the FileMaker Database can be reached",
+            nargs="?",
+            help=(
+                "The IP address from which the FileMaker Database can be reached "
+                "(leave out to convert only from the --snapshot_dir snapshot)"
+            ),
         )
         parser.add_argument(
             "--verbose",
             action="store_true",
             help="Add this flag to use a verbose SQLAlchemy engine",
         )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help=(
+                "Add this flag to only add new records and update modified records in "
+                "existing tables, instead of dropping and re-creating every table"
+            ),
+        )
+        parser.add_argument(
+            "--page_size",
+            type=int,
+            default=cls.DEF_PAGE_SIZE,
+            help=(
+                "The number of records to get from FileMaker in each request "
+                f"(default = {cls.DEF_PAGE_SIZE})"
+            ),
+        )
+        parser.add_argument(
+            "--chunk_size",
+            type=int,
+            default=DEF_CHUNK_SIZE,
+            help=(
+                "The maximum number of rows to send to the SQL DB at once "
+                f"(default = {DEF_CHUNK_SIZE})"
+            ),
+        )
+        parser.add_argument(
+            "--n_threads",
+            type=int,
+            default=cls.DEF_N_THREADS,
+            help=(
+                "The maximum number of requests to make to FileMaker at once "
+                f"(default = {cls.DEF_N_THREADS})"
+            ),
+        )
+        parser.add_argument(
+            "--snapshot_dir",
+            type=pathlib.Path,
+            help=(
+                "Path to a directory holding a snapshot of the FileMaker layouts. "
+                "Layouts are read from the snapshot unless they're missing from it or "
+                "out of date, and layouts fetched from FileMaker are saved in it."
+            ),
+        )
+        parser.add_argument(
+            "--snapshot_max_age",
+            type=float,
+            default=FileMakerSnapshot.DEF_MAX_AGE.total_seconds(),
+            help=(
+                "Fetch layouts from FileMaker again if their snapshots are older than "
+                "this many seconds, even if their number of records hasn't changed "
+                f"(default = {FileMakerSnapshot.DEF_MAX_AGE.total_seconds():.0f})"
+            ),
+        )
         parser.add_argument(
             "--logger_stream_level",
             choices=cls.LOGGER_CHOICES,
@@ -314,6 +520,428 @@ class FileMakerToSQL:
             self.__log_and_raise_exception(RuntimeError, errmsg, raise_from=exc)
         return fms
 
+    def __get_thread_filemaker_server(self):
+        """Return the FileMaker Server instance for the current thread, logging a new
+        one in if this thread doesn't have one yet
+        """
+        fms = getattr(self.__thread_local, "fms", None)
+        if fms is None:
+            fms = self.__get_filemaker_server(list(self.fm_layout_map.keys())[0])
+            self.__thread_local.fms = fms
+            with self.__fm_servers_lock:
+                self.__fm_servers.append(fms)
+        return fms
+
+    def __logout_filemaker_servers(self):
+        "Log out every FileMaker Server instance made by the worker threads"
+        with self.__fm_servers_lock:
+            fm_servers = self.__fm_servers
+            self.__fm_servers = []
+        for fms in fm_servers:
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    fms.logout()
+            except Exception:  # pylint: disable=broad-exception-caught
+                self.logger.debug("Failed to log out of a FileMaker session")
+        self.__thread_local = threading.local()
+
+    def __get_records_page(self, layout, offset, page_size):
+        """Return a dataframe of up to page_size records from a layout starting at
+        offset (1-based), and the total number of records in the layout
+        """
+        fms = self.__get_thread_filemaker_server()
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                foundset = fms.get_records(
+                    offset=offset, limit=page_size, request_layout=layout
+                )
+                records_df = foundset.to_df()
+        except FileMakerError:
+            if fms.last_error == self.FM_NO_RECORDS_ERROR_CODE:
+                return pd.DataFrame(), 0
+            raise
+        return records_df, int(foundset.info.get("foundCount", records_df.shape[0]))
+
+    def __submit_page_fetches(self, executor, page_size):
+        """Submit requests for every page of records in every layout to the executor
+
+        The first page of every layout is requested right away, and the rest of each
+        layout's pages are requested once its first page says how many records it has.
+        Layouts that can be read from the snapshot are read (all at once) instead.
+
+        Returns: A dictionary (in layout map order) of lists of futures for the pages
+            of each layout (in record order)
+        """
+        self.__fetched_layouts = set(self.__get_layouts_to_fetch(executor))
+        page_futures = {layout: None for layout in self.fm_layout_map}
+        for layout in self.fm_layout_map:
+            if layout not in self.__fetched_layouts:
+                self.logger.debug(
+                    'Reading the "%s" layout from %s', layout, self.__snapshot
+                )
+                page_futures[layout] = [
+                    executor.submit(self.__read_snapshot_layout, layout)
+                ]
+        first_page_futures = {
+            executor.submit(self.__get_records_page, layout, 1, page_size): layout
+            for layout in self.fm_layout_map
+            if layout in self.__fetched_layouts
+        }
+        for future in as_completed(first_page_futures):
+            layout = first_page_futures[future]
+            try:
+                _, n_records = future.result()
+            except Exception as exc:
+                self.__log_and_raise_exception(
+                    RuntimeError,
+                    f'ERROR: failed to get records from the "{layout}" layout!',
+                    raise_from=exc,
+                )
+            page_futures[layout] = [future] + [
+                executor.submit(self.__get_records_page, layout, offset, page_size)
+                for offset in range(1 + page_size, n_records + 1, page_size)
+            ]
+            self.logger.debug(
+                'Fetching %s records from the "%s" layout in %s pages',
+                n_records,
+                layout,
+                len(page_futures[layout]),
+            )
+        return page_futures
+
+    def __get_layouts_to_fetch(self, executor):
+        """Return a list of the layouts whose records need to be fetched from FileMaker
+        (because there's no snapshot, or they're missing from it or out of date)
+        """
+        if self.__snapshot is None:
+            if self.fm_ip_address is None:
+                self.__log_and_raise_exception(
+                    RuntimeError,
+                    "ERROR: records can't be converted without a FileMaker connection "
+                    "or a snapshot!",
+                )
+            return list(self.fm_layout_map)
+        if self.fm_ip_address is None:
+            missing_layouts = [
+                layout
+                for layout in self.fm_layout_map
+                if layout not in self.__snapshot.layouts
+            ]
+            if len(missing_layouts) > 0:
+                self.__log_and_raise_exception(
+                    RuntimeError,
+                    (
+                        f"ERROR: {self.__snapshot} is missing the "
+                        f"{', '.join(missing_layouts)} layout(s), and there's no "
+                        "FileMaker connection to fetch them from!"
+                    ),
+                )
+            return []
+        if not self.__reuse_unchanged_layouts:
+            return list(self.fm_layout_map)
+        stale_futures = {
+            executor.submit(self.__is_snapshot_stale, layout): layout
+            for layout in self.fm_layout_map
+        }
+        layouts_to_fetch = []
+        for future, layout in stale_futures.items():
+            try:
+                if future.result():
+                    layouts_to_fetch.append(layout)
+            except Exception as exc:
+                self.__log_and_raise_exception(
+                    RuntimeError,
+                    f'ERROR: failed to check the "{layout}" layout for changes!',
+                    raise_from=exc,
+                )
+        return layouts_to_fetch
+
+    def __is_snapshot_stale(self, layout):
+        """Return True if a layout's snapshot is missing or expired, or FileMaker has
+        a different number of records in the layout than the snapshot does
+        """
+        if self.__snapshot.is_expired(layout):
+            return True
+        _, n_records = self.__get_records_page(layout, 1, 1)
+        return n_records != self.__snapshot.get_info(layout)["n_records"]
+
+    def __read_snapshot_layout(self, layout):
+        """Return a dataframe of the records in a layout's snapshot and the number of
+        records in it (like a single page of records from FileMaker)
+        """
+        records_df = self.__snapshot.read(layout)
+        return records_df, records_df.shape[0]
+
+    def __load_layouts(self, page_futures, load_layout, n_threads):
+        """Call load_layout(layout, page_futures[layout]) for every layout using a pool
+        of n_threads threads, starting each layout as soon as every layout it depends
+        on has been loaded
+        """
+        remaining = {
+            layout: set(parents)
+            for layout, parents in self.get_layout_dependencies().items()
+        }
+        running = {}
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            while len(remaining) > 0 or len(running) > 0:
+                ready = [layout for layout, parents in remaining.items() if not parents]
+                for layout in ready:
+                    del remaining[layout]
+                    future = executor.submit(load_layout, layout, page_futures[layout])
+                    running[future] = layout
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    layout = running.pop(future)
+                    # re-raise any errors (tables already being added will finish)
+                    future.result()
+                    for parents in remaining.values():
+                        parents.discard(layout)
+
+    def __add_layout(self, layout, page_futures):
+        "Create the table for a layout once all of its pages of records have arrived"
+        self.__add_table_for_layout(
+            layout, self.__get_layout_records(layout, page_futures)
+        )
+
+    def __sync_layout(self, layout, page_futures):
+        """Sync the records from a layout to its table, creating the table if it
+        doesn't exist yet
+        """
+        records_df = self.__get_layout_records(layout, page_futures)
+        tablename = self.fm_layout_map[layout]["sql_table_name"]
+        if tablename in self.meta.tables:
+            self.__sync_table_for_layout(layout, records_df)
+        else:
+            self.__add_table_for_layout(layout, records_df)
+
+    def __get_layout_records(self, layout, page_futures):
+        """Return a dataframe of all of the records in a layout once the pages of
+        records from the given futures have arrived
+        """
+        page_dfs = []
+        for future in page_futures:
+            try:
+                page_dfs.append(future.result()[0])
+            except Exception as exc:
+                self.__log_and_raise_exception(
+                    RuntimeError,
+                    f'ERROR: failed to get records from the "{layout}" layout!',
+                    raise_from=exc,
+                )
+        records_df = pd.concat(page_dfs, ignore_index=True)
+        if self.__snapshot is not None and layout in self.__fetched_layouts:
+            if self.__snapshot.write(layout, records_df):
+                self.logger.debug(
+                    'Updated the "%s" layout in %s', layout, self.__snapshot
+                )
+        return records_df
+
+    def __add_table_for_layout(self, layout, records_df):
+        "Create the table for a layout and add all of its records to it"
+        self.logger.info('Adding entries from the "%s" FileMaker Layout', layout)
+        tablename = self.fm_layout_map[layout]["sql_table_name"]
+        if records_df.shape[0] < 1:
+            warnmsg = (
+                f"WARNING: found {records_df.shape[0]} records in the "
+                f'"{layout}" layout! The "{tablename}" table will not be added.'
+            )
+            self.logger.warning(warnmsg)
+            return
+        columns = self.__get_columns_from_fm_records(records_df, layout)
+        with self.__meta_lock, self.__write_lock:
+            new_table = Table(
+                tablename,
+                self.meta,
+                *columns,
+            )
+            self.meta.create_all(bind=self.engine, tables=[new_table])
+        sync_table = self.__get_sync_table()
+        entry_sets = self.__get_entry_sets_from_fm_records(records_df, layout)
+        n_new_entries = 0
+        try:
+            with self.__write_lock, self.engine.connect() as conn:
+                for entry_list in entry_sets.values():
+                    n_new_entries += len(entry_list)
+                    bulk_insert(
+                        conn,
+                        new_table,
+                        entry_list,
+                        chunk_size=self.__chunk_size,
+                        logger=self.logger,
+                    )
+                self.__write_watermarks(conn, sync_table, layout, records_df)
+                conn.commit()
+        except Exception as exc:
+            self.__log_and_raise_exception(
+                RuntimeError,
+                f"ERROR: failed adding entries to the {tablename} table!",
+                raise_from=exc,
+            )
+        self.logger.debug("Added %s entries to the %s table", n_new_entries, tablename)
+
+    def __sync_table_for_layout(self, layout, records_df):
+        """Insert the new records and update the modified records from a layout in its
+        existing table
+        """
+        self.logger.info('Syncing entries from the "%s" FileMaker Layout', layout)
+        tablename = self.fm_layout_map[layout]["sql_table_name"]
+        table = self.meta.tables[tablename]
+        sync_table = self.__get_sync_table()
+        with self.engine.connect() as conn:
+            watermarks = dict(
+                conn.execute(
+                    select(sync_table.c.record_id, sync_table.c.mod_id).where(
+                        sync_table.c.layout == layout
+                    )
+                ).all()
+            )
+        if records_df.shape[0] < 1:
+            record_ids = pd.Series([], dtype=int)
+        else:
+            record_ids = records_df["recordId"].astype(int)
+        n_deleted = len(set(watermarks) - set(record_ids))
+        if n_deleted > 0:
+            self.logger.warning(
+                "WARNING: %s records previously added to the %s table are no longer in "
+                'the "%s" layout. Their rows will not be removed.',
+                n_deleted,
+                tablename,
+                layout,
+            )
+        if records_df.shape[0] < 1:
+            return
+        previous_mod_ids = record_ids.map(watermarks)
+        is_new = previous_mod_ids.isna()
+        is_modified = ~is_new & (previous_mod_ids != records_df["modId"].astype(int))
+        changed_df = records_df[is_new | is_modified]
+        if changed_df.shape[0] < 1:
+            self.logger.debug("No new or modified entries for the %s table", tablename)
+            return
+        # infer the column types from every record, not just the changed ones
+        _ = self.__get_column_python_types(records_df, layout)
+        entry_sets = self.__get_entry_sets_from_fm_records(changed_df, layout)
+        column_names = [column.name for column in table.columns]
+        entries = [entry for entry_list in entry_sets.values() for entry in entry_list]
+        new_column_names = {key for entry in entries for key in entry} - set(
+            column_names
+        )
+        if len(new_column_names) > 0:
+            self.logger.warning(
+                "WARNING: the %s table has no columns for %s. Drop and re-create the "
+                "tables to add them.",
+                tablename,
+                ", ".join(sorted(new_column_names)),
+            )
+        rows = [{name: entry.get(name) for name in column_names} for entry in entries]
+        try:
+            with self.__write_lock, self.engine.connect() as conn:
+                existing_record_ids = {
+                    str(record_id)
+                    for record_id in conn.execute(select(table.c.recordid)).scalars()
+                }
+                rows_to_update = [
+                    row for row in rows if str(row["recordid"]) in existing_record_ids
+                ]
+                rows_to_insert = [
+                    row
+                    for row in rows
+                    if str(row["recordid"]) not in existing_record_ids
+                ]
+                if len(rows_to_update) > 0:
+                    # bind parameters are named by index in case column names have
+                    # characters that can't be used in parameter names
+                    stmt = (
+                        update(table)
+                        .where(table.c.recordid == bindparam("old_recordid"))
+                        .values(
+                            {
+                                name: bindparam(f"new_{icol}")
+                                for icol, name in enumerate(column_names)
+                            }
+                        )
+                    )
+                    _ = conn.execute(
+                        stmt,
+                        [
+                            {
+                                "old_recordid": row["recordid"],
+                                **{
+                                    f"new_{icol}": row[name]
+                                    for icol, name in enumerate(column_names)
+                                },
+                            }
+                            for row in rows_to_update
+                        ],
+                    )
+                if len(rows_to_insert) > 0:
+                    bulk_insert(
+                        conn,
+                        table,
+                        rows_to_insert,
+                        chunk_size=self.__chunk_size,
+                        logger=self.logger,
+                    )
+                self.__write_watermarks(conn, sync_table, layout, changed_df)
+                conn.commit()
+        except Exception as exc:
+            self.__log_and_raise_exception(
+                RuntimeError,
+                f"ERROR: failed syncing entries to the {tablename} table!",
+                raise_from=exc,
+            )
+        self.logger.debug(
+            "Added %s and updated %s entries in the %s table",
+            len(rows_to_insert),
+            len(rows_to_update),
+            tablename,
+        )
+
+    def __get_sync_table(self):
+        "Return the bookkeeping table of record watermarks, creating it if necessary"
+        if self.SYNC_TABLE_NAME not in self.meta.tables:
+            sync_table = Table(
+                self.SYNC_TABLE_NAME,
+                self.meta,
+                Column("layout", String(256), primary_key=True),
+                Column("record_id", Integer, primary_key=True, autoincrement=False),
+                Column("mod_id", Integer, nullable=False),
+                Column("synced_at", DateTime, nullable=False),
+            )
+            self.meta.create_all(bind=self.engine, tables=[sync_table])
+        return self.meta.tables[self.SYNC_TABLE_NAME]
+
+    def __write_watermarks(self, conn, sync_table, layout, records_df):
+        """Record the recordId and modId of every record in a dataframe in the
+        bookkeeping table (using an open connection, without committing)
+        """
+        synced_at = datetime.datetime.now()
+        watermarks = [
+            {
+                "layout": layout,
+                "record_id": int(record_id),
+                "mod_id": int(mod_id),
+                "synced_at": synced_at,
+            }
+            for record_id, mod_id in zip(records_df["recordId"], records_df["modId"])
+        ]
+        if len(watermarks) < 1:
+            return
+        _ = conn.execute(
+            delete(sync_table).where(
+                and_(
+                    sync_table.c.layout == bindparam("old_layout"),
+                    sync_table.c.record_id == bindparam("old_record_id"),
+                )
+            ),
+            [
+                {"old_layout": layout, "old_record_id": watermark["record_id"]}
+                for watermark in watermarks
+            ],
+        )
+        bulk_insert(conn, sync_table, watermarks, chunk_size=self.__chunk_size)
+
     def __get_python_type_for_column(self, column_records, layout, column_name):
         """Return the Python type that every entry in a particular column should be cast to
 
@@ -369,9 +997,9 @@ class FileMakerToSQL:
                     col_kwargs["unique"] = True
                 elif col_unique.startswith("fk"):
                     col_extra_args.append(ForeignKey(col_unique.split("-")[-1]))
-            column_python_type = self.__get_python_type_for_column(
-                records[column_name], layout, column_name
-            )
+            column_python_type = self.__get_column_python_types(records, layout)[
+                column_name
+            ]
             column_type = self.TYPE_MAP[column_python_type]
             type_kwargs = {}
             if column_type == String:
@@ -403,6 +1031,23 @@ class FileMakerToSQL:
             )
         return all_columns
 
+    def __get_column_python_types(self, records, layout):
+        """Return a dictionary of the Python type that entries in each column of a
+        layout's records should be cast to
+
+        The types are inferred from the given records the first time this is called
+        for a layout during a conversion, and reused after that (so it should first
+        be called with all of the layout's records).
+        """
+        if layout not in self.__column_python_types:
+            self.__column_python_types[layout] = {
+                column_name: self.__get_python_type_for_column(
+                    records[column_name], layout, column_name
+                )
+                for column_name in records.columns
+            }
+        return self.__column_python_types[layout]
+
     def __get_entry_sets_from_fm_records(self, records, layout):
         """Given a dataframe of FileMaker records and the name of the layout they came from,
         return a dictionary of rows that should be added to the corresponding SQL table.
@@ -411,123 +1056,209 @@ class FileMakerToSQL:
         non-null column values, and the values are lists of dictionaries representing
         new rows to add.
 
+        Values are converted one column at a time: strings are stripped, missing values
+        are masked out, and the rest are cast to the column's Python type. Rows are
+        then grouped by which of their values are not missing.
+
         Args:
-            records: list of FileMaker records from the given layout
+            records: a Pandas dataframe of FileMaker records from the given layout
             layout: the name of the FileMaker layout from which the records were retrieved
 
         Returns: A dictionary of lists of new entries to add
         """
-        entry_sets = {}
-        column_python_types = {
-            column_name: self.__get_python_type_for_column(
-                records[column_name], layout, column_name
+        column_python_types = self.__get_column_python_types(records, layout)
+        custom_columns = self.fm_layout_map[layout]["custom_columns"]
+        values = {}
+        not_null = {}
+        for column_name in records.columns:
+            if "ignore" in custom_columns.get(column_name, []):
+                continue
+            sql_column_name = column_name.lower().replace(" ", "_")
+            column_not_null, column_values = self.__convert_column(
+                records[column_name], column_name, column_python_types[column_name]
             )
-            for column_name in records.columns
-        }
-        for _, row in records.iterrows():
-            entry = {}
-            for column_name in records.columns:
-                val = row[column_name]
-                if isinstance(val, str):
-                    val = val.strip()
-                if val in ("", " ", "N/A", "?"):
-                    continue
-                # some custom adjustments below
-                if (
-                    isinstance(val, str)
-                    and column_name == "PreAmp Output Power"
-                    and "-" in val
-                ):
-                    oldval = val
-                    val = str(
-                        0.5 * (float(val.split("-")[0]) + float(val.split("-")[1]))
-                    )
-                    self.logger.warning(
-                        "Adjusted %s value from %s to %s", column_name, oldval, val
-                    )
-                if column_python_types[column_name] == datetime.datetime:
-                    sqlval = datetime.datetime.strptime(val, "%m/%d/%Y")
-                else:
-                    try:
-                        sqlval = column_python_types[column_name]()
-                    except:
-                        print(f"val = {val}, colname = {column_name}")
-                        raise
-                    sqlval = column_python_types[column_name](val)
-                entry[column_name.lower().replace(" ", "_")] = sqlval
-            # for the experiment layout, add the metadata link FK
-            if layout == "Experiment":
-                metadata_link_id = self.__get_experiment_metadata_link_id(entry)
-                if metadata_link_id is not None:
-                    entry["video_metadata_link_ID"] = metadata_link_id
-            keysetstr = str(set(list(entry.keys())))
-            if keysetstr not in entry_sets:
-                entry_sets[keysetstr] = []
-            entry_sets[keysetstr].append(entry)
+            not_null[sql_column_name] = column_not_null
+            values[sql_column_name] = column_values
+        values_df = pd.DataFrame(values, index=records.index, dtype=object)
+        not_null_df = pd.DataFrame(not_null, index=records.index, dtype=bool)
+        # for the experiment layout, add the metadata link FK
+        if layout == "Experiment":
+            link_ids = self.__get_experiment_metadata_link_ids(values_df, not_null_df)
+            values_df["video_metadata_link_ID"] = pd.Series(
+                link_ids, index=records.index, dtype=object
+            )
+            not_null_df["video_metadata_link_ID"] = values_df[
+                "video_metadata_link_ID"
+            ].notna()
+        # group the rows by the set of columns that aren't null
+        entry_sets = {}
+        if len(values_df.columns) < 1 or values_df.shape[0] < 1:
+            return entry_sets
+        not_null_array = not_null_df.to_numpy()
+        _, group_indices = np.unique(
+            np.packbits(not_null_array, axis=1), axis=0, return_inverse=True
+        )
+        group_indices = group_indices.reshape(-1)
+        # keep the groups in order of their first row
+        _, first_rows = np.unique(group_indices, return_index=True)
+        for igroup in np.argsort(first_rows):
+            group_mask = group_indices == igroup
+            group_columns = values_df.columns[not_null_array[np.argmax(group_mask)]]
+            entries = values_df.loc[group_mask, group_columns].to_dict("records")
+            entry_sets[str(set(group_columns))] = entries
         return entry_sets
 
-    def __get_experiment_metadata_link_id(self, entry):
-        """Given an "Experiment" entry, returns the ID of a metadata_links entry
-        corresponding to the experiment based on its datestamp, camera filename,
-        and experiment day counter
+    def __convert_column(self, column_records, column_name, python_type):
+        """Convert every value in a column of FileMaker records to the value that
+        should go in the SQL DB
+
+        Args:
+            column_records: a single column of a Pandas dataframe of FileMaker records
+            column_name: the name of the column in FileMaker
+            python_type: the Python type the values should be cast to
+
+        Returns: a boolean array that's True where the value isn't missing, and a
+            list of the converted values (None where they're missing)
+
+        Raises:
+            TypeError: the column has values but no type they can be cast to
         """
-        links_table = self.meta.tables["metadata_links"]
-        results_table = self.meta.tables["flyer_analysis_results"]
-        constraints = []
-        if "experiment_day_counter" in entry:
-            constraints.append(
-                links_table.c.experiment_day_counter
-                == int(entry["experiment_day_counter"])
-            )
-        if "camera_filename" in entry:
-            constraints.append(
-                links_table.c.camera_filename == entry["camera_filename"]
-            )
-        if len(constraints) < 1:
-            return None
-        where_clause = None
-        if len(constraints) == 1:
-            where_clause = and_(
-                links_table.c.datestamp == entry["date"], constraints[0]
-            )
-        elif len(constraints) == 2:
-            where_clause = and_(
-                links_table.c.datestamp == entry["date"], or_(*constraints)
+        vals = column_records.astype(object)
+        is_str = vals.map(lambda val: isinstance(val, str)).to_numpy(dtype=bool)
+        if is_str.any():
+            vals[is_str] = vals[is_str].str.strip()
+        not_null = ~vals.isin(self.NULL_VALUES).to_numpy()
+        # some custom adjustments below
+        if column_name == "PreAmp Output Power" and is_str.any():
+            is_range = is_str & not_null
+            is_range[is_range] = vals[is_range].str.contains("-", regex=False)
+            if is_range.any():
+                range_parts = vals[is_range].str.split("-")
+                averages = (
+                    0.5
+                    * (range_parts.str[0].map(float) + range_parts.str[1].map(float))
+                ).map(str)
+                for oldval, val in zip(vals[is_range], averages):
+                    self.logger.warning(
+                        "Adjusted %s value from %s to %s", column_name, oldval, val
+                    )
+                vals[is_range] = averages.to_numpy()
+        converted = np.full(len(vals), None, dtype=object)
+        if not not_null.any():
+            return not_null, converted
+        to_convert = vals[not_null]
+        if python_type == datetime.datetime:
+            # dates repeat a lot, so only parse each distinct one once
+            dates = {
+                val: datetime.datetime.strptime(val, "%m/%d/%Y")
+                for val in pd.unique(to_convert)
+            }
+            converted[not_null] = [dates[val] for val in to_convert]
+        elif python_type in (float, int):
+            converted[not_null] = (
+                to_convert.to_numpy(dtype=object).astype(python_type).tolist()
             )
+        elif python_type == str:
+            converted[not_null] = to_convert.astype(str).tolist()
         else:
             self.__log_and_raise_exception(
-                RuntimeError,
+                TypeError,
                 (
-                    f"Got {len(constraints)} constraints for a query "
-                    "to the metadata_links table (expected either 1 or 2)!"
+                    f'ERROR: could not determine a type for the "{column_name}" column '
+                    f"(values include {to_convert.iloc[0]!r})"
                 ),
             )
-        stmt = select(links_table.c.ID).where(where_clause)
-        with self.engine.connect() as conn:
-            results = conn.execute(stmt).all()
-        if (results is None) or len(results) < 1:
-            return None
-        if len(results) == 1:
-            return results[0].ID
-        max_results = -1
-        best_link_id = None
-        for res in results:
-            stmt = (
-                select(func.count())  # pylint: disable=not-callable
-                .select_from(
-                    results_table.join(
-                        links_table,
-                        results_table.c.metadata_link_ID == links_table.c.ID,
-                    )
+        return not_null, converted
+
+    def __get_experiment_metadata_link_ids(self, values_df, not_null_df):
+        """Given dataframes of converted "Experiment" values and where they're not
+        null, return a list of the ID of the metadata_links entry corresponding to
+        each experiment based on its datestamp, camera filename, and experiment day
+        counter (None where there isn't one)
+
+        A link matches if it has the experiment's datestamp and either its experiment
+        day counter or its camera filename. If more than one link matches, the one
+        with the most linked flyer analysis results is used (the first by ID in case
+        of a tie). Every candidate link is found with one query.
+        """
+        columns = {}
+        for column_name in ("date", "experiment_day_counter", "camera_filename"):
+            if column_name in values_df.columns:
+                columns[column_name] = values_df[column_name].where(
+                    not_null_df[column_name], None
                 )
-                .where(results_table.c.metadata_link_ID == res.ID)
+            else:
+                columns[column_name] = pd.Series(
+                    None, index=values_df.index, dtype=object
+                )
+        dates = columns["date"].dropna()
+        if len(dates) < 1:
+            return [None] * values_df.shape[0]
+        links_by_counter, links_by_camera = self.__get_metadata_link_index(
+            min(dates), max(dates)
+        )
+        link_ids = []
+        for date, counter, camera_filename in zip(
+            columns["date"],
+            columns["experiment_day_counter"],
+            columns["camera_filename"],
+        ):
+            candidates = {}
+            if date is not None:
+                if counter is not None:
+                    candidates.update(links_by_counter.get((date, int(counter)), {}))
+                if camera_filename is not None:
+                    candidates.update(links_by_camera.get((date, camera_filename), {}))
+            if len(candidates) < 1:
+                link_ids.append(None)
+            else:
+                link_ids.append(max(sorted(candidates), key=candidates.get))
+        return link_ids
+
+    def __get_metadata_link_index(self, min_date, max_date):
+        """Return dictionaries of the metadata_links entries with datestamps between
+        two dates, keyed by (datestamp, experiment day counter) and by (datestamp,
+        camera filename). Each value is a dictionary of the number of linked flyer
+        analysis results keyed by link ID.
+        """
+        links_table = self.meta.tables["metadata_links"]
+        results_table = self.meta.tables["flyer_analysis_results"]
+        stmt = (
+            select(
+                links_table.c.ID,
+                links_table.c.datestamp,
+                links_table.c.experiment_day_counter,
+                links_table.c.camera_filename,
+                func.count(results_table.c.ID),  # pylint: disable=not-callable
+            )
+            .select_from(
+                links_table.outerjoin(
+                    results_table,
+                    results_table.c.metadata_link_ID == links_table.c.ID,
+                )
+            )
+            .where(links_table.c.datestamp.between(min_date, max_date))
+            .group_by(
+                links_table.c.ID,
+                links_table.c.datestamp,
+                links_table.c.experiment_day_counter,
+                links_table.c.camera_filename,
             )
-            with self.engine.connect() as conn:
-                n_linked_results = conn.execute(stmt).all()[0][0]
-            if n_linked_results > max_results:
-                max_results = n_linked_results
-                best_link_id = res.ID
-        return best_link_id
+        )
+        with self.engine.connect() as conn:
+            rows = conn.execute(stmt).all()
+        links_by_counter = {}
+        links_by_camera = {}
+        for link_id, datestamp, counter, camera_filename, n_results in rows:
+            if counter is not None:
+                links_by_counter.setdefault((datestamp, counter), {})[
+                    link_id
+                ] = n_results
+            if camera_filename is not None:
+                links_by_camera.setdefault((datestamp, camera_filename), {})[
+                    link_id
+                ] = n_results
+        return links_by_counter, links_by_camera
 
 
 def main(args=None):
@@ -535,6 +1266,10 @@ def main(args=None):
     the given FileMaker DB to entries in tables in the SQL DB
     """
     options = FileMakerToSQL.get_command_line_options(args)
+    if options.filemaker_ip is None and options.snapshot_dir is None:
+        raise ValueError(
+            "ERROR: a FileMaker IP address and/or a --snapshot_dir must be given!"
+        )
     sql_converter = FileMakerToSQL(
         options.logger_stream_level,
         options.logger_file_level,
@@ -545,8 +1280,20 @@ def main(args=None):
         options.filemaker_ip,
         verbose=options.verbose,
     )
-    sql_converter.drop_tables()
-    sql_converter.convert()
+    conversion_kwargs = {
+        "page_size": options.page_size,
+        "n_threads": options.n_threads,
+        "chunk_size": options.chunk_size,
+    }
+    if options.snapshot_dir is not None:
+        conversion_kwargs["snapshot"] = FileMakerSnapshot(
+            options.snapshot_dir, max_age=options.snapshot_max_age
+        )
+    if options.incremental:
+        sql_converter.sync(**conversion_kwargs)
+    else:
+        sql_converter.drop_tables()
+        sql_converter.convert(**conversion_kwargs)
 
 
 if __name__ == "__main__":
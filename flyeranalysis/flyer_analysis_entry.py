@@ -15,10 +15,10 @@ class FlyerAnalysisEntry(ORMBase):
 
     ID = mapped_column(Integer, primary_key=True)
     metadata_link_ID = mapped_column(
-        ForeignKey(f"{MetadataLinkEntry.__tablename__}.ID")
+        ForeignKey(f"{MetadataLinkEntry.__tablename__}.ID"), index=True
     )
     rel_filepath = mapped_column(String(896), unique=True, nullable=False)
-    exit_code = mapped_column(SmallInteger, nullable=False)
+    exit_code = mapped_column(SmallInteger, nullable=False, index=True)
     radius = mapped_column(Float)
     tilt = mapped_column(Float)
     leading_row = mapped_column(SmallInteger)
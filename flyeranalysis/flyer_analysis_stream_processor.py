@@ -3,21 +3,32 @@
 Typical usage:
     FlyerAnalysisStreamProcessor --db_connection_str [connection_string] --topic_name [topic]
 """
+
 # imports
+import time
 import datetime
+import pathlib
 import threading
-from io import BytesIO
-import numpy as np
-import pandas as pd
-from PIL import Image
 from sqlalchemy import create_engine, inspect, select, and_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker, scoped_session
 from openmsistream import DataFileStreamProcessor
 from .orm_base import ORMBase
 from .metadata_link_entry import MetadataLinkEntry
 from .flyer_analysis_entry import FlyerAnalysisEntry
 from .flyer_image_entry import FlyerImageEntry
-from .flyer_detection import Flyer_Detection, FlyerCharacteristics
+from .video_summary_entry import VideoSummaryEntry, VideoExitCodeCountEntry
+from .video_summaries import (
+    create_video_summary_rows,
+    add_result_to_video_summary,
+    rebuild_video_summaries,
+)
+from .flyer_detection_core import FlyerDetectionCore, STREAM_ANALYSIS_KWARGS
+from .analysis_cache import AnalysisCache
+from .image_store import get_image_store
+from .bulk_insert import get_engine_kwargs
+from .sampling_profiler import SamplingProfiler
+from .stream_metrics import StreamProcessorMetrics, MetricsExporter, TimedLock
 
 
 class FlyerAnalysisStreamProcessor(DataFileStreamProcessor):
@@ -26,7 +37,8 @@ class FlyerAnalysisStreamProcessor(DataFileStreamProcessor):
     and add their results to an output file or database
 
     The original .bmp image and the analysis result image will be
-    stored in a secondary table if output is going to a DB
+    stored in a secondary table if output is going to a DB, and each result is
+    added to the summary of its video (see video_summaries.py)
     """
 
     # All the Table objects associated with the DB
@@ -34,6 +46,8 @@ class FlyerAnalysisStreamProcessor(DataFileStreamProcessor):
         FlyerAnalysisEntry.__table__,
         FlyerImageEntry.__table__,
         MetadataLinkEntry.__table__,
+        VideoSummaryEntry.__table__,
+        VideoExitCodeCountEntry.__table__,
     ]
 
     def __init__(
@@ -44,9 +58,49 @@ class FlyerAnalysisStreamProcessor(DataFileStreamProcessor):
         db_connection_str=None,
         drop_existing=False,
         verbose=False,
+        analysis_cache_dir=None,
+        analysis_cache_max_gb=AnalysisCache.DEF_MAX_BYTES / 1024**3,
+        image_store=None,
+        metrics_port=None,
+        metrics_file=None,
+        metrics_interval=10,
+        profile=False,
+        profile_every_n=None,
+        profile_seconds=None,
         **other_kwargs,
     ):
         super().__init__(config_file, topic_name, **other_kwargs)
+        # optionally profile a sample of the frames processed
+        self._profiler = None
+        if profile:
+            self._profiler = SamplingProfiler(
+                self._output_dir / "profile",
+                every_n_frames=profile_every_n,
+                first_n_seconds=profile_seconds,
+            )
+        # collect live metrics, optionally serving them over HTTP and/or writing them
+        # to a file periodically
+        self._metrics = StreamProcessorMetrics(
+            get_n_files_in_progress=lambda: len(self.files_in_progress_by_path)
+        )
+        self._first_message_times = {}
+        self._metrics_exporter = None
+        if metrics_port is not None or metrics_file is not None:
+            self._metrics_exporter = MetricsExporter(
+                self._metrics,
+                port=metrics_port,
+                filepath=metrics_file,
+                interval_secs=metrics_interval,
+            )
+            self._metrics_exporter.start()
+        # optionally keep images outside of the DB (only references go in the table)
+        self._image_store = get_image_store(image_store)
+        # optionally use an on-disk cache of analysis results
+        self._analysis_cache = None
+        if analysis_cache_dir is not None:
+            self._analysis_cache = AnalysisCache(
+                analysis_cache_dir, max_bytes=int(analysis_cache_max_gb * 1024**3)
+            )
         # either create an engine to interact with a DB or store the path to the output file
         self._engine = None
         self._output_file = None
@@ -54,7 +108,7 @@ class FlyerAnalysisStreamProcessor(DataFileStreamProcessor):
         if db_connection_str is not None:
             # if a connection string was given, connect to the DB
             try:
-                extra_kwargs = {}
+                extra_kwargs = get_engine_kwargs(db_connection_str)
                 if db_connection_str.startswith("mssql"):
                     extra_kwargs["deprecate_large_types"] = True
                 self._engine = create_engine(
@@ -62,6 +116,8 @@ class FlyerAnalysisStreamProcessor(DataFileStreamProcessor):
                 )
                 self._scoped_session = scoped_session(sessionmaker(bind=self._engine))
                 self._sessions_by_thread_ident = {}
+                # (metadata link ID, exit code) pairs known to have summary rows
+                self._video_summary_keys = set()
             except Exception as exc:
                 errmsg = (
                     "ERROR: failed to connect to database using connection string "
@@ -75,14 +131,44 @@ class FlyerAnalysisStreamProcessor(DataFileStreamProcessor):
                 self.__create_tables()
             # create tables in the DB if any of them haven't been created yet
             inspector = inspect(self._engine)
+            has_summaries = inspector.has_table(VideoSummaryEntry.__tablename__)
             for table_name in [table.name for table in self.ALL_TABLES]:
                 if not inspector.has_table(table_name):
                     self.__create_tables()
                     break
+            self.__add_missing_columns()
+            self.__create_missing_indexes()
+            # summarize any results from before the summary tables were added
+            if not has_summaries:
+                with self._engine.begin() as conn:
+                    n_summaries = rebuild_video_summaries(conn)
+                if n_summaries > 0:
+                    self.logger.info(f"Summarized results for {n_summaries} videos")
         else:
             # if no connection string was given, set the path to the single output file
             self._output_file = self._output_dir / f"{analysis_table_name}.csv"
 
+    def _process_message(self, lock, msg, rootdir_to_set=None):
+        """
+        Record when the first message for each file is received (for the end-to-end
+        latency metric) before processing the message as usual
+        """
+        try:
+            dfc = msg.value()  # from a regular Kafka Consumer
+        except TypeError:
+            dfc = msg.value  # from KafkaCrypto
+        relative_filepath = getattr(dfc, "relative_filepath", None)
+        if relative_filepath is not None:
+            self._first_message_times.setdefault(relative_filepath, time.monotonic())
+        retval = super()._process_message(lock, msg, rootdir_to_set)
+        # stop tracking files once they're no longer in progress
+        if (
+            relative_filepath is not None
+            and relative_filepath not in self.files_in_progress_by_path
+        ):
+            self._first_message_times.pop(relative_filepath, None)
+        return retval
+
     def _process_downloaded_data_file(self, datafile, lock):
         """
         Run the flyer analysis on the downloaded data file
@@ -91,41 +177,67 @@ class FlyerAnalysisStreamProcessor(DataFileStreamProcessor):
         """
         if not datafile.filename.endswith(".bmp"):
             return None
+        if self._profiler is not None:
+            return self._profiler.profile_frame(
+                self.__analyze_and_write_frame, datafile, lock
+            )
+        return self.__analyze_and_write_frame(datafile, lock)
+
+    def __analyze_and_write_frame(self, datafile, lock):
+        """
+        Analyze a downloaded .bmp file and write its result to the output file or DB
+
+        returns None if processing was successful, an Exception otherwise
+        """
+        lock = TimedLock(lock, self._metrics)
         try:
             # first, if we're writing to a DB, check if the relative filepath
             # has already been written
-            if self._engine is not None and self.__entry_exists(datafile, lock):
-                return None
-            result = None
-            analyzer = Flyer_Detection()
-            img = np.asarray(Image.open(BytesIO(datafile.bytestring)))
+            if self._engine is not None:
+                start = time.perf_counter()
+                entry_exists = self.__entry_exists(datafile, lock)
+                self._metrics.observe("dedup_check", time.perf_counter() - start)
+                if entry_exists:
+                    self._metrics.record_dedup_skip()
+                    return None
+            analyzer = FlyerDetectionCore(cache=self._analysis_cache)
             # filtering the image sometimes fails, use a special exit code in this case
-            try:
-                filtered_image = analyzer.filter_image(img)
-            except Exception:
-                result = FlyerCharacteristics()
-                result.rel_filepath = datafile.relative_filepath
-                result.exit_code = 8
-            if not result:
-                result = analyzer.radius_from_lslm(
-                    filtered_image,
-                    datafile.relative_filepath,
-                    self._output_dir,
-                    min_radius=0,
-                    max_radius=np.inf,
-                    save_output_file=False,
-                )
+            start = time.perf_counter()
+            result, _ = analyzer.analyze_frame(
+                datafile.relative_filepath,
+                self._output_dir,
+                frame_bytes=datafile.bytestring,
+                **STREAM_ANALYSIS_KWARGS,
+            )
+            self._metrics.observe("analysis", time.perf_counter() - start)
+            start = time.perf_counter()
             if self._output_file is not None:
                 self.__write_result_to_csv(result, lock)
             elif self._engine is not None:
                 self.__write_result_to_db(result, datafile.bytestring, lock)
+            self._metrics.observe("output_write", time.perf_counter() - start)
+            first_message_time = self._first_message_times.get(
+                datafile.relative_filepath
+            )
+            if first_message_time is not None:
+                self._metrics.observe(
+                    "end_to_end_latency", time.monotonic() - first_message_time
+                )
+            self._metrics.record_frame(result.exit_code)
         except Exception as exc:
+            self._metrics.record_error()
             return exc
         return None
 
     def _on_shutdown(self):
         super()._on_shutdown()
-        self._engine.dispose()
+        if self._metrics_exporter is not None:
+            self._metrics_exporter.stop()
+        if self._profiler is not None:
+            for filepath in self._profiler.close():
+                self.logger.info(f"Wrote profile output to {filepath}")
+        if self._engine is not None:
+            self._engine.dispose()
 
     def __drop_existing_tables(self):
         """
@@ -139,11 +251,35 @@ class FlyerAnalysisStreamProcessor(DataFileStreamProcessor):
         """
         ORMBase.metadata.create_all(bind=self._engine, tables=self.ALL_TABLES)
 
+    def __add_missing_columns(self):
+        """
+        Add any columns to the flyer images table that don't exist yet (for tables
+        that were created before the image store columns were added)
+        """
+        added = FlyerImageEntry.add_missing_columns(self._engine)
+        if len(added) > 0:
+            self.logger.info(
+                f"Added columns {', '.join(added)} to the "
+                f"{FlyerImageEntry.__tablename__} table"
+            )
+
+    def __create_missing_indexes(self):
+        """
+        Create any indexes on the tables that don't exist yet (for tables that were
+        created before the indexes were added)
+        """
+        for table in self.ALL_TABLES:
+            for index in table.indexes:
+                index.create(bind=self._engine, checkfirst=True)
+
     def __write_result_to_csv(self, result, lock):
         """
         Write a given result to the output CSV file
         """
-        data = vars(result)
+        # (imported here since pandas is slow to import)
+        import pandas as pd  # pylint: disable=import-outside-toplevel
+
+        data = result.as_dict()
         data_frame = pd.DataFrame([data])
         with lock:
             if self._output_file.is_file():
@@ -206,6 +342,23 @@ class FlyerAnalysisStreamProcessor(DataFileStreamProcessor):
             session.commit()
             return new_entry.ID
 
+    def __create_video_summary_rows(self, metadata_link_id, exit_code, lock):
+        """
+        Make sure the summary rows that a result with the given metadata link ID and
+        exit code will be added to exist
+        """
+        key = (metadata_link_id, exit_code)
+        if key in self._video_summary_keys:
+            return
+        with lock:
+            try:
+                with self._engine.begin() as conn:
+                    create_video_summary_rows(conn, metadata_link_id, exit_code)
+            except IntegrityError:
+                # another process added the rows first
+                pass
+            self._video_summary_keys.add(key)
+
     def __write_result_to_db(self, result, img_bytestring, lock):
         """
         Write a given result to the output database
@@ -219,13 +372,20 @@ class FlyerAnalysisStreamProcessor(DataFileStreamProcessor):
         metadata_link_id = self.__get_metadata_link_id(
             result, lock, self._sessions_by_thread_ident[thread_id]
         )
-        # add the analysis result entry
+        # add the analysis result entry, and add it to its video's summary
         analysis_entry = FlyerAnalysisEntry.from_id_and_result(metadata_link_id, result)
+        if metadata_link_id is not None:
+            self.__create_video_summary_rows(
+                metadata_link_id, analysis_entry.exit_code, lock
+            )
         self._sessions_by_thread_ident[thread_id].add(analysis_entry)
+        add_result_to_video_summary(
+            self._sessions_by_thread_ident[thread_id], analysis_entry
+        )
         self._sessions_by_thread_ident[thread_id].commit()
         # add the image entry
         image_entry = FlyerImageEntry.from_id_img_and_result(
-            analysis_entry.ID, img_bytestring, result
+            analysis_entry.ID, img_bytestring, result, image_store=self._image_store
         )
         self._sessions_by_thread_ident[thread_id].add(image_entry)
         self._sessions_by_thread_ident[thread_id].commit()
@@ -253,6 +413,83 @@ class FlyerAnalysisStreamProcessor(DataFileStreamProcessor):
                 "tables in the database on startup"
             ),
         )
+        parser.add_argument(
+            "--analysis_cache_dir",
+            type=pathlib.Path,
+            help=(
+                "Path to a directory to use as an on-disk cache of analysis results. "
+                "Frames whose contents have already been analyzed with the same "
+                "parameters will not be analyzed again. No cache is used if this "
+                "argument is not given."
+            ),
+        )
+        parser.add_argument(
+            "--analysis_cache_max_gb",
+            type=float,
+            default=AnalysisCache.DEF_MAX_BYTES / 1024**3,
+            help=(
+                "The maximum size of the analysis result cache in GB. The least "
+                "recently used results are removed when the cache grows larger."
+            ),
+        )
+        parser.add_argument(
+            "--image_store",
+            help=(
+                "Where to keep camera and analysis images instead of storing them "
+                "inline in the database: a path to a local/shared directory, or an "
+                '"s3://bucket/prefix" URL. The database will only hold the keys, sizes, '
+                "and checksums of the images."
+            ),
+        )
+        parser.add_argument(
+            "--metrics_port",
+            type=int,
+            help=(
+                "Serve live metrics (throughput, latency, time spent analyzing, "
+                "writing, and waiting for locks, exit codes, etc.) in the Prometheus "
+                "text format at http://localhost:[metrics_port]/metrics"
+            ),
+        )
+        parser.add_argument(
+            "--metrics_file",
+            type=pathlib.Path,
+            help=(
+                "Path to a file that should be rewritten with the live metrics (in the "
+                "Prometheus text format) every --metrics_interval seconds"
+            ),
+        )
+        parser.add_argument(
+            "--metrics_interval",
+            type=float,
+            default=10,
+            help="How often (in seconds) to rewrite the --metrics_file (default = 10)",
+        )
+        parser.add_argument(
+            "--profile",
+            action="store_true",
+            help=(
+                "Add this flag to profile a sample of the frames processed (across "
+                "all threads) and write the merged profile statistics and collapsed "
+                "call stacks to a 'profile' directory in the output directory on "
+                "shutdown"
+            ),
+        )
+        parser.add_argument(
+            "--profile_every_n",
+            type=int,
+            help=(
+                "Profile every Nth frame "
+                f"(default = {SamplingProfiler.DEF_EVERY_N_FRAMES})"
+            ),
+        )
+        parser.add_argument(
+            "--profile_seconds",
+            type=float,
+            help=(
+                "Profile every frame during the first N seconds instead of every Nth "
+                "frame"
+            ),
+        )
         parser.add_argument(
             "--verbose",
             "-v",
@@ -267,6 +504,15 @@ class FlyerAnalysisStreamProcessor(DataFileStreamProcessor):
             db_connection_str=args.db_connection_str,
             drop_existing=args.drop_existing,
             verbose=args.verbose,
+            analysis_cache_dir=args.analysis_cache_dir,
+            analysis_cache_max_gb=args.analysis_cache_max_gb,
+            image_store=args.image_store,
+            metrics_port=args.metrics_port,
+            metrics_file=args.metrics_file,
+            metrics_interval=args.metrics_interval,
+            profile=args.profile,
+            profile_every_n=args.profile_every_n,
+            profile_seconds=args.profile_seconds,
             output_dir=args.output_dir,
             filepath_regex=args.download_regex,
             n_threads=args.n_threads,
@@ -311,6 +557,12 @@ class FlyerAnalysisStreamProcessor(DataFileStreamProcessor):
         for fn in proc_filepaths:
             msg += f"\n\t{fn}"
         flyer_analysis.logger.info(msg)
+        if flyer_analysis._analysis_cache is not None:
+            flyer_analysis.logger.info(
+                f"Analysis cache in {args.analysis_cache_dir}: "
+                f"{flyer_analysis._analysis_cache.n_hits} hits, "
+                f"{flyer_analysis._analysis_cache.n_misses} misses"
+            )
 
 
 def main(args=None):
@@ -0,0 +1,595 @@
+"""The core of the flyer detection analysis: filtering and fitting single frames
+
+Kept separate from the plotting and file input/output helpers in flyer_detection.py
+(and with no imports of matplotlib, pandas, or imageio) so that processes that only
+analyze frames, like stream processor and backfill workers, start quickly.
+"""
+
+# imports
+import copy
+import time
+from io import BytesIO
+import numpy as np
+import cv2
+from PIL import Image
+from skimage import filters, draw
+
+# Default parameters for the filtering and fitting steps
+DEF_BLUR_KERNEL = 7
+DEF_AREA_CUTOFF = 200
+DEF_ARC_FRACTION = 0.3
+# Settings used when analyzing frames whose results go to the database
+# (every fit is kept, and failures to filter an image get a special exit code)
+STREAM_ANALYSIS_KWARGS = {
+    "min_radius": 0,
+    "max_radius": np.inf,
+    "save_output_file": False,
+    "filter_failure_exit_code": 8,
+}
+
+
+class FlyerCharacteristics:
+    """
+    A class to store the variables present in the 'radius_from_lslm' function
+    Attributes:
+      radius -> Radius of the Flyer
+      center_row -> Row number of the center of the Flyer
+      center_column -> Column number of the center of the Flyer
+      image -> Image of Flyer superimposed with the Least-Squares Circle
+      leading_row -> The leading row of the Flyer
+      flyer_row -> The row numbers containing the values used for the Least-Squares fit
+      flyer_column -> The column numbers containing the values used for the Least-Squares fit
+      n_fit_evaluations -> The number of function evaluations the Least-Squares fit needed
+      exception_type -> The name of the exception that was caught if the analysis failed
+      stage_times -> Seconds spent in each stage of the analysis (only recorded if
+                     telemetry is being collected)
+    """
+
+    __slots__ = (
+        "exit_code",
+        "radius",
+        "center_row",
+        "center_column",
+        "leading_row",
+        "flyer_row",
+        "flyer_column",
+        "rel_filepath",
+        "newimg_loc",
+        "tilt",
+        "analysis_image",
+        "n_fit_evaluations",
+        "exception_type",
+        "stage_times",
+    )
+    # Attributes describing how a result was computed rather than the result itself
+    TELEMETRY_FIELDS = ("n_fit_evaluations", "exception_type", "stage_times")
+
+    def __init__(self):
+        self.exit_code = None
+        self.radius = None
+        self.center_row = None
+        self.center_column = None
+        self.leading_row = None
+        self.flyer_row = None
+        self.flyer_column = None
+        self.rel_filepath = None
+        self.newimg_loc = None
+        self.tilt = None
+        self.analysis_image = None
+        self.n_fit_evaluations = None
+        self.exception_type = None
+        self.stage_times = None
+
+    def as_dict(self, telemetry=False):
+        "Return a dictionary of the result's attributes (including telemetry if True)"
+        return {
+            name: getattr(self, name)
+            for name in self.__slots__
+            if telemetry or name not in self.TELEMETRY_FIELDS
+        }
+
+    def show_image(self):
+        # It is to be noted that the flyer rows and columns will be the y-coordinates and row-coordinates in a graph.
+        import matplotlib.pyplot as plt  # pylint: disable=import-outside-toplevel
+
+        plt.imshow(self.analysis_image)
+        plt.scatter(self.center_column, self.center_row, c="r")
+        plt.scatter(self.flyer_column, self.flyer_row, marker=".", s=[5], c="orange")
+        plt.show()
+
+
+class FlyerDetectionCore:
+    """
+    Filters and fits single frames to find the flyer in them.
+
+    If an AnalysisCache is given, results for frames that have already been analyzed
+    with the same parameters will be read from it instead of being recomputed.
+
+    If an AnalysisTelemetry object is given, the time spent in each stage is recorded
+    on the result of every frame passed to analyze_frame and added to its histograms.
+
+    If an OverlayWriter is given, analysis images are written to files in its pool of
+    background threads instead of in the analysis loop.
+    """
+
+    def __init__(self, cache=None, telemetry=None, overlay_writer=None):
+        self.cache = cache
+        self.telemetry = telemetry
+        self.overlay_writer = overlay_writer
+
+    # Code to filter out ones where the values are null
+    def check_blank_image(self, img):
+        # Finding the non-zero element locations of the image
+        x, y = np.nonzero(img)
+        if x.size > 0 and y.size > 0:
+            return False
+        else:
+            return True
+
+    # Code to check if last row has a value
+    def check_last_row(self, img):
+        """
+        Inputs:
+        img: An array which is essentially the image
+        Outputs:
+        True: If the flyer is touching the bottom most part of the image
+        False: If the flyer is not touching the bottom most part of the image
+        """
+        return np.any(img[img.shape[0] - 1])
+
+    # Code to Find Radius
+    def radius_from_lslm(
+        self,
+        img,
+        im_loc,
+        output_dir,
+        min_radius=50,
+        max_radius=500,
+        save_output_file=True,
+        arc_fraction=DEF_ARC_FRACTION,
+        stage_times=None,
+    ):
+        fc = FlyerCharacteristics()
+        fc.rel_filepath = im_loc
+        fc.stage_times = stage_times
+        try:
+            if self.check_blank_image(img):
+                fc.exit_code = 1
+                return fc
+            img2, temp = _run_stage(
+                stage_times,
+                "edge_selection",
+                self.select_edge_points,
+                img,
+                arc_fraction,
+            )
+            fit = _run_stage(stage_times, "fit", self.fit_circle, temp)
+            _run_stage(
+                stage_times,
+                "fit_result",
+                self.set_fit_result,
+                fc,
+                img2,
+                temp,
+                fit,
+                min_radius,
+                max_radius,
+            )
+            if fc.exit_code is not None:
+                return fc
+            # Putting the new images into a file
+            if save_output_file:
+                _run_stage(
+                    stage_times, "save", self.save_analysis_image, fc, output_dir
+                )
+        except Exception as exc:
+            fc.exit_code = 7
+            fc.exception_type = type(exc).__name__
+            return fc
+        fc.exit_code = 0
+        return fc
+
+    def select_edge_points(self, img, arc_fraction=DEF_ARC_FRACTION):
+        """
+        Select the points on the leading edge of the flyer in a filtered image to use
+        for the circle fit. Returns two images: one with the lowest flyer point in every
+        column ("img2"), and one with only the points in the window around the leading
+        point that covers +/- arc_fraction of the flyer's width ("temp")
+        """
+        # Find the points where the threshold has identified the flyer points
+        x, y = np.where(img == 255)
+        max_x = max(x)
+        # Isolating the points near the lowest one, and keeping the lowest point in each column
+        near_bottom = x >= max_x - 30
+        x, y = x[near_bottom], y[near_bottom]
+        order = np.lexsort((x, y))
+        x, y = x[order], y[order]
+        lowest_in_column = np.append(y[1:] != y[:-1], True)
+        x, y = x[lowest_in_column], y[lowest_in_column]
+        # I then find the lowest x point, and get 60% of the flyer
+        order = x.argsort(kind="quicksort")
+        x, y = x[order], y[order]
+        max_y = np.amax(y)
+        min_y = np.amin(y)
+        t = int(np.ceil((max_y - min_y) * arc_fraction))
+        t1 = y[-1] - t
+        t2 = y[-1] + t
+        # Here, I am making sure to check corner points, and ensure that if +/- 0.3 is more on one side, the difference is transferred to the other side instead
+        if t1 < min_y:
+            if (t1 - min_y + t2) <= max_y:
+                t2 += t1 - min_y
+            else:
+                t2 = max_y
+        if t2 > max_y:
+            if (t1 - (t2 - max_y)) >= min_y:
+                t1 -= t2 - max_y
+            else:
+                t2 = min_y
+        # Finding the slope of the
+        # I'm reconstucting the flyer image here, for better understandability. This will not affect the radius of curvature but will help in drawing the disk!
+        img2 = np.zeros((img.shape[0], img.shape[1]))
+        img2[x, y] = 255
+        d = img2[:, t1:t2]
+        a1 = np.zeros((img.shape[0], t1))
+        a2 = np.zeros((img.shape[0], img.shape[1] - t2))
+        temp = np.concatenate((a1, d, a2), axis=1)
+        return img2, temp
+
+    def fit_circle(self, temp):
+        """
+        Fit a circle to the nonzero points in an image of selected edge points.
+        Returns a tuple of (row indices, column indices, center row, center column,
+        radius, number of function evaluations). The last four are None if there
+        are no points to fit.
+        """
+        x, y = np.nonzero(temp)
+        if len(x) < 1 or len(y) < 1:
+            return x, y, None, None, None, None
+        # Using the Least Squares method with Levenberg-Marquardt Optimization (which is Dampened Least Squares similar to L2 regularization)
+        x_m = np.mean(x)
+        y_m = np.mean(y)
+        # u = x - x_m
+        # v = y - y_m
+        # method_2 = "leastsq"
+
+        # Coope's method can be implemented here to linearize the equation, but I am unsure if that can be used with L-M which is a non-linear method
+        # I have written down the equation in the comments the starting point for Coope's method.
+        # Code for the least squares
+        def calc_R(xc, yc):
+            # 2 Xc X + 2 Yc Y + R² - Xc² - Yc² = X² + Y²
+            return np.sqrt((x - xc) ** 2 + (y - yc) ** 2)
+
+        def f_2(c):
+            Ri = calc_R(*c)
+            return Ri - Ri.mean()
+
+        # Using Scipy's Least Squares Optimization method to find the center of the circle
+        # (imported here since scipy.optimize is slow to import)
+        from scipy import optimize  # pylint: disable=import-outside-toplevel
+
+        center_estimate = x_m, y_m
+        center_2 = optimize.least_squares(f_2, center_estimate, method="lm")
+
+        xc_2, yc_2 = center_2.x
+        # Calculating the radius of the circle
+        Ri_2 = calc_R(*center_2.x)
+        R_2 = Ri_2.mean()
+        return x, y, xc_2, yc_2, R_2, center_2.nfev
+
+    def set_fit_result(
+        self,
+        fc,
+        img2,
+        temp,
+        fit,
+        min_radius=50,
+        max_radius=500,
+        make_analysis_image=True,
+    ):
+        """
+        Set the attributes of a FlyerCharacteristics object from the output of
+        fit_circle. fc.exit_code is set if the result is not usable, and left as
+        None otherwise.
+        """
+        x, y, xc_2, yc_2, R_2, nfev = fit
+        fc.flyer_row = x
+        fc.flyer_column = y
+        fc.n_fit_evaluations = nfev
+        if len(x) < 1 and len(y) < 1:
+            fc.exit_code = 2
+            return
+        elif len(x) < 1 and len(y) > 0:
+            fc.exit_code = 3
+            return
+        elif len(y) < 1 and len(x) > 0:
+            fc.exit_code = 4
+            return
+        if R_2 > max_radius or R_2 < min_radius:
+            fc.exit_code = 5
+            return
+        fc.radius = R_2
+        fc.center_row = xc_2
+        fc.center_column = yc_2
+        fc.leading_row = max(x)
+        # Finding the tilt using arctan and slope value. For a circle, the slope is: -(x-xc)/(y-yc)
+        by_column = y.argsort(kind="quicksort")
+        middle = by_column[int(np.ceil(len(y) / 2))]
+        v, h = y[middle], x[middle]
+        if (h - xc_2) == 0:
+            fc.exit_code = 6
+            return
+        fc.tilt = np.arctan((v - yc_2) / (h - xc_2))
+        if not make_analysis_image:
+            return
+        fc.analysis_image = self.draw_analysis_image(img2, xc_2, yc_2, R_2, x, y)
+
+    def draw_analysis_image(
+        self, img2, center_row, center_column, radius, flyer_row, flyer_column
+    ):
+        """
+        Return the analysis image for a fit: the filtered edges in img2, overlaid
+        with the fitted disk and the edge points that were used for the fit
+        """
+        rr, cc = draw.disk((center_row, center_column), radius, shape=img2.shape)
+        analysis_image = copy.deepcopy(img2)
+        analysis_image[rr, cc] = 100
+        analysis_image[flyer_row, flyer_column] = 256
+        analysis_image = (analysis_image - np.min(analysis_image)) / (
+            np.max(analysis_image) - np.min(analysis_image)
+        )
+        analysis_image = 255 * analysis_image  # Now scale by 255
+        return analysis_image.astype(np.uint8)
+
+    def save_analysis_image(self, fc, output_dir):
+        """
+        Write a result's analysis image to a file in the output directory (or queue it
+        to be written if an OverlayWriter is being used)
+        """
+        im_loc = str(fc.rel_filepath)
+        fc.newimg_loc = output_dir + "/" + im_loc[im_loc.rfind("/") + 1 :]
+        if self.overlay_writer is not None:
+            fc.newimg_loc = self.overlay_writer.submit(fc.newimg_loc, fc.analysis_image)
+        else:
+            import imageio  # pylint: disable=import-outside-toplevel
+
+            imageio.imwrite(fc.newimg_loc, fc.analysis_image)
+
+    def get_analysis_params(
+        self,
+        min_radius=50,
+        max_radius=500,
+        blur_kernel=DEF_BLUR_KERNEL,
+        area_cutoff=DEF_AREA_CUTOFF,
+        arc_fraction=DEF_ARC_FRACTION,
+    ):
+        "Return a dictionary of the parameters that determine an analysis result"
+        return {
+            "min_radius": min_radius,
+            "max_radius": max_radius,
+            "blur_kernel": blur_kernel,
+            "area_cutoff": area_cutoff,
+            "arc_fraction": arc_fraction,
+        }
+
+    def analyze_frame(
+        self,
+        im_loc,
+        output_dir,
+        *,
+        frame_bytes=None,
+        img=None,
+        min_radius=50,
+        max_radius=500,
+        save_output_file=True,
+        filter_failure_exit_code=None,
+        blur_kernel=DEF_BLUR_KERNEL,
+        area_cutoff=DEF_AREA_CUTOFF,
+        arc_fraction=DEF_ARC_FRACTION,
+    ):
+        """
+        Filter and fit a single frame given either the raw bytes of its image file
+        (frame_bytes) or its already-decoded image array (img). If a cache is being
+        used, frames that have already been analyzed with the same parameters are
+        not decoded, filtered, or fit again.
+
+        If filter_failure_exit_code is given, a result with that exit code is
+        returned if filtering the image fails (otherwise the exception is raised).
+
+        Returns a (FlyerCharacteristics, touches_last_row) tuple, where
+        touches_last_row is True if the filtered flyer reaches the last row of the image
+        """
+        stage_times = None if self.telemetry is None else {}
+        fc, touches_last_row = self.__analyze_frame(
+            im_loc,
+            output_dir,
+            frame_bytes,
+            img,
+            stage_times,
+            min_radius=min_radius,
+            max_radius=max_radius,
+            save_output_file=save_output_file,
+            filter_failure_exit_code=filter_failure_exit_code,
+            blur_kernel=blur_kernel,
+            area_cutoff=area_cutoff,
+            arc_fraction=arc_fraction,
+        )
+        if self.telemetry is not None:
+            fc.stage_times = stage_times
+            self.telemetry.record(fc)
+        return fc, touches_last_row
+
+    def __analyze_frame(
+        self,
+        im_loc,
+        output_dir,
+        frame_bytes,
+        img,
+        stage_times,
+        *,
+        min_radius,
+        max_radius,
+        save_output_file,
+        filter_failure_exit_code,
+        blur_kernel,
+        area_cutoff,
+        arc_fraction,
+    ):
+        "Does the work of analyze_frame (recording stage durations if stage_times is a dict)"
+        cache_key = None
+        if self.cache is not None:
+            if frame_bytes is None:
+                img = np.ascontiguousarray(img)
+                frame_bytes = f"{img.shape}{img.dtype}".encode() + img.tobytes()
+            cache_key = self.cache.get_key(
+                frame_bytes,
+                self.get_analysis_params(
+                    min_radius=min_radius,
+                    max_radius=max_radius,
+                    blur_kernel=blur_kernel,
+                    area_cutoff=area_cutoff,
+                    arc_fraction=arc_fraction,
+                ),
+            )
+            fc, touches_last_row = _run_stage(
+                stage_times, "cache_lookup", self.cache.get_result, cache_key, im_loc
+            )
+            if fc is not None:
+                if save_output_file and fc.analysis_image is not None:
+                    self.save_analysis_image(fc, output_dir)
+                return fc, touches_last_row
+        if img is None:
+            img = _run_stage(stage_times, "decode", _decode_frame, frame_bytes)
+        try:
+            filtered_image = self.filter_image(
+                img,
+                blur_kernel=blur_kernel,
+                area_cutoff=area_cutoff,
+                stage_times=stage_times,
+            )
+        except Exception as exc:
+            if filter_failure_exit_code is None:
+                raise
+            fc = FlyerCharacteristics()
+            fc.rel_filepath = im_loc
+            fc.exit_code = filter_failure_exit_code
+            fc.exception_type = type(exc).__name__
+            touches_last_row = False
+        else:
+            fc = self.radius_from_lslm(
+                filtered_image,
+                im_loc,
+                output_dir,
+                min_radius=min_radius,
+                max_radius=max_radius,
+                save_output_file=save_output_file,
+                arc_fraction=arc_fraction,
+                stage_times=stage_times,
+            )
+            touches_last_row = bool(self.check_last_row(filtered_image))
+        if cache_key is not None:
+            _run_stage(
+                stage_times,
+                "cache_write",
+                self.cache.put,
+                cache_key,
+                fc,
+                touches_last_row,
+            )
+        return fc, touches_last_row
+
+    def filter_image(
+        self,
+        img,
+        blur_kernel=DEF_BLUR_KERNEL,
+        area_cutoff=DEF_AREA_CUTOFF,
+        stage_times=None,
+    ):
+        """
+        Code to get the final filtered Image (recording the duration of each step
+        in the stage_times dictionary, if one is given)
+        """
+        input_image_gray = _run_stage(
+            stage_times, "blur", self.blur_image, img, blur_kernel
+        )
+        temp = _run_stage(stage_times, "sobel", self.sobel_edges, input_image_gray)
+        thresh1 = _run_stage(stage_times, "threshold", self.threshold_edges, temp)
+        mask = _run_stage(stage_times, "morphology", self.remove_noise, thresh1)
+        result = _run_stage(
+            stage_times, "components", self.select_components, mask, area_cutoff
+        )
+        return _run_stage(stage_times, "crop", self.crop_date_stamp, result)
+
+    def blur_image(self, img, blur_kernel=DEF_BLUR_KERNEL):
+        "Smooth the image with a (blur_kernel x blur_kernel) Gaussian kernel"
+        # Converting the Image to Grayscale
+        # pylint: disable=no-member
+        return cv2.GaussianBlur(img, (blur_kernel, blur_kernel), 0)
+
+    def sobel_edges(self, img):
+        "Apply Sobel edge detection to the (blurred) image and rescale it to uint8"
+        # Applying Sobel Edge Detection on the Image
+        edge_sobel = filters.sobel(img)
+        # Rescaling the Image
+        return (edge_sobel * 255).astype(np.uint8)
+
+    def threshold_edges(self, img):
+        "Threshold the edge image to a binary mask"
+        # Thresholding the Image using Binary and Otsu Thresholding
+        # pylint: disable=no-member
+        _, thresh1 = cv2.threshold(img, 150, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        return thresh1
+
+    def remove_noise(self, thresh1):
+        "Remove small noise from the binary mask with an erosion and a dilation"
+        # pylint: disable=no-member
+        # Erosion and Dilation Element
+        element = np.ones((4, 4), np.uint8)
+        # Eroding the Element to remove Noise
+        mask = cv2.erode(thresh1, element, iterations=1)
+        # Dilation to regain Original Sizings
+        mask = cv2.dilate(mask, element, iterations=1)
+        return mask
+
+    def select_components(self, mask, area_cutoff=DEF_AREA_CUTOFF):
+        "Keep only the connected components in the mask with at least area_cutoff pixels"
+        # pylint: disable=no-member
+        # Here, I am only finding the connected components
+        nlabels, labels, stats, _ = cv2.connectedComponentsWithStats(
+            mask, None, None, None, 8, cv2.CV_32S
+        )
+        areas = stats[1:, cv2.CC_STAT_AREA]
+        result = np.zeros((labels.shape), np.uint8)
+        # Choosing the Size of the connected components to keep
+        for i in range(0, nlabels - 1):
+            if (
+                areas[i] >= area_cutoff
+            ):  # SIze (this can be changed but currently, this is what worked for me)
+                result[labels == i + 1] = 255
+        return result
+
+    def crop_date_stamp(self, result):
+        "Crop the date stamp band off of the bottom of the image"
+        # Cropping off the bottom date
+        bottom = int(17 * np.floor(result.shape[0] / 18))
+        return result[:bottom]
+
+
+def _decode_frame(frame_bytes):
+    "Return the image array for the raw bytes of a frame's image file"
+    return np.asarray(Image.open(BytesIO(frame_bytes)))
+
+
+def _run_stage(stage_times, stage_name, stage, *args):
+    """
+    Return the output of calling stage(*args), adding how long it took (in seconds)
+    to the stage_times dictionary under stage_name if stage_times isn't None
+    """
+    if stage_times is None:
+        return stage(*args)
+    start = time.perf_counter()
+    try:
+        return stage(*args)
+    finally:
+        stage_times[stage_name] = (
+            stage_times.get(stage_name, 0.0) + time.perf_counter() - start
+        )
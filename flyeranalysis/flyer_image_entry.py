@@ -1,53 +1,184 @@
 """ORM for an entry in the flyer images table"""
+
 # imports
 from io import BytesIO
 import numpy as np
-from sqlalchemy import Integer, LargeBinary, ForeignKey
+from sqlalchemy import Integer, String, LargeBinary, ForeignKey, inspect
 from sqlalchemy.orm import mapped_column, relationship
 from .orm_base import ORMBase
 from .flyer_analysis_entry import FlyerAnalysisEntry
+from .analysis_artifact import (
+    is_analysis_artifact,
+    encode_analysis_artifact,
+    decode_analysis_artifact,
+)
 
 
 class FlyerImageEntry(ORMBase):
     """
     A class describing entries in the flyer image table using sqlalchemy ORM
+
+    Images are either stored inline in the table, or (if an ImageStore is given)
+    kept in the store with only their keys, sizes, and checksums in the table.
+    Image columns are deferred so that querying entries doesn't load any image
+    bytes until they're actually accessed.
     """
 
     __tablename__ = "flyer_images"
 
+    # The names of the two image columns
+    IMAGE_COLUMNS = ("camera_image", "analysis_image")
+
     ID = mapped_column(Integer, primary_key=True)
     analysis_result_ID = mapped_column(
-        ForeignKey(f"{FlyerAnalysisEntry.__tablename__}.ID")
+        ForeignKey(f"{FlyerAnalysisEntry.__tablename__}.ID"), index=True
     )
-    camera_image = mapped_column(LargeBinary())
-    analysis_image = mapped_column(LargeBinary())
+    camera_image = mapped_column(LargeBinary(), deferred=True)
+    analysis_image = mapped_column(LargeBinary(), deferred=True)
+    camera_image_key = mapped_column(String(128))
+    camera_image_size = mapped_column(Integer)
+    camera_image_checksum = mapped_column(String(64))
+    analysis_image_key = mapped_column(String(128))
+    analysis_image_size = mapped_column(Integer)
+    analysis_image_checksum = mapped_column(String(64))
 
     flyer_analysis_relation = relationship(
         "FlyerAnalysisEntry", foreign_keys="FlyerImageEntry.analysis_result_ID"
     )
 
-    def __init__(self, analysis_result_id, camera_image, analysis_image):
+    @classmethod
+    def add_missing_columns(cls, engine):
+        """
+        Add any columns that are missing from an existing flyer images table (for
+        tables that were created before the image store columns were added). The
+        added columns are all nullable, so the rows already in the table keep their
+        inline images.
+
+        Returns: a list of the names of the columns that were added
+        """
+        inspector = inspect(engine)
+        if not inspector.has_table(cls.__tablename__):
+            return []
+        existing = {
+            column["name"] for column in inspector.get_columns(cls.__tablename__)
+        }
+        preparer = engine.dialect.identifier_preparer
+        added = []
+        with engine.begin() as conn:
+            for column in cls.__table__.columns:
+                if column.name in existing:
+                    continue
+                conn.exec_driver_sql(
+                    f"ALTER TABLE {preparer.quote(cls.__tablename__)} "
+                    f"ADD {preparer.quote(column.name)} "
+                    f"{column.type.compile(dialect=engine.dialect)} NULL"
+                )
+                added.append(column.name)
+        return added
+
+    def __init__(
+        self, analysis_result_id, camera_image, analysis_image, image_store=None
+    ):
         super().__init__()
         self.analysis_result_ID = analysis_result_id
-        self.camera_image = camera_image
-        self.analysis_image = analysis_image
+        for column, data in zip(self.IMAGE_COLUMNS, (camera_image, analysis_image)):
+            for name, value in self.get_image_column_values(
+                column, data, image_store
+            ).items():
+                setattr(self, name, value)
 
     @classmethod
-    def from_id_img_and_result(cls, analysis_result_ID, img_bytestring, result):
+    def from_id_img_and_result(
+        cls, analysis_result_ID, img_bytestring, result, image_store=None
+    ):
         """
         Given the ID of an associated analysis result entry, the bytestring of
         the original .bmp image, and the "FlyerCharacteristics" result object
         from the flyer detection code, return a newly-created entry for the table
+        (with its images kept in image_store if one is given)
         """
-        if result.analysis_image is None:
-            analysis_img_bytestring = None
-        else:
-            mem_stream = BytesIO()
-            np.savez_compressed(mem_stream, result.analysis_image)
-            mem_stream.seek(0)
-            analysis_img_bytestring = mem_stream.read()
         return cls(
             analysis_result_ID,
             img_bytestring,
-            analysis_img_bytestring,
+            cls.encode_analysis_image(result),
+            image_store=image_store,
         )
+
+    @staticmethod
+    def encode_analysis_image(result):
+        """
+        Return the bytestring to store for the analysis image of a given
+        "FlyerCharacteristics" result object (None if it has no analysis image).
+        This is a compact artifact holding only the information needed to redraw
+        the image (see analysis_artifact.py).
+        """
+        return encode_analysis_artifact(result)
+
+    @staticmethod
+    def get_image_column_values(column, data, image_store=None):
+        """
+        Return a dictionary of the values to set for one of the image columns
+        (and its key, size, and checksum columns) to store the given bytes, either
+        inline (if image_store is None) or in the given ImageStore
+        """
+        values = {
+            column: None,
+            f"{column}_key": None,
+            f"{column}_size": None,
+            f"{column}_checksum": None,
+        }
+        if data is None:
+            return values
+        if image_store is None:
+            values[column] = data
+            return values
+        key, size, checksum = image_store.put(data)
+        values[f"{column}_key"] = key
+        values[f"{column}_size"] = size
+        values[f"{column}_checksum"] = checksum
+        return values
+
+    def get_camera_image(self, image_store=None):
+        """
+        Return the bytestring of the original .bmp image, fetching it from the given
+        ImageStore if it isn't stored inline (None if there is no image)
+        """
+        return self.__get_image_bytes("camera_image", image_store)
+
+    def get_analysis_image(self, image_store=None):
+        """
+        Return the analysis image as a numpy array, fetching it from the given
+        ImageStore if it isn't stored inline (None if there is no image). Images
+        stored as compact artifacts are redrawn, and older entries holding full
+        .npz images are read as-is.
+        """
+        return self.decode_analysis_image(
+            self.__get_image_bytes("analysis_image", image_store)
+        )
+
+    @staticmethod
+    def decode_analysis_image(analysis_img_bytestring):
+        """
+        Return the analysis image as a numpy array given the bytes stored for it
+        (either a compact artifact or an older .npz image), or None if there are none
+        """
+        if analysis_img_bytestring is None:
+            return None
+        if is_analysis_artifact(analysis_img_bytestring):
+            return decode_analysis_artifact(analysis_img_bytestring)
+        with np.load(BytesIO(analysis_img_bytestring)) as npz_file:
+            return npz_file["arr_0"]
+
+    def __get_image_bytes(self, column, image_store):
+        data = getattr(self, column)
+        if data is not None:
+            return data
+        key = getattr(self, f"{column}_key")
+        if key is None:
+            return None
+        if image_store is None:
+            raise ValueError(
+                f"ERROR: the {column} for flyer image {self.ID} is kept in an image "
+                "store, but no image store was given to read it from!"
+            )
+        return image_store.get(key, checksum=getattr(self, f"{column}_checksum"))
@@ -0,0 +1,133 @@
+"""A compact, array-backed table of flyer analysis results for many frames"""
+
+# imports
+import numpy as np
+
+
+class FlyerResultsTable:
+    """
+    Columnar storage for the results of analyzing many frames of a video
+
+    Scalar results are kept in preallocated numpy arrays with fixed data types instead
+    of a list of dictionaries, and the (variable-length) edge points used for each fit
+    are kept in a ragged CSR-style side store: the points for row i are
+    edge_rows[edge_offsets[i]:edge_offsets[i+1]] (and the same for edge_columns).
+    Full-frame analysis images are not stored at all.
+
+    Args:
+        capacity: the number of results to preallocate space for (the table grows
+            automatically if more results are appended)
+    """
+
+    # The scalar columns of the table and their data types. Values that can be
+    # missing are stored as floats so that None becomes NaN.
+    SCALAR_COLUMNS = {
+        "exit_code": np.int16,
+        "radius": np.float64,
+        "center_row": np.float64,
+        "center_column": np.float64,
+        "leading_row": np.float64,
+        "tilt": np.float64,
+    }
+    STRING_COLUMNS = ("rel_filepath", "newimg_loc")
+    DEF_CAPACITY = 256
+    DEF_EDGE_POINTS_PER_RESULT = 128
+
+    @property
+    def n_edge_points(self):
+        "The total number of edge points stored for all results"
+        return int(self.__edge_offsets[self.__n_results])
+
+    def __init__(self, capacity=DEF_CAPACITY):
+        capacity = max(int(capacity), 1)
+        self.__n_results = 0
+        self.__columns = {}
+        for name, dtype in self.SCALAR_COLUMNS.items():
+            self.__columns[name] = np.empty(capacity, dtype=dtype)
+        for name in self.STRING_COLUMNS:
+            self.__columns[name] = np.empty(capacity, dtype=object)
+        self.__edge_offsets = np.zeros(capacity + 1, dtype=np.int64)
+        edge_capacity = capacity * self.DEF_EDGE_POINTS_PER_RESULT
+        self.__edge_rows = np.empty(edge_capacity, dtype=np.int32)
+        self.__edge_columns = np.empty(edge_capacity, dtype=np.int32)
+
+    def __len__(self):
+        return self.__n_results
+
+    def append(self, result):
+        """
+        Add a single "FlyerCharacteristics" result object to the end of the table
+        """
+        irow = self.__n_results
+        if irow >= self.__edge_offsets.shape[0] - 1:
+            self.__grow_rows(2 * irow)
+        for name, dtype in self.SCALAR_COLUMNS.items():
+            value = getattr(result, name)
+            if value is None:
+                value = np.nan if np.issubdtype(dtype, np.floating) else -1
+            self.__columns[name][irow] = value
+        for name in self.STRING_COLUMNS:
+            value = getattr(result, name)
+            self.__columns[name][irow] = str(value) if value is not None else None
+        start = self.__edge_offsets[irow]
+        n_points = 0 if result.flyer_row is None else len(result.flyer_row)
+        if start + n_points > self.__edge_rows.shape[0]:
+            self.__grow_edge_points(2 * (start + n_points))
+        if n_points > 0:
+            self.__edge_rows[start : start + n_points] = result.flyer_row
+            self.__edge_columns[start : start + n_points] = result.flyer_column
+        self.__edge_offsets[irow + 1] = start + n_points
+        self.__n_results += 1
+
+    def column(self, name):
+        "Return a view of the (filled part of the) column with the given name"
+        return self.__columns[name][: self.__n_results]
+
+    def edge_points(self, index):
+        """
+        Return views of the (flyer_row, flyer_column) arrays of edge points used
+        for the fit of the result at the given index
+        """
+        if index < 0:
+            index += self.__n_results
+        if not 0 <= index < self.__n_results:
+            raise IndexError(f"Result index {index} out of range")
+        start, stop = self.__edge_offsets[index], self.__edge_offsets[index + 1]
+        return self.__edge_rows[start:stop], self.__edge_columns[start:stop]
+
+    def to_dataframe(self):
+        """
+        Return a DataFrame of the scalar and string columns. The DataFrame's
+        columns are views of the table's arrays (no data are copied).
+        """
+        import pandas as pd  # pylint: disable=import-outside-toplevel
+
+        return pd.DataFrame(
+            {name: self.column(name) for name in self.__columns},
+            copy=False,
+        )
+
+    def __grow_rows(self, new_capacity):
+        new_capacity = max(new_capacity, 1)
+        for name, array in self.__columns.items():
+            self.__columns[name] = self.__resized(array, new_capacity, self.__n_results)
+        self.__edge_offsets = self.__resized(
+            self.__edge_offsets, new_capacity + 1, self.__n_results + 1, fill=0
+        )
+
+    def __grow_edge_points(self, new_capacity):
+        n_points = self.n_edge_points
+        self.__edge_rows = self.__resized(self.__edge_rows, new_capacity, n_points)
+        self.__edge_columns = self.__resized(
+            self.__edge_columns, new_capacity, n_points
+        )
+
+    @staticmethod
+    def __resized(array, new_capacity, n_filled, fill=None):
+        "Return a larger copy of an array, keeping only its first n_filled entries"
+        if fill is None:
+            new_array = np.empty(new_capacity, dtype=array.dtype)
+        else:
+            new_array = np.full(new_capacity, fill, dtype=array.dtype)
+        new_array[:n_filled] = array[:n_filled]
+        return new_array
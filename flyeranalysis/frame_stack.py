@@ -0,0 +1,192 @@
+"""Memory-mapped stacks of high speed video frames for bulk offline analysis
+
+A frame stack packs every .bmp frame of a single video into one .npy file that can be
+memory-mapped, alongside a small sidecar JSON file holding the original frame names in
+order. Reading sequential pages of a single file is much cheaper than opening thousands
+of small files, especially on network storage.
+
+Typical usage:
+    python -m flyeranalysis.frame_stack [input_directory] [output_stack_path]
+"""
+
+# imports
+import os
+import json
+import pathlib
+from argparse import ArgumentParser
+import numpy as np
+from PIL import Image
+
+
+class FrameStack:
+    """A read-only, memory-mapped stack of the frames from one video
+
+    Args:
+        stack_path: path to the .npy file holding the stacked frames. The sidecar
+            frame name index is expected next to it (see FrameStack.get_index_path)
+
+    Raises:
+        FileNotFoundError: the stack file or its sidecar index doesn't exist
+        RuntimeError: the number of frames in the stack and in the index don't match
+    """
+
+    STACK_SUFFIX = ".npy"
+    INDEX_SUFFIX = "_frames.json"
+    FRAME_SUFFIX = ".bmp"
+
+    @property
+    def frame_names(self):
+        "The names of the original frame files, in stack order"
+        return self.__frame_names
+
+    @property
+    def source_directory(self):
+        "The path to the directory the frames were originally read from"
+        return self.__source_directory
+
+    @property
+    def frame_shape(self):
+        "The shape of each individual frame in the stack"
+        return self.frames.shape[1:]
+
+    def __init__(self, stack_path):
+        self.stack_path = self.get_stack_path(stack_path)
+        self.index_path = self.get_index_path(self.stack_path)
+        for filepath in (self.stack_path, self.index_path):
+            if not filepath.is_file():
+                raise FileNotFoundError(f"ERROR: {filepath} does not exist!")
+        with open(self.index_path, "r") as index_file:
+            index = json.load(index_file)
+        self.__frame_names = index["frame_names"]
+        self.__source_directory = index["source_directory"]
+        self.frames = np.load(self.stack_path, mmap_mode="r")
+        if self.frames.shape[0] != len(self.__frame_names):
+            raise RuntimeError(
+                f"ERROR: {self.stack_path} holds {self.frames.shape[0]} frames but "
+                f"its index at {self.index_path} lists {len(self.__frame_names)}!"
+            )
+
+    def __len__(self):
+        return len(self.__frame_names)
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+    def __iter__(self):
+        "Iterate over (frame_name, frame_array) tuples in stack order"
+        for frame_name, frame in zip(self.__frame_names, self.frames):
+            yield frame_name, frame
+
+    @classmethod
+    def get_stack_path(cls, stack_path):
+        "Return the path to a stack .npy file, adding the suffix if it's missing"
+        stack_path = pathlib.Path(stack_path)
+        if stack_path.suffix != cls.STACK_SUFFIX:
+            stack_path = stack_path.with_name(stack_path.name + cls.STACK_SUFFIX)
+        return stack_path
+
+    @classmethod
+    def get_index_path(cls, stack_path):
+        "Return the path to the sidecar frame name index for a given stack file"
+        stack_path = cls.get_stack_path(stack_path)
+        return stack_path.with_name(stack_path.stem + cls.INDEX_SUFFIX)
+
+    @classmethod
+    def from_directory(cls, input_location, stack_path):
+        """Pack all of the .bmp frames in a directory into a new frame stack
+
+        Frames are written one at a time into a memory-mapped output file, so the
+        whole video never has to be held in memory at once.
+
+        Args:
+            input_location: path to the directory holding the .bmp frames of one video
+            stack_path: path to the .npy file that should be created
+
+        Returns: a FrameStack object for the newly-created stack
+
+        Raises:
+            FileNotFoundError: the input directory holds no .bmp frames
+            ValueError: the frames in the input directory don't all have the same
+                shape and data type
+        """
+        input_location = pathlib.Path(input_location)
+        frame_names = [
+            fn
+            for fn in sorted(os.listdir(input_location))
+            if fn.endswith(cls.FRAME_SUFFIX)
+        ]
+        if len(frame_names) < 1:
+            raise FileNotFoundError(
+                f"ERROR: no {cls.FRAME_SUFFIX} frames found in {input_location}!"
+            )
+        stack_path = cls.get_stack_path(stack_path)
+        stack_path.parent.mkdir(parents=True, exist_ok=True)
+        first_frame = np.asarray(Image.open(input_location / frame_names[0]))
+        stack = np.lib.format.open_memmap(
+            stack_path,
+            mode="w+",
+            dtype=first_frame.dtype,
+            shape=(len(frame_names), *first_frame.shape),
+        )
+        try:
+            stack[0] = first_frame
+            for iframe, frame_name in enumerate(frame_names[1:], start=1):
+                frame = np.asarray(Image.open(input_location / frame_name))
+                if frame.shape != first_frame.shape or frame.dtype != first_frame.dtype:
+                    raise ValueError(
+                        f"ERROR: frame {frame_name} has shape {frame.shape} and dtype "
+                        f"{frame.dtype}, but expected shape {first_frame.shape} and "
+                        f"dtype {first_frame.dtype} (from {frame_names[0]})"
+                    )
+                stack[iframe] = frame
+            stack.flush()
+        finally:
+            del stack
+        with open(cls.get_index_path(stack_path), "w") as index_file:
+            json.dump(
+                {
+                    "source_directory": str(input_location),
+                    "frame_names": frame_names,
+                },
+                index_file,
+                indent=2,
+            )
+        return cls(stack_path)
+
+    @classmethod
+    def get_command_line_options(cls, args=None):
+        """Return the command line options given an (optional) list of args
+
+        Args:
+            args: a list of arguments to pass to the parser instead of using sys.argv
+
+        Returns: A namespace of parsed arguments
+        """
+        parser = ArgumentParser()
+        parser.add_argument(
+            "input_directory",
+            type=pathlib.Path,
+            help="The directory holding the .bmp frames of a single video",
+        )
+        parser.add_argument(
+            "stack_path",
+            type=pathlib.Path,
+            help=(
+                "Path to the .npy stack file that should be created. The frame name "
+                f'index will be written alongside it with a "{cls.INDEX_SUFFIX}" suffix.'
+            ),
+        )
+        return parser.parse_args(args)
+
+
+def main(args=None):
+    "Pack a directory of frames into a frame stack from the command line"
+    options = FrameStack.get_command_line_options(args)
+    stack = FrameStack.from_directory(options.input_directory, options.stack_path)
+    print(
+        f"Wrote {len(stack)} frames from {options.input_directory} to {stack.stack_path}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Pluggable stores for frame and analysis images kept outside of the database
+
+Images are content-addressed: each one is stored under the SHA-256 hash of its bytes,
+and the database only holds that key along with the image's size and checksum.
+"""
+
+# imports
+import os
+import pathlib
+import hashlib
+import threading
+from io import BytesIO
+from urllib.parse import urlparse
+
+
+def get_image_store(spec):
+    """Return an ImageStore given a string describing where images should be kept
+
+    Args:
+        spec: either a path to a local/shared directory (optionally as a "file://" URL)
+            or an "s3://bucket/prefix" URL. S3 stores use a boto3 client configured
+            from the environment.
+
+    Returns: an ImageStore object (or None if spec is None)
+    """
+    if spec is None or isinstance(spec, ImageStore):
+        return spec
+    parsed = urlparse(str(spec))
+    if parsed.scheme == "s3":
+        return S3ImageStore(parsed.netloc, prefix=parsed.path.lstrip("/"))
+    if parsed.scheme == "file":
+        return FileSystemImageStore(parsed.path)
+    return FileSystemImageStore(spec)
+
+
+class ImageStore:
+    """Base class for content-addressed stores of image bytes
+
+    Not used directly: subclasses implement _write and _read for a particular backend.
+    """
+
+    @staticmethod
+    def get_checksum(data):
+        "Return the SHA-256 checksum (hex digest) of some bytes"
+        return hashlib.sha256(data).hexdigest()
+
+    def put(self, data):
+        """Store some bytes and return a (key, size, checksum) tuple describing them
+
+        Storing the same bytes more than once is safe (they're only kept once).
+        """
+        checksum = self.get_checksum(data)
+        self._write(checksum, data)
+        return checksum, len(data), checksum
+
+    def get(self, key, checksum=None):
+        """Return the bytes stored under a key
+
+        Raises:
+            RuntimeError: a checksum was given and it doesn't match the stored bytes
+        """
+        data = self._read(key)
+        if checksum is not None and self.get_checksum(data) != checksum:
+            raise RuntimeError(
+                f"ERROR: checksum mismatch for image {key} read from {self}!"
+            )
+        return data
+
+    def _write(self, key, data):
+        raise NotImplementedError
+
+    def _read(self, key):
+        raise NotImplementedError
+
+
+class FileSystemImageStore(ImageStore):
+    """Stores images as individual files in a (local or shared) directory
+
+    Files are spread into subdirectories by the first characters of their keys to
+    keep directory sizes manageable.
+
+    Args:
+        root: path to the directory holding the images (created if necessary)
+    """
+
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def __str__(self):
+        return f"{self.__class__.__name__}({self.root})"
+
+    def get_path(self, key):
+        "Return the path to the file holding the image with the given key"
+        return self.root / key[:2] / key[2:4] / key
+
+    def _write(self, key, data):
+        filepath = self.get_path(key)
+        if filepath.is_file():
+            return
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = filepath.with_name(
+            f"{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        with open(tmp_path, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp_path, filepath)
+
+    def _read(self, key):
+        with open(self.get_path(key), "rb") as fp:
+            return fp.read()
+
+
+class S3ImageStore(ImageStore):
+    """Stores images as objects in an S3-compatible bucket
+
+    Args:
+        bucket: the name of the bucket to use
+        prefix: a prefix to add to the key of every object
+        client: an S3 client object (default is a new boto3 client configured from
+            the environment; a LocalS3Client can be used for tests)
+    """
+
+    def __init__(self, bucket, prefix="", client=None):
+        if client is None:
+            try:
+                import boto3  # pylint: disable=import-outside-toplevel
+            except ImportError as exc:
+                raise ImportError(
+                    "ERROR: boto3 is needed to store images in S3. "
+                    "You can install it with 'pip install boto3'."
+                ) from exc
+            client = boto3.client("s3")
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.rstrip("/") + "/" if prefix else ""
+
+    def __str__(self):
+        return f"{self.__class__.__name__}(s3://{self.bucket}/{self.prefix})"
+
+    def _write(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+
+    def _read(self, key):
+        response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        return response["Body"].read()
+
+
+class LocalS3Client:
+    """A minimal stand-in for a boto3 S3 client that keeps objects in a local directory
+
+    Implements only the calls used by S3ImageStore, so S3 storage can be exercised
+    without a real (or mocked) S3 service.
+
+    Args:
+        root: path to the directory holding one subdirectory per bucket
+    """
+
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+
+    def put_object(self, *, Bucket, Key, Body):  # pylint: disable=invalid-name
+        "Store the bytes in Body as an object"
+        filepath = self.root / Bucket / Key
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        with open(filepath, "wb") as fp:
+            fp.write(Body)
+        return {"ETag": hashlib.md5(Body).hexdigest()}
+
+    def get_object(self, *, Bucket, Key):  # pylint: disable=invalid-name
+        "Return a dictionary with the object's bytes in a readable 'Body' stream"
+        filepath = self.root / Bucket / Key
+        if not filepath.is_file():
+            raise KeyError(f"No object {Key} in bucket {Bucket}")
+        with open(filepath, "rb") as fp:
+            data = fp.read()
+        return {"Body": BytesIO(data), "ContentLength": len(data)}
@@ -1,7 +1,7 @@
 """ORM for a row in the metadata links table"""
 # imports
 import re, datetime
-from sqlalchemy import Integer, DateTime, String
+from sqlalchemy import Integer, DateTime, String, Index
 from sqlalchemy.orm import mapped_column
 from .orm_base import ORMBase
 
@@ -19,6 +19,13 @@ class MetadataLinkEntry(ORMBase):
     """
 
     __tablename__ = "metadata_links"
+    # links are looked up by datestamp and either counter or camera filename
+    __table_args__ = (
+        Index(
+            "ix_metadata_links_datestamp_counter", "datestamp", "experiment_day_counter"
+        ),
+        Index("ix_metadata_links_datestamp_camera", "datestamp", "camera_filename"),
+    )
 
     ID = mapped_column(Integer, primary_key=True)
     datestamp = mapped_column(DateTime)
@@ -0,0 +1,144 @@
+"""Writes analysis (overlay) images to files in a pool of background threads
+
+Writing an analysis image can take as long as analyzing the frame it came from
+(especially on network filesystems), so Flyer_Detection hands the images to an
+OverlayWriter instead of writing them itself. At most max_pending images are queued
+at once: once that many are waiting to be written, submitting another one blocks
+until one of them has been written, so memory use stays bounded if the disk can't
+keep up with the analysis.
+
+Images can be written either as uncompressed .bmp files (the fastest to write) or as
+.png files with a tunable compression level (0 is fastest, 9 is smallest).
+"""
+
+# imports
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+
+
+class OverlayWriter:
+    """A bounded pool of threads writing images to files
+
+    Exceptions raised while writing an image are re-raised by the next call to
+    submit or flush.
+
+    Args:
+        image_format: "bmp" to write uncompressed images, or "png" to write
+            compressed images
+        png_compression: the PNG compression level (0-9) to use if image_format is "png"
+        n_threads: the number of threads writing images
+        max_pending: the maximum number of images waiting to be written at once
+            (default = 4 * n_threads)
+
+    Raises:
+        ValueError: the image format or PNG compression level is invalid
+    """
+
+    IMAGE_FORMATS = ("bmp", "png")
+    DEF_PNG_COMPRESSION = 1
+    DEF_N_THREADS = 2
+
+    def __init__(
+        self,
+        image_format="bmp",
+        *,
+        png_compression=DEF_PNG_COMPRESSION,
+        n_threads=DEF_N_THREADS,
+        max_pending=None,
+    ):
+        if image_format not in self.IMAGE_FORMATS:
+            raise ValueError(
+                f"ERROR: unknown image format {image_format} "
+                f"(expected one of {', '.join(self.IMAGE_FORMATS)})"
+            )
+        if not 0 <= png_compression <= 9:
+            raise ValueError(
+                f"ERROR: PNG compression level {png_compression} is not between 0 and 9!"
+            )
+        self.image_format = image_format
+        self.png_compression = png_compression
+        self.n_threads = n_threads
+        self.max_pending = max_pending if max_pending is not None else 4 * n_threads
+        self.__executor = ThreadPoolExecutor(
+            max_workers=n_threads, thread_name_prefix="OverlayWriter"
+        )
+        self.__slots = threading.BoundedSemaphore(self.max_pending)
+        self.__lock = threading.Lock()
+        self.__pending = set()
+        self.__errors = []
+        self.__write_params = []
+        if image_format == "png":
+            self.__write_params = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_filepath(self, filepath):
+        "Return the path an image given for a filepath will actually be written to"
+        return f"{os.path.splitext(str(filepath))[0]}.{self.image_format}"
+
+    def submit(self, filepath, image):
+        """Queue an image to be written (blocking while max_pending images are queued)
+
+        The image array must not be modified after it's submitted.
+
+        Args:
+            filepath: the path to write the image to (its extension is replaced to
+                match the image format)
+            image: the image array to write
+
+        Returns: the path the image will be written to
+        """
+        self.__raise_errors()
+        filepath = self.get_filepath(filepath)
+        self.__slots.acquire()
+        try:
+            future = self.__executor.submit(self.__write, filepath, image)
+        except Exception:
+            self.__slots.release()
+            raise
+        with self.__lock:
+            self.__pending.add(future)
+        future.add_done_callback(self.__done)
+        return filepath
+
+    def flush(self):
+        "Wait until every queued image has been written"
+        while True:
+            with self.__lock:
+                pending = list(self.__pending)
+            if len(pending) < 1:
+                break
+            for future in pending:
+                future.exception()
+        self.__raise_errors()
+
+    def close(self):
+        "Write every queued image and shut down the pool of threads"
+        try:
+            self.flush()
+        finally:
+            self.__executor.shutdown(wait=True)
+
+    def __write(self, filepath, image):
+        if not cv2.imwrite(filepath, image, self.__write_params):
+            raise OSError(f"ERROR: failed to write an image to {filepath}")
+
+    def __done(self, future):
+        with self.__lock:
+            self.__pending.discard(future)
+            if future.exception() is not None:
+                self.__errors.append(future.exception())
+        self.__slots.release()
+
+    def __raise_errors(self):
+        with self.__lock:
+            errors = self.__errors
+            self.__errors = []
+        if len(errors) > 0:
+            raise errors[0]
@@ -0,0 +1,352 @@
+"""Run the flyer analysis over a grid of parameters, sharing intermediate results
+
+The analysis is broken into a chain of stages (blur -> Sobel -> threshold -> morphology
+-> connected components -> edge selection -> fit). The output of each stage for a frame
+is memoized by the values of the parameters that it and every stage upstream of it
+depend on, so each distinct intermediate result is only computed once per frame no
+matter how many parameter combinations share it.
+
+Typical usage:
+    python -m flyeranalysis.parameter_sweep [input_location] [output_csv] \
+        --blur_kernel 5 7 9 --area_cutoff 100 200 --arc_fraction 0.2 0.3
+"""
+
+# imports
+import os
+import pathlib
+import itertools
+import logging
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from PIL import Image
+from .frame_stack import FrameStack
+from .flyer_detection_core import (
+    FlyerDetectionCore,
+    FlyerCharacteristics,
+    DEF_BLUR_KERNEL,
+    DEF_AREA_CUTOFF,
+    DEF_ARC_FRACTION,
+)
+
+
+class ParameterSweep:
+    """Analyzes frames for every combination of parameters in a grid
+
+    Args:
+        param_grid: dictionary of parameter names to lists of values to try. Any
+            parameter not in the grid uses its default value (see DEF_PARAMS).
+
+    Raises:
+        ValueError: the grid has a parameter that isn't in DEF_PARAMS
+    """
+
+    DEF_PARAMS = {
+        "blur_kernel": DEF_BLUR_KERNEL,
+        "area_cutoff": DEF_AREA_CUTOFF,
+        "arc_fraction": DEF_ARC_FRACTION,
+        "min_radius": 50,
+        "max_radius": 500,
+    }
+    # The stages of the analysis in order, with the parameters each one depends on
+    # (the radius bounds are only applied to the final, unmemoized result)
+    STAGES = (
+        ("blur", ("blur_kernel",)),
+        ("sobel", ()),
+        ("threshold", ()),
+        ("morphology", ()),
+        ("components", ("area_cutoff",)),
+        ("edge_selection", ("arc_fraction",)),
+        ("fit", ()),
+    )
+    FILTER_STAGES = ("blur", "sobel", "threshold", "morphology", "components")
+    RESULT_COLUMNS = (
+        "exit_code",
+        "radius",
+        "center_row",
+        "center_column",
+        "leading_row",
+        "tilt",
+    )
+    # Same code as the stream processor uses for frames that fail filtering
+    FILTER_FAILURE_EXIT_CODE = 8
+
+    @property
+    def param_combinations(self):
+        "A list of dictionaries of parameter values, one for each point in the grid"
+        names = list(self.param_grid.keys())
+        return [
+            dict(zip(names, values))
+            for values in itertools.product(*self.param_grid.values())
+        ]
+
+    def __init__(self, param_grid):
+        unrecognized = set(param_grid) - set(self.DEF_PARAMS)
+        if unrecognized:
+            raise ValueError(
+                f"ERROR: unrecognized sweep parameters {sorted(unrecognized)} "
+                f"(options are {list(self.DEF_PARAMS.keys())})"
+            )
+        self.param_grid = {
+            name: list(param_grid[name]) if name in param_grid else [default]
+            for name, default in self.DEF_PARAMS.items()
+        }
+        self.analyzer = FlyerDetectionCore()
+        # the names of the parameters each stage's output depends on (its own and
+        # those of every stage upstream of it)
+        self.__upstream_params = []
+        upstream = ()
+        for _, stage_params in self.STAGES:
+            upstream = upstream + stage_params
+            self.__upstream_params.append(upstream)
+        self.n_stage_runs = {stage_name: 0 for stage_name, _ in self.STAGES}
+
+    def sweep_frame(self, img, im_loc):
+        """Analyze one frame with every combination of parameters in the grid
+
+        Args:
+            img: the image array of the frame
+            im_loc: the path to the frame (stored in the "rel_filepath" column)
+
+        Returns: a list of dictionaries, one per parameter combination, holding the
+            parameter values and the analysis results
+        """
+        memo = {}
+        rows = []
+        for params in self.param_combinations:
+            fc = self.__get_result(img, im_loc, params, memo)
+            row = {"rel_filepath": im_loc, **params}
+            for column in self.RESULT_COLUMNS:
+                row[column] = getattr(fc, column)
+            rows.append(row)
+        return rows
+
+    def __get_result(self, img, im_loc, params, memo):
+        "Return the FlyerCharacteristics result for one frame and parameter combination"
+        fc = FlyerCharacteristics()
+        fc.rel_filepath = im_loc
+        fit_istage = len(self.STAGES) - 1
+        fit = self.__get_stage_output(fit_istage, img, params, memo)
+        if isinstance(fit, _StageFailure):
+            if fit.stage_name in self.FILTER_STAGES:
+                fc.exit_code = self.FILTER_FAILURE_EXIT_CODE
+            else:
+                fc.exit_code = 7
+            return fc
+        if fit is None:
+            fc.exit_code = 1
+            return fc
+        img2, temp = self.__get_stage_output(fit_istage - 1, img, params, memo)
+        try:
+            self.analyzer.set_fit_result(
+                fc,
+                img2,
+                temp,
+                fit,
+                min_radius=params["min_radius"],
+                max_radius=params["max_radius"],
+                make_analysis_image=False,
+            )
+        except Exception:
+            fc.exit_code = 7
+            return fc
+        if fc.exit_code is None:
+            fc.exit_code = 0
+        return fc
+
+    def __get_stage_output(self, istage, img, params, memo):
+        "Return the (memoized) output of one stage for a frame and parameter combination"
+        stage_name, _ = self.STAGES[istage]
+        key = (stage_name,) + tuple(params[p] for p in self.__upstream_params[istage])
+        if key not in memo:
+            if istage == 0:
+                upstream = img
+            else:
+                upstream = self.__get_stage_output(istage - 1, img, params, memo)
+            if isinstance(upstream, _StageFailure) or (upstream is None and istage > 0):
+                memo[key] = upstream
+            else:
+                try:
+                    memo[key] = self.__run_stage(stage_name, upstream, params)
+                except Exception as exc:
+                    memo[key] = _StageFailure(stage_name, exc)
+                self.n_stage_runs[stage_name] += 1
+        return memo[key]
+
+    def __run_stage(self, stage_name, upstream, params):
+        "Run a single stage of the analysis on the output of the stage before it"
+        analyzer = self.analyzer
+        if stage_name == "blur":
+            return analyzer.blur_image(upstream, params["blur_kernel"])
+        if stage_name == "sobel":
+            return analyzer.sobel_edges(upstream)
+        if stage_name == "threshold":
+            return analyzer.threshold_edges(upstream)
+        if stage_name == "morphology":
+            return analyzer.remove_noise(upstream)
+        if stage_name == "components":
+            return analyzer.crop_date_stamp(
+                analyzer.select_components(upstream, params["area_cutoff"])
+            )
+        if stage_name == "edge_selection":
+            # blank images have no edge to select (exit code 1)
+            if analyzer.check_blank_image(upstream):
+                return None
+            return analyzer.select_edge_points(upstream, params["arc_fraction"])
+        if stage_name == "fit":
+            _, temp = upstream
+            return analyzer.fit_circle(temp)
+        raise ValueError(f"ERROR: unrecognized analysis stage {stage_name}")
+
+
+class _StageFailure:
+    "Placeholder for the output of a stage that raised an exception"
+
+    def __init__(self, stage_name, exc):
+        self.stage_name = stage_name
+        self.exc = exc
+
+
+def get_frame_refs(input_location):
+    """Return a list of (image location, frame stack path, index in stack) tuples for
+    every frame in a directory of .bmp files or a frame stack
+    """
+    input_location = pathlib.Path(input_location)
+    if input_location.is_dir():
+        return [
+            (os.path.join(input_location, fn), None, None)
+            for fn in sorted(os.listdir(input_location))
+            if fn.endswith(FrameStack.FRAME_SUFFIX)
+        ]
+    stack = FrameStack(input_location)
+    return [
+        (os.path.join(stack.source_directory, frame_name), stack.stack_path, iframe)
+        for iframe, frame_name in enumerate(stack.frame_names)
+    ]
+
+
+def _sweep_frame(param_grid, im_loc, stack_path, stack_index):
+    "Sweep a single frame (in a worker process). Returns the rows and stage counts."
+    if stack_path is None:
+        img = np.array(Image.open(im_loc))
+    else:
+        img = np.asarray(FrameStack(stack_path)[stack_index])
+    sweep = ParameterSweep(param_grid)
+    rows = sweep.sweep_frame(img, im_loc)
+    return rows, sweep.n_stage_runs
+
+
+def run_parameter_sweep(input_location, param_grid, n_workers=1, logger=None):
+    """Analyze every frame in a directory or frame stack for every combination of
+    parameters in a grid
+
+    Args:
+        input_location: path to a directory of .bmp frames or a frame stack .npy file
+        param_grid: dictionary of parameter names to lists of values to try
+        n_workers: the number of parallel processes to use (frames are split between them)
+        logger: a logger to use for messages (optional)
+
+    Returns: a DataFrame with one row per frame and parameter combination
+    """
+    # check the grid before starting any workers
+    sweep = ParameterSweep(param_grid)
+    frame_refs = get_frame_refs(input_location)
+    all_rows = []
+    n_stage_runs = dict.fromkeys(sweep.n_stage_runs, 0)
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [
+            executor.submit(_sweep_frame, param_grid, *frame_ref)
+            for frame_ref in frame_refs
+        ]
+        for iframe, future in enumerate(futures):
+            rows, frame_stage_runs = future.result()
+            for row in rows:
+                row["frame"] = iframe
+            all_rows.extend(rows)
+            for stage_name, n_runs in frame_stage_runs.items():
+                n_stage_runs[stage_name] += n_runs
+    if logger is not None:
+        n_combos = len(sweep.param_combinations)
+        logger.info(
+            "Analyzed %d frames for %d parameter combinations",
+            len(frame_refs),
+            n_combos,
+        )
+        for stage_name, n_runs in n_stage_runs.items():
+            logger.info(
+                "Ran %s stage %d times (%d without sharing)",
+                stage_name,
+                n_runs,
+                n_combos * len(frame_refs),
+            )
+    columns = ["frame", "rel_filepath", *sweep.param_grid, *sweep.RESULT_COLUMNS]
+    return pd.DataFrame(all_rows, columns=columns)
+
+
+def get_command_line_options(args=None):
+    """Return the command line options given an (optional) list of args
+
+    Args:
+        args: a list of arguments to pass to the parser instead of using sys.argv
+
+    Returns: A namespace of parsed arguments
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "input_location",
+        type=pathlib.Path,
+        help="A directory of .bmp frames, or a frame stack .npy file, to analyze",
+    )
+    parser.add_argument(
+        "output_file",
+        type=pathlib.Path,
+        help="Path to the .csv file that should hold the table of results",
+    )
+    param_types = {
+        "blur_kernel": int,
+        "area_cutoff": int,
+        "arc_fraction": float,
+        "min_radius": float,
+        "max_radius": float,
+    }
+    for name, default in ParameterSweep.DEF_PARAMS.items():
+        parser.add_argument(
+            f"--{name}",
+            type=param_types[name],
+            nargs="+",
+            default=[default],
+            help=f"Value(s) of {name} to try (default = {default})",
+        )
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        default=1,
+        help="The number of parallel processes to use (default = 1)",
+    )
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    "Run a parameter sweep from the command line"
+    options = get_command_line_options(args)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(name)s %(asctime)s] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    logger = logging.getLogger("ParameterSweep")
+    param_grid = {name: getattr(options, name) for name in ParameterSweep.DEF_PARAMS}
+    results = run_parameter_sweep(
+        options.input_location,
+        param_grid,
+        n_workers=options.n_workers,
+        logger=logger,
+    )
+    options.output_file.parent.mkdir(parents=True, exist_ok=True)
+    results.to_csv(options.output_file, index=False)
+    logger.info("Wrote %d results to %s", results.shape[0], options.output_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,450 @@
+"""Re-run the flyer analysis on frames that are already stored in the database
+
+Raw camera frames are read back out of the flyer images table with a server-side
+cursor, re-analyzed in a pool of processes, and their results and analysis images are
+updated in place in batched transactions (along with the summaries of their videos).
+Progress is checkpointed to a file so that interrupted backfills can be resumed. No
+Kafka replay is needed.
+
+Typical usage:
+    FlyerReanalysisBackfill [connection_string] --exit_codes 5 7 --start_date 2023-01-01
+"""
+
+# imports
+import os
+import json
+import pathlib
+import datetime
+import logging
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from sqlalchemy import create_engine, select, update, and_
+from sqlalchemy.orm import Session
+from .metadata_link_entry import MetadataLinkEntry
+from .flyer_analysis_entry import FlyerAnalysisEntry
+from .flyer_image_entry import FlyerImageEntry
+from .video_summaries import create_video_summary_tables, rebuild_video_summaries
+from .flyer_detection_core import FlyerDetectionCore, STREAM_ANALYSIS_KWARGS
+from .image_store import get_image_store
+from .bulk_insert import get_engine_kwargs
+
+
+class FlyerReanalysisBackfill:
+    """Re-analyzes frames stored in the flyer images table and updates their results
+
+    Args:
+        db_connection_str: SQLAlchemy connection string for the database to backfill
+        checkpoint_file: path to a JSON file used to record progress. If it exists,
+            frames that were already re-analyzed are skipped.
+        exit_codes: only re-analyze frames whose current result has one of these exit codes
+        start_date: only re-analyze frames from videos on or after this date
+        end_date: only re-analyze frames from videos on or before this date
+        metadata_link_ids: only re-analyze frames linked to these metadata_links IDs
+        n_workers: the number of processes to use for the analysis
+            (default is the number of CPUs)
+        batch_size: the number of frames to read, analyze, and update at once
+        image_store: where images are kept if they're not stored inline in the
+            database (a string accepted by image_store.get_image_store)
+        verbose: if True, a verbose SQLAlchemy engine will be created
+
+    Raises:
+        ValueError: connecting to the database failed, or the checkpoint file was
+            written by a backfill with different filters
+    """
+
+    DEF_BATCH_SIZE = 200
+    # The columns of the analysis results table that are updated
+    RESULT_COLUMNS = (
+        "exit_code",
+        "radius",
+        "tilt",
+        "leading_row",
+        "center_row",
+        "center_column",
+    )
+
+    def __init__(
+        self,
+        db_connection_str,
+        *,
+        checkpoint_file=None,
+        exit_codes=None,
+        start_date=None,
+        end_date=None,
+        metadata_link_ids=None,
+        n_workers=None,
+        batch_size=DEF_BATCH_SIZE,
+        image_store=None,
+        verbose=False,
+        logger=None,
+    ):
+        self.logger = (
+            logger if logger is not None else logging.getLogger(self.__class__.__name__)
+        )
+        try:
+            self.engine = create_engine(
+                db_connection_str, echo=verbose, **get_engine_kwargs(db_connection_str)
+            )
+        except Exception as exc:
+            errmsg = (
+                "ERROR: failed to connect to database using connection string "
+                f"{db_connection_str}!"
+            )
+            self.logger.error(errmsg, exc_info=exc)
+            raise ValueError(errmsg) from exc
+        self.checkpoint_file = (
+            pathlib.Path(checkpoint_file) if checkpoint_file is not None else None
+        )
+        self.exit_codes = exit_codes
+        self.start_date = start_date
+        self.end_date = end_date
+        self.metadata_link_ids = metadata_link_ids
+        self.n_workers = n_workers
+        self.batch_size = batch_size
+        self.image_store = image_store
+        self.last_image_id = 0
+        self.n_reanalyzed = 0
+        self.failed_image_ids = []
+        if self.checkpoint_file is not None and self.checkpoint_file.is_file():
+            with open(self.checkpoint_file, "r") as checkpoint:
+                checkpoint_dict = json.load(checkpoint)
+            if checkpoint_dict["filters"] != self.filters:
+                errmsg = (
+                    f"ERROR: checkpoint file {self.checkpoint_file} was written by a "
+                    f"backfill with filters {checkpoint_dict['filters']}, which don't "
+                    f"match the current filters {self.filters}. Use a different "
+                    "checkpoint file or remove it to start over."
+                )
+                self.logger.error(errmsg)
+                raise ValueError(errmsg)
+            self.last_image_id = checkpoint_dict["last_image_ID"]
+            self.n_reanalyzed = checkpoint_dict["n_reanalyzed"]
+            self.failed_image_ids = checkpoint_dict.get("failed_image_IDs", [])
+            self.logger.info(
+                "Resuming from checkpoint in %s (%d frames already re-analyzed)",
+                self.checkpoint_file,
+                self.n_reanalyzed,
+            )
+
+    @property
+    def filters(self):
+        "A JSON-serializable dictionary of the filters on which frames to re-analyze"
+        return {
+            "exit_codes": self.exit_codes,
+            "start_date": self.start_date.isoformat() if self.start_date else None,
+            "end_date": self.end_date.isoformat() if self.end_date else None,
+            "metadata_link_ids": self.metadata_link_ids,
+        }
+
+    def get_query(self):
+        "Return the query for all of the frames that still need to be re-analyzed"
+        conditions = [FlyerImageEntry.ID > self.last_image_id]
+        if self.exit_codes:
+            conditions.append(FlyerAnalysisEntry.exit_code.in_(self.exit_codes))
+        if self.metadata_link_ids:
+            conditions.append(
+                FlyerAnalysisEntry.metadata_link_ID.in_(self.metadata_link_ids)
+            )
+        if self.start_date is not None:
+            conditions.append(MetadataLinkEntry.datestamp >= self.start_date)
+        if self.end_date is not None:
+            conditions.append(MetadataLinkEntry.datestamp <= self.end_date)
+        return (
+            select(
+                FlyerImageEntry.ID,
+                FlyerImageEntry.analysis_result_ID,
+                FlyerAnalysisEntry.metadata_link_ID,
+                FlyerAnalysisEntry.rel_filepath,
+                FlyerImageEntry.camera_image,
+                FlyerImageEntry.camera_image_key,
+                FlyerImageEntry.camera_image_checksum,
+            )
+            .join(
+                FlyerAnalysisEntry,
+                FlyerImageEntry.analysis_result_ID == FlyerAnalysisEntry.ID,
+            )
+            .outerjoin(
+                MetadataLinkEntry,
+                FlyerAnalysisEntry.metadata_link_ID == MetadataLinkEntry.ID,
+            )
+            .where(and_(*conditions))
+            .order_by(FlyerImageEntry.ID)
+        )
+
+    def run(self):
+        """Re-analyze every frame matching the filters, updating results in batches
+
+        Frames that can't be re-analyzed (for example, if their camera image can't be
+        read from the image store) are logged and skipped, leaving their current
+        results in place. Their IDs are listed in failed_image_ids.
+
+        Returns: the total number of frames re-analyzed (including any from before
+            resuming from a checkpoint)
+        """
+        if self.engine.dialect.name == "sqlite":
+            # let the streaming reads and the batched writes happen at the same time
+            with self.engine.connect() as conn:
+                conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+        create_video_summary_tables(self.engine)
+        added = FlyerImageEntry.add_missing_columns(self.engine)
+        if len(added) > 0:
+            self.logger.info(
+                "Added columns %s to the %s table",
+                ", ".join(added),
+                FlyerImageEntry.__tablename__,
+            )
+        stmt = self.get_query()
+        with self.engine.connect() as read_conn, ProcessPoolExecutor(
+            max_workers=self.n_workers
+        ) as executor:
+            rows = read_conn.execution_options(
+                stream_results=True, yield_per=self.batch_size
+            ).execute(stmt)
+            for batch in rows.partitions():
+                frames = [
+                    (
+                        row.ID,
+                        row.analysis_result_ID,
+                        row.rel_filepath,
+                        row.camera_image,
+                        row.camera_image_key,
+                        row.camera_image_checksum,
+                        self.image_store,
+                    )
+                    for row in batch
+                ]
+                futures = [
+                    (row, executor.submit(_reanalyze_frame, frame))
+                    for row, frame in zip(batch, frames)
+                ]
+                updates = []
+                metadata_link_ids = set()
+                for row, future in futures:
+                    try:
+                        updates.append(future.result())
+                    except Exception as exc:
+                        # leave the frame's current result in place and move on
+                        self.failed_image_ids.append(row.ID)
+                        self.logger.error(
+                            "Failed to re-analyze flyer_images ID %d",
+                            row.ID,
+                            exc_info=exc,
+                        )
+                        continue
+                    if row.metadata_link_ID is not None:
+                        metadata_link_ids.add(row.metadata_link_ID)
+                if len(updates) > 0:
+                    self.__write_updates(updates, metadata_link_ids)
+                self.last_image_id = batch[-1].ID
+                self.n_reanalyzed += len(updates)
+                self.__write_checkpoint()
+                self.logger.info(
+                    "Re-analyzed %d frames (through flyer_images ID %d)",
+                    self.n_reanalyzed,
+                    self.last_image_id,
+                )
+        self.engine.dispose()
+        if len(self.failed_image_ids) > 0:
+            self.logger.warning(
+                "%d frames failed to be re-analyzed and were skipped "
+                "(flyer_images IDs %s)",
+                len(self.failed_image_ids),
+                ", ".join(str(image_id) for image_id in self.failed_image_ids),
+            )
+        return self.n_reanalyzed
+
+    def __write_updates(self, updates, metadata_link_ids):
+        """Bulk update the results and analysis images for a batch, and rebuild the
+        summaries of the videos they're in, in one transaction
+        """
+        with Session(self.engine) as session:
+            session.execute(
+                update(FlyerAnalysisEntry), [result for result, _ in updates]
+            )
+            session.execute(update(FlyerImageEntry), [image for _, image in updates])
+            if len(metadata_link_ids) > 0:
+                rebuild_video_summaries(session.connection(), metadata_link_ids)
+            session.commit()
+
+    def __write_checkpoint(self):
+        if self.checkpoint_file is None:
+            return
+        self.checkpoint_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.checkpoint_file.with_name(f"{self.checkpoint_file.name}.tmp")
+        with open(tmp_path, "w") as checkpoint:
+            json.dump(
+                {
+                    "last_image_ID": self.last_image_id,
+                    "n_reanalyzed": self.n_reanalyzed,
+                    "failed_image_IDs": self.failed_image_ids,
+                    "filters": self.filters,
+                },
+                checkpoint,
+            )
+        os.replace(tmp_path, self.checkpoint_file)
+
+    @classmethod
+    def get_command_line_options(cls, args=None):
+        """Return the command line options given an (optional) list of args
+
+        Args:
+            args: a list of arguments to pass to the parser instead of using sys.argv
+
+        Returns: A namespace of parsed arguments
+        """
+
+        def date(date_str):
+            return datetime.datetime.strptime(date_str, "%Y-%m-%d")
+
+        parser = ArgumentParser()
+        parser.add_argument(
+            "db_connection_str",
+            help="The SQLAlchemy connection string for the database to backfill",
+        )
+        parser.add_argument(
+            "--checkpoint_file",
+            type=pathlib.Path,
+            default=pathlib.Path("./flyer_reanalysis_checkpoint.json"),
+            help=(
+                "Path to a file used to record progress, so that interrupted "
+                "backfills can be resumed (default = ./flyer_reanalysis_checkpoint.json)"
+            ),
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Add this flag to ignore any existing checkpoint and start over",
+        )
+        parser.add_argument(
+            "--exit_codes",
+            type=int,
+            nargs="+",
+            help="Only re-analyze frames whose current results have these exit codes",
+        )
+        parser.add_argument(
+            "--start_date",
+            type=date,
+            help="Only re-analyze frames from videos on or after this date (YYYY-MM-DD)",
+        )
+        parser.add_argument(
+            "--end_date",
+            type=date,
+            help="Only re-analyze frames from videos on or before this date (YYYY-MM-DD)",
+        )
+        parser.add_argument(
+            "--metadata_link_ids",
+            type=int,
+            nargs="+",
+            help="Only re-analyze frames linked to these metadata_links IDs",
+        )
+        parser.add_argument(
+            "--n_workers",
+            type=int,
+            default=None,
+            help="The number of processes to use (default = number of CPUs)",
+        )
+        parser.add_argument(
+            "--batch_size",
+            type=int,
+            default=cls.DEF_BATCH_SIZE,
+            help=(
+                "The number of frames to read and update in each transaction "
+                f"(default = {cls.DEF_BATCH_SIZE})"
+            ),
+        )
+        parser.add_argument(
+            "--image_store",
+            help=(
+                "Where images are kept if they're not stored inline in the database: "
+                'a path to a local/shared directory, or an "s3://bucket/prefix" URL'
+            ),
+        )
+        parser.add_argument(
+            "--verbose",
+            action="store_true",
+            help="Add this flag to use a verbose SQLAlchemy engine",
+        )
+        return parser.parse_args(args)
+
+
+def _reanalyze_frame(frame):
+    """Analyze a single stored frame (in a worker process). Returns dictionaries of
+    values to update in the analysis results and flyer images tables.
+    """
+    (
+        image_id,
+        result_id,
+        rel_filepath,
+        camera_image,
+        camera_image_key,
+        camera_image_checksum,
+        image_store_spec,
+    ) = frame
+    image_store = _get_worker_image_store(image_store_spec)
+    if camera_image is None and camera_image_key is not None:
+        if image_store is None:
+            raise ValueError(
+                f"ERROR: the camera image for flyer image {image_id} is kept in an "
+                "image store, but no image store was given to read it from!"
+            )
+        camera_image = image_store.get(camera_image_key, checksum=camera_image_checksum)
+    result, _ = FlyerDetectionCore().analyze_frame(
+        pathlib.Path(rel_filepath),
+        None,
+        frame_bytes=camera_image,
+        **STREAM_ANALYSIS_KWARGS,
+    )
+    entry = FlyerAnalysisEntry.from_id_and_result(None, result)
+    result_values = {"ID": result_id}
+    for column in FlyerReanalysisBackfill.RESULT_COLUMNS:
+        result_values[column] = getattr(entry, column)
+    image_values = {
+        "ID": image_id,
+        **FlyerImageEntry.get_image_column_values(
+            "analysis_image",
+            FlyerImageEntry.encode_analysis_image(result),
+            image_store,
+        ),
+    }
+    return result_values, image_values
+
+
+@lru_cache(maxsize=None)
+def _get_worker_image_store(image_store_spec):
+    "Return the image store to use in a worker process (one per process)"
+    return get_image_store(image_store_spec)
+
+
+def main(args=None):
+    "Run a reanalysis backfill from the command line"
+    options = FlyerReanalysisBackfill.get_command_line_options(args)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(name)s %(asctime)s] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    if options.restart and options.checkpoint_file.is_file():
+        options.checkpoint_file.unlink()
+    backfill = FlyerReanalysisBackfill(
+        options.db_connection_str,
+        checkpoint_file=options.checkpoint_file,
+        exit_codes=options.exit_codes,
+        start_date=options.start_date,
+        end_date=options.end_date,
+        metadata_link_ids=options.metadata_link_ids,
+        n_workers=options.n_workers,
+        batch_size=options.batch_size,
+        image_store=options.image_store,
+        verbose=options.verbose,
+    )
+    n_reanalyzed = backfill.run()
+    backfill.logger.info(
+        "Done! %d total frames re-analyzed (%d failed)",
+        n_reanalyzed,
+        len(backfill.failed_image_ids),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,476 @@
+"""Export flyer analysis results (and optionally their images) from the database to files
+
+Results are joined to their metadata_links entries and read in fixed-size chunks with
+a server-side cursor, so exports of any size run in bounded memory. Each chunk of
+results is written to its own Parquet file in a "results" directory (so the directory
+can be read as a single partitioned dataset). Camera and/or analysis images can also
+be decoded (in a pool of threads) and written as image stacks, either to a chunked,
+compressed HDF5 file or to one compressed .npz file per chunk. Each result's row in
+the image stacks is recorded in its "camera_image_index"/"analysis_image_index" column.
+
+Writing Parquet files requires pyarrow, and writing HDF5 files requires h5py.
+
+Typical usage:
+    python -m flyeranalysis.results_export [connection_string] [output_dir] --camera_images
+"""
+
+# imports
+import os
+import pathlib
+import datetime
+import logging
+from io import BytesIO
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from sqlalchemy import create_engine, select, and_
+from .metadata_link_entry import MetadataLinkEntry
+from .flyer_analysis_entry import FlyerAnalysisEntry
+from .flyer_image_entry import FlyerImageEntry
+from .image_store import get_image_store
+from .bulk_insert import get_engine_kwargs
+
+
+class ResultsExporter:
+    """Exports flyer analysis results and images from the database in chunks
+
+    Args:
+        db_connection_str: SQLAlchemy connection string for the database to export from
+        output_dir: path to the directory to write the exported files in
+        exit_codes: only export results with one of these exit codes
+        start_date: only export results from videos on or after this date
+        end_date: only export results from videos on or before this date
+        metadata_link_ids: only export results linked to these metadata_links IDs
+        camera_images: if True, export the raw camera frames as an image stack
+        analysis_images: if True, export the (redrawn) analysis images as an image stack
+        image_format: "hdf5" to write each image stack to a single chunked, compressed
+            HDF5 file, or "npz" to write one compressed .npz file per chunk
+        chunk_size: the number of results to read and write at once (at most this many
+            decoded images are held in memory)
+        n_threads: the number of threads to use for decoding images
+            (default is the number of CPUs)
+        image_store: where images are kept if they're not stored inline in the
+            database (a string accepted by image_store.get_image_store)
+        verbose: if True, a verbose SQLAlchemy engine will be created
+
+    Raises:
+        ValueError: connecting to the database failed, or the image format is unknown
+    """
+
+    DEF_CHUNK_SIZE = 1000
+    IMAGE_FORMATS = ("hdf5", "npz")
+    # gzip compression level for image stacks in HDF5 files
+    HDF5_COMPRESSION_LEVEL = 4
+    RESULTS_DIRNAME = "results"
+    # The columns of the analysis results and metadata links tables that are exported
+    RESULT_COLUMNS = (
+        "ID",
+        "metadata_link_ID",
+        "rel_filepath",
+        "exit_code",
+        "radius",
+        "tilt",
+        "leading_row",
+        "center_row",
+        "center_column",
+    )
+    METADATA_LINK_COLUMNS = ("datestamp", "experiment_day_counter", "camera_filename")
+
+    def __init__(
+        self,
+        db_connection_str,
+        output_dir,
+        *,
+        exit_codes=None,
+        start_date=None,
+        end_date=None,
+        metadata_link_ids=None,
+        camera_images=False,
+        analysis_images=False,
+        image_format="hdf5",
+        chunk_size=DEF_CHUNK_SIZE,
+        n_threads=None,
+        image_store=None,
+        verbose=False,
+        logger=None,
+    ):
+        self.logger = (
+            logger if logger is not None else logging.getLogger(self.__class__.__name__)
+        )
+        if image_format not in self.IMAGE_FORMATS:
+            errmsg = (
+                f"ERROR: unknown image format {image_format} "
+                f"(expected one of {', '.join(self.IMAGE_FORMATS)})"
+            )
+            self.logger.error(errmsg)
+            raise ValueError(errmsg)
+        try:
+            self.engine = create_engine(
+                db_connection_str, echo=verbose, **get_engine_kwargs(db_connection_str)
+            )
+        except Exception as exc:
+            errmsg = (
+                "ERROR: failed to connect to database using connection string "
+                f"{db_connection_str}!"
+            )
+            self.logger.error(errmsg, exc_info=exc)
+            raise ValueError(errmsg) from exc
+        self.output_dir = pathlib.Path(output_dir)
+        self.exit_codes = exit_codes
+        self.start_date = start_date
+        self.end_date = end_date
+        self.metadata_link_ids = metadata_link_ids
+        self.image_columns = []
+        if camera_images:
+            self.image_columns.append("camera_image")
+        if analysis_images:
+            self.image_columns.append("analysis_image")
+        self.image_format = image_format
+        self.chunk_size = chunk_size
+        self.n_threads = n_threads if n_threads is not None else os.cpu_count()
+        self.image_store = get_image_store(image_store)
+        self.n_exported = 0
+        self.n_images_exported = {column: 0 for column in self.image_columns}
+
+    def get_query(self):
+        "Return the query for all of the results (and images) to export"
+        conditions = []
+        if self.exit_codes:
+            conditions.append(FlyerAnalysisEntry.exit_code.in_(self.exit_codes))
+        if self.metadata_link_ids:
+            conditions.append(
+                FlyerAnalysisEntry.metadata_link_ID.in_(self.metadata_link_ids)
+            )
+        if self.start_date is not None:
+            conditions.append(MetadataLinkEntry.datestamp >= self.start_date)
+        if self.end_date is not None:
+            conditions.append(MetadataLinkEntry.datestamp <= self.end_date)
+        columns = [getattr(FlyerAnalysisEntry, name) for name in self.RESULT_COLUMNS]
+        columns += [
+            getattr(MetadataLinkEntry, name) for name in self.METADATA_LINK_COLUMNS
+        ]
+        for image_column in self.image_columns:
+            columns += [
+                getattr(FlyerImageEntry, image_column),
+                getattr(FlyerImageEntry, f"{image_column}_key"),
+                getattr(FlyerImageEntry, f"{image_column}_checksum"),
+            ]
+        stmt = select(*columns).outerjoin(
+            MetadataLinkEntry,
+            FlyerAnalysisEntry.metadata_link_ID == MetadataLinkEntry.ID,
+        )
+        if self.image_columns:
+            stmt = stmt.outerjoin(
+                FlyerImageEntry,
+                FlyerImageEntry.analysis_result_ID == FlyerAnalysisEntry.ID,
+            )
+        return stmt.where(and_(*conditions)).order_by(FlyerAnalysisEntry.ID)
+
+    def run(self):
+        """Export every result matching the filters, one chunk at a time
+
+        Returns: the number of results exported
+        """
+        pa, pq = _import_pyarrow()
+        h5py = (
+            _import_h5py()
+            if self.image_columns and self.image_format == "hdf5"
+            else None
+        )
+        results_dir = self.output_dir / self.RESULTS_DIRNAME
+        results_dir.mkdir(parents=True, exist_ok=True)
+        schema = self.__get_results_schema(pa)
+        h5_files = {}
+        try:
+            if h5py is not None:
+                for image_column in self.image_columns:
+                    h5_files[image_column] = h5py.File(
+                        self.output_dir / f"{image_column}s.h5", "w"
+                    )
+            with self.engine.connect() as conn, ThreadPoolExecutor(
+                max_workers=self.n_threads
+            ) as executor:
+                rows = conn.execution_options(
+                    stream_results=True, yield_per=self.chunk_size
+                ).execute(self.get_query())
+                for ichunk, chunk in enumerate(rows.partitions()):
+                    columns = {
+                        name: [getattr(row, name) for row in chunk]
+                        for name in self.RESULT_COLUMNS + self.METADATA_LINK_COLUMNS
+                    }
+                    for image_column in self.image_columns:
+                        images = list(
+                            executor.map(
+                                lambda row, col=image_column: self.__decode_image(
+                                    row, col
+                                ),
+                                chunk,
+                            )
+                        )
+                        columns[f"{image_column}_index"] = self.__write_images(
+                            image_column,
+                            images,
+                            columns["ID"],
+                            ichunk,
+                            h5_files.get(image_column),
+                        )
+                    pq.write_table(
+                        pa.Table.from_pydict(columns, schema=schema),
+                        results_dir / f"part-{ichunk:05d}.parquet",
+                    )
+                    self.n_exported += len(chunk)
+                    self.logger.info("Exported %d results", self.n_exported)
+        finally:
+            for h5_file in h5_files.values():
+                h5_file.close()
+            self.engine.dispose()
+        return self.n_exported
+
+    def __get_results_schema(self, pa):
+        "Return the pyarrow schema for the Parquet files of results"
+        fields = [
+            ("ID", pa.int64()),
+            ("metadata_link_ID", pa.int64()),
+            ("rel_filepath", pa.string()),
+            ("exit_code", pa.int16()),
+            ("radius", pa.float64()),
+            ("tilt", pa.float64()),
+            ("leading_row", pa.int32()),
+            ("center_row", pa.float64()),
+            ("center_column", pa.float64()),
+            ("datestamp", pa.timestamp("us")),
+            ("experiment_day_counter", pa.int64()),
+            ("camera_filename", pa.string()),
+        ]
+        fields += [(f"{column}_index", pa.int64()) for column in self.image_columns]
+        return pa.schema(fields)
+
+    def __decode_image(self, row, image_column):
+        "Return one of the images for a row as an array (None if it doesn't have one)"
+        data = getattr(row, image_column)
+        key = getattr(row, f"{image_column}_key")
+        if data is None and key is not None:
+            if self.image_store is None:
+                raise ValueError(
+                    f"ERROR: the {image_column} for result {row.ID} is kept in an "
+                    "image store, but no image store was given to read it from!"
+                )
+            data = self.image_store.get(
+                key, checksum=getattr(row, f"{image_column}_checksum")
+            )
+        if data is None:
+            return None
+        if image_column == "analysis_image":
+            return FlyerImageEntry.decode_analysis_image(data)
+        return np.asarray(Image.open(BytesIO(data)))
+
+    def __write_images(self, image_column, images, result_ids, ichunk, h5_file):
+        """Add a chunk of images to an image stack, and return a list of the row each
+        image was written to (None for rows without an image)
+        """
+        indices = []
+        stack = []
+        for image in images:
+            if image is None:
+                indices.append(None)
+                continue
+            indices.append(self.n_images_exported[image_column] + len(stack))
+            stack.append(image)
+        if len(stack) < 1:
+            return indices
+        first_shape = stack[0].shape
+        if h5_file is not None and "images" in h5_file:
+            first_shape = h5_file["images"].shape[1:]
+        for image in stack:
+            if image.shape != first_shape:
+                raise ValueError(
+                    f"ERROR: {image_column}s with different shapes ({first_shape} and "
+                    f"{image.shape}) can't be exported to the same image stack!"
+                )
+        stack = np.stack(stack)
+        stack_ids = np.array(
+            [rid for rid, index in zip(result_ids, indices) if index is not None],
+            dtype=np.int64,
+        )
+        if h5_file is None:
+            stack_dir = self.output_dir / f"{image_column}s"
+            stack_dir.mkdir(parents=True, exist_ok=True)
+            np.savez_compressed(
+                stack_dir / f"part-{ichunk:05d}.npz",
+                images=stack,
+                result_ID=stack_ids,
+                first_index=self.n_images_exported[image_column],
+            )
+        else:
+            if "images" not in h5_file:
+                h5_file.create_dataset(
+                    "images",
+                    shape=(0, *stack.shape[1:]),
+                    maxshape=(None, *stack.shape[1:]),
+                    dtype=stack.dtype,
+                    chunks=(1, *stack.shape[1:]),
+                    compression="gzip",
+                    compression_opts=self.HDF5_COMPRESSION_LEVEL,
+                )
+                h5_file.create_dataset(
+                    "result_ID", shape=(0,), maxshape=(None,), dtype=np.int64
+                )
+            start = h5_file["images"].shape[0]
+            for name, values in (("images", stack), ("result_ID", stack_ids)):
+                h5_file[name].resize(start + len(stack), axis=0)
+                h5_file[name][start:] = values
+        self.n_images_exported[image_column] += len(stack)
+        return indices
+
+    @classmethod
+    def get_command_line_options(cls, args=None):
+        """Return the command line options given an (optional) list of args
+
+        Args:
+            args: a list of arguments to pass to the parser instead of using sys.argv
+
+        Returns: A namespace of parsed arguments
+        """
+
+        def date(date_str):
+            return datetime.datetime.strptime(date_str, "%Y-%m-%d")
+
+        parser = ArgumentParser()
+        parser.add_argument(
+            "db_connection_str",
+            help="The SQLAlchemy connection string for the database to export from",
+        )
+        parser.add_argument(
+            "output_dir",
+            type=pathlib.Path,
+            help="Path to the directory to write the exported files in",
+        )
+        parser.add_argument(
+            "--camera_images",
+            action="store_true",
+            help="Add this flag to export the raw camera frames as an image stack",
+        )
+        parser.add_argument(
+            "--analysis_images",
+            action="store_true",
+            help="Add this flag to export the analysis images as an image stack",
+        )
+        parser.add_argument(
+            "--image_format",
+            choices=cls.IMAGE_FORMATS,
+            default="hdf5",
+            help=(
+                "The format to write image stacks in: a single chunked, compressed "
+                "HDF5 file per stack, or a compressed .npz file per chunk "
+                "(default = hdf5)"
+            ),
+        )
+        parser.add_argument(
+            "--exit_codes",
+            type=int,
+            nargs="+",
+            help="Only export results with these exit codes",
+        )
+        parser.add_argument(
+            "--start_date",
+            type=date,
+            help="Only export results from videos on or after this date (YYYY-MM-DD)",
+        )
+        parser.add_argument(
+            "--end_date",
+            type=date,
+            help="Only export results from videos on or before this date (YYYY-MM-DD)",
+        )
+        parser.add_argument(
+            "--metadata_link_ids",
+            type=int,
+            nargs="+",
+            help="Only export results linked to these metadata_links IDs",
+        )
+        parser.add_argument(
+            "--chunk_size",
+            type=int,
+            default=cls.DEF_CHUNK_SIZE,
+            help=(
+                "The number of results to read and write at once "
+                f"(default = {cls.DEF_CHUNK_SIZE})"
+            ),
+        )
+        parser.add_argument(
+            "--n_threads",
+            type=int,
+            default=None,
+            help="The number of threads to decode images with (default = number of CPUs)",
+        )
+        parser.add_argument(
+            "--image_store",
+            help=(
+                "Where images are kept if they're not stored inline in the database: "
+                'a path to a local/shared directory, or an "s3://bucket/prefix" URL'
+            ),
+        )
+        parser.add_argument(
+            "--verbose",
+            action="store_true",
+            help="Add this flag to use a verbose SQLAlchemy engine",
+        )
+        return parser.parse_args(args)
+
+
+def _import_pyarrow():
+    "Return the pyarrow and pyarrow.parquet modules"
+    try:
+        import pyarrow  # pylint: disable=import-outside-toplevel
+        import pyarrow.parquet  # pylint: disable=import-outside-toplevel
+    except ImportError as exc:
+        raise ImportError(
+            "ERROR: pyarrow is needed to export results to Parquet files. "
+            "You can install it with 'pip install flyeranalysis[export]'."
+        ) from exc
+    return pyarrow, pyarrow.parquet
+
+
+def _import_h5py():
+    "Return the h5py module"
+    try:
+        import h5py  # pylint: disable=import-outside-toplevel
+    except ImportError as exc:
+        raise ImportError(
+            "ERROR: h5py is needed to export images to HDF5 files. You can install "
+            "it with 'pip install flyeranalysis[export]' (or use --image_format npz)."
+        ) from exc
+    return h5py
+
+
+def main(args=None):
+    "Run an export from the command line"
+    options = ResultsExporter.get_command_line_options(args)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(name)s %(asctime)s] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    exporter = ResultsExporter(
+        options.db_connection_str,
+        options.output_dir,
+        exit_codes=options.exit_codes,
+        start_date=options.start_date,
+        end_date=options.end_date,
+        metadata_link_ids=options.metadata_link_ids,
+        camera_images=options.camera_images,
+        analysis_images=options.analysis_images,
+        image_format=options.image_format,
+        chunk_size=options.chunk_size,
+        n_threads=options.n_threads,
+        image_store=options.image_store,
+        verbose=options.verbose,
+    )
+    n_exported = exporter.run()
+    exporter.logger.info(
+        "Done! %d results exported to %s", n_exported, options.output_dir
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""A low-overhead profiler for a sample of the frames processed by a program
+
+Only a sample of frames is profiled: either every Nth frame, or every frame processed
+during the first N seconds. While a sampled frame is being processed:
+
+    - it is profiled deterministically with cProfile (one frame at a time across all
+      threads, since only one cProfile profiler can be active at once in newer
+      Python versions), and
+    - a background thread periodically samples the call stack of every thread that's
+      processing a sampled frame.
+
+When the profiler is closed it writes the merged cProfile statistics (a .pstats file
+and a plain-text summary) and the sampled stacks in the "collapsed" format used by
+flame graph tools (flamegraph.pl, speedscope, etc.) to its output directory.
+"""
+
+# imports
+import io
+import os
+import sys
+import time
+import pstats
+import pathlib
+import cProfile
+import threading
+from collections import Counter
+
+
+class SamplingProfiler:
+    """Profiles a sample of the calls made through profile_frame
+
+    Args:
+        output_dir: the directory the profile output files should be written to
+        every_n_frames: profile every Nth frame (default is every 10th frame, unless
+            first_n_seconds is given)
+        first_n_seconds: profile every frame processed within this many seconds of the
+            first frame (and none after)
+        sample_interval: seconds between samples of the call stacks
+
+    Raises:
+        ValueError: both every_n_frames and first_n_seconds were given
+    """
+
+    DEF_EVERY_N_FRAMES = 10
+    DEF_SAMPLE_INTERVAL = 0.005
+    PSTATS_FILENAME = "profile.pstats"
+    SUMMARY_FILENAME = "profile_summary.txt"
+    COLLAPSED_FILENAME = "profile_stacks.collapsed"
+
+    def __init__(
+        self,
+        output_dir,
+        *,
+        every_n_frames=None,
+        first_n_seconds=None,
+        sample_interval=DEF_SAMPLE_INTERVAL,
+    ):
+        if every_n_frames is not None and first_n_seconds is not None:
+            raise ValueError(
+                "ERROR: only one of every_n_frames and first_n_seconds can be given!"
+            )
+        if every_n_frames is None and first_n_seconds is None:
+            every_n_frames = self.DEF_EVERY_N_FRAMES
+        self.output_dir = pathlib.Path(output_dir)
+        self.every_n_frames = every_n_frames
+        self.first_n_seconds = first_n_seconds
+        self.sample_interval = sample_interval
+        self.n_frames = 0
+        self.n_sampled_frames = 0
+        self.n_stack_samples = 0
+        self.__start_time = None
+        self.__lock = threading.Lock()
+        self.__cprofile_lock = threading.Lock()
+        self.__profiles = []
+        self.__stacks = Counter()
+        # the number of sampled frames each thread is currently processing
+        self.__active_threads = Counter()
+        self.__stop_event = threading.Event()
+        self.__sampler_thread = threading.Thread(
+            target=self.__sample_stacks, daemon=True
+        )
+        self.__sampler_thread.start()
+
+    def profile_frame(self, func, *args, **kwargs):
+        """Return the result of calling func(*args, **kwargs) to process one frame,
+        profiling the call if the frame is part of the sample
+        """
+        if not self.__is_sampled():
+            return func(*args, **kwargs)
+        ident = threading.get_ident()
+        with self.__lock:
+            self.n_sampled_frames += 1
+            self.__active_threads[ident] += 1
+        profile = None
+        if self.__cprofile_lock.acquire(blocking=False):
+            profile = cProfile.Profile()
+        try:
+            if profile is None:
+                return func(*args, **kwargs)
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            if profile is not None:
+                self.__cprofile_lock.release()
+            with self.__lock:
+                if profile is not None:
+                    self.__profiles.append(profile)
+                self.__active_threads[ident] -= 1
+                if self.__active_threads[ident] <= 0:
+                    del self.__active_threads[ident]
+
+    def write(self):
+        """Write the profile output files to the output directory
+
+        Returns: a list of the paths to the files that were written
+        """
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        written = []
+        with self.__lock:
+            profiles = list(self.__profiles)
+            stacks = self.__stacks.copy()
+        if profiles:
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            pstats_path = self.output_dir / self.PSTATS_FILENAME
+            stats.dump_stats(pstats_path)
+            summary = io.StringIO()
+            pstats.Stats(str(pstats_path), stream=summary).sort_stats(
+                "cumulative"
+            ).print_stats(50)
+            summary_path = self.output_dir / self.SUMMARY_FILENAME
+            with open(summary_path, "w") as fp:
+                fp.write(
+                    f"{self.n_sampled_frames} of {self.n_frames} frames sampled, "
+                    f"{len(profiles)} profiled with cProfile, "
+                    f"{self.n_stack_samples} stack samples\n"
+                )
+                fp.write(summary.getvalue())
+            written += [pstats_path, summary_path]
+        if stacks:
+            collapsed_path = self.output_dir / self.COLLAPSED_FILENAME
+            with open(collapsed_path, "w") as fp:
+                for stack, n in stacks.most_common():
+                    fp.write(f"{stack} {n}\n")
+            written.append(collapsed_path)
+        return written
+
+    def close(self):
+        """Stop sampling stacks and write the profile output files
+
+        Returns: a list of the paths to the files that were written
+        """
+        self.__stop_event.set()
+        self.__sampler_thread.join()
+        return self.write()
+
+    def __is_sampled(self):
+        "Return True if the next frame should be profiled"
+        with self.__lock:
+            self.n_frames += 1
+            if self.__start_time is None:
+                self.__start_time = time.monotonic()
+            if self.first_n_seconds is not None:
+                return time.monotonic() - self.__start_time <= self.first_n_seconds
+            return (self.n_frames - 1) % self.every_n_frames == 0
+
+    def __sample_stacks(self):
+        "Periodically record the call stacks of threads processing sampled frames"
+        sampler_ident = threading.get_ident()
+        while not self.__stop_event.wait(self.sample_interval):
+            with self.__lock:
+                active = [i for i in self.__active_threads if i != sampler_ident]
+            if not active:
+                continue
+            frames = sys._current_frames()  # pylint: disable=protected-access
+            stacks = [
+                _get_collapsed_stack(frames[ident])
+                for ident in active
+                if ident in frames
+            ]
+            with self.__lock:
+                for stack in stacks:
+                    self.__stacks[stack] += 1
+                    self.n_stack_samples += 1
+
+
+def _get_collapsed_stack(frame):
+    "Return a 'root;...;leaf' string describing the call stack ending at a frame"
+    labels = []
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        labels.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(labels))
@@ -0,0 +1,287 @@
+"""Live metrics for the flyer analysis stream processor
+
+Metrics are collected in memory and can be exposed in the Prometheus text format
+through a small local HTTP server, and/or written to a file periodically.
+"""
+
+# imports
+import os
+import time
+import pathlib
+import threading
+from bisect import bisect_left
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .analysis_telemetry import AnalysisTelemetry
+
+
+class StreamProcessorMetrics:
+    """Counters and timing histograms for frames handled by a stream processor
+
+    Safe to use from several threads at once.
+
+    Args:
+        get_n_files_in_progress: a function returning the number of files that are
+            currently being reconstructed (optional, exposed as a gauge)
+    """
+
+    PREFIX = "flyer_analysis"
+    # The window (in seconds) used to compute the recent processing rate
+    RATE_WINDOW_SECS = 60.0
+    # The timings that are tracked, with their descriptions
+    TIMINGS = {
+        "end_to_end_latency": (
+            "Seconds from receiving the first message of a frame to committing its "
+            "result"
+        ),
+        "analysis": "Seconds spent analyzing each frame",
+        "output_write": "Seconds spent writing each frame's result to the DB or file",
+        "dedup_check": "Seconds spent checking the DB for already-analyzed frames",
+        "lock_wait": "Seconds spent waiting to acquire the shared processing lock",
+    }
+
+    def __init__(self, get_n_files_in_progress=None):
+        self.get_n_files_in_progress = get_n_files_in_progress
+        self.start_time = time.monotonic()
+        self.n_frames = 0
+        self.n_dedup_skips = 0
+        self.n_errors = 0
+        self.exit_codes = Counter()
+        self.__timings = {name: _Histogram() for name in self.TIMINGS}
+        self.__recent_frame_times = deque()
+        self.__lock = threading.Lock()
+
+    def observe(self, timing_name, seconds):
+        "Add one observation to the histogram for a timing"
+        with self.__lock:
+            self.__timings[timing_name].observe(seconds)
+
+    def record_frame(self, exit_code):
+        "Record that a frame was analyzed and its result was written"
+        now = time.monotonic()
+        with self.__lock:
+            self.n_frames += 1
+            self.exit_codes[exit_code] += 1
+            self.__recent_frame_times.append(now)
+            self.__trim_recent_frame_times(now)
+
+    def record_dedup_skip(self):
+        "Record that a frame was skipped because its result is already in the DB"
+        with self.__lock:
+            self.n_dedup_skips += 1
+
+    def record_error(self):
+        "Record that processing a frame raised an exception"
+        with self.__lock:
+            self.n_errors += 1
+
+    def get_frames_per_second(self):
+        "Return the rate of analyzed frames over the recent window"
+        now = time.monotonic()
+        with self.__lock:
+            self.__trim_recent_frame_times(now)
+            window = min(self.RATE_WINDOW_SECS, now - self.start_time)
+            if window <= 0:
+                return 0.0
+            return len(self.__recent_frame_times) / window
+
+    def to_prometheus_text(self):
+        "Return all of the metrics in the Prometheus text exposition format"
+        frames_per_second = self.get_frames_per_second()
+        n_files_in_progress = None
+        if self.get_n_files_in_progress is not None:
+            n_files_in_progress = self.get_n_files_in_progress()
+        p = self.PREFIX
+        lines = []
+        with self.__lock:
+            lines += _metric_header(
+                f"{p}_frames_total", "counter", "Frames analyzed and written"
+            )
+            lines.append(f"{p}_frames_total {self.n_frames}")
+            lines += _metric_header(
+                f"{p}_frames_per_second",
+                "gauge",
+                f"Frames analyzed per second over the last {self.RATE_WINDOW_SECS:g}s",
+            )
+            lines.append(f"{p}_frames_per_second {frames_per_second:.6g}")
+            lines += _metric_header(
+                f"{p}_exit_codes_total", "counter", "Analyzed frames by exit code"
+            )
+            for code, n in sorted(self.exit_codes.items(), key=str):
+                lines.append(f'{p}_exit_codes_total{{exit_code="{code}"}} {n}')
+            lines += _metric_header(
+                f"{p}_dedup_skips_total",
+                "counter",
+                "Frames skipped because their results were already in the DB",
+            )
+            lines.append(f"{p}_dedup_skips_total {self.n_dedup_skips}")
+            lines += _metric_header(
+                f"{p}_errors_total",
+                "counter",
+                "Frames whose processing raised an error",
+            )
+            lines.append(f"{p}_errors_total {self.n_errors}")
+            if n_files_in_progress is not None:
+                lines += _metric_header(
+                    f"{p}_files_in_progress",
+                    "gauge",
+                    "Files whose messages are still being received",
+                )
+                lines.append(f"{p}_files_in_progress {n_files_in_progress}")
+            lines += _metric_header(
+                f"{p}_uptime_seconds", "gauge", "Seconds since the processor started"
+            )
+            lines.append(f"{p}_uptime_seconds {time.monotonic() - self.start_time:.3f}")
+            for name, description in self.TIMINGS.items():
+                metric_name = f"{p}_{name}_seconds"
+                lines += _metric_header(metric_name, "histogram", description)
+                lines += self.__timings[name].to_prometheus_lines(metric_name)
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, filepath):
+        "Atomically (re)write the metrics to a file in the Prometheus text format"
+        filepath = pathlib.Path(filepath)
+        tmp_path = filepath.with_name(f"{filepath.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as fp:
+            fp.write(self.to_prometheus_text())
+        os.replace(tmp_path, filepath)
+
+    def __trim_recent_frame_times(self, now):
+        "Must be called while holding the lock"
+        while (
+            self.__recent_frame_times
+            and now - self.__recent_frame_times[0] > self.RATE_WINDOW_SECS
+        ):
+            self.__recent_frame_times.popleft()
+
+
+class MetricsExporter:
+    """Exposes StreamProcessorMetrics over HTTP and/or in a periodically-written file
+
+    Args:
+        metrics: the StreamProcessorMetrics object to export
+        port: serve the metrics at http://[host]:[port]/metrics if given
+        host: the interface to serve the metrics on (local only by default)
+        filepath: path to a file to rewrite with the metrics periodically if given
+        interval_secs: how often to rewrite the file
+    """
+
+    def __init__(
+        self, metrics, *, port=None, host="127.0.0.1", filepath=None, interval_secs=10
+    ):
+        self.metrics = metrics
+        self.filepath = None if filepath is None else pathlib.Path(filepath)
+        self.interval_secs = interval_secs
+        self.__server = None
+        self.__threads = []
+        self.__stop_event = threading.Event()
+        if port is not None:
+            self.__server = ThreadingHTTPServer((host, port), _get_handler(metrics))
+            self.__threads.append(
+                threading.Thread(target=self.__server.serve_forever, daemon=True)
+            )
+        if self.filepath is not None:
+            self.filepath.parent.mkdir(parents=True, exist_ok=True)
+            self.__threads.append(
+                threading.Thread(target=self.__write_file_periodically, daemon=True)
+            )
+
+    @property
+    def server_address(self):
+        "The (host, port) the metrics are being served on (None if not serving)"
+        return None if self.__server is None else self.__server.server_address
+
+    def start(self):
+        "Start serving/writing the metrics in background threads"
+        for thread in self.__threads:
+            thread.start()
+
+    def stop(self):
+        "Stop serving/writing the metrics (the file is written one last time)"
+        self.__stop_event.set()
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+        for thread in self.__threads:
+            if thread.is_alive():
+                thread.join()
+        if self.filepath is not None:
+            self.metrics.write_file(self.filepath)
+
+    def __write_file_periodically(self):
+        while not self.__stop_event.wait(self.interval_secs):
+            self.metrics.write_file(self.filepath)
+
+
+class TimedLock:
+    """Wraps a lock so that the time spent waiting to acquire it in "with" blocks is
+    added to the "lock_wait" timing of a StreamProcessorMetrics object
+    """
+
+    def __init__(self, lock, metrics):
+        self.lock = lock
+        self.metrics = metrics
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.metrics.observe("lock_wait", time.perf_counter() - start)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.lock.release()
+
+
+class _Histogram:
+    "A cumulative histogram of durations using the same buckets as AnalysisTelemetry"
+
+    BUCKET_EDGES = AnalysisTelemetry.DURATION_BUCKET_EDGES
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.bucket_counts = [0] * (len(self.BUCKET_EDGES) + 1)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.bucket_counts[bisect_left(self.BUCKET_EDGES, seconds)] += 1
+
+    def to_prometheus_lines(self, metric_name):
+        lines = []
+        cumulative = 0
+        for edge, n in zip(self.BUCKET_EDGES, self.bucket_counts):
+            cumulative += n
+            lines.append(f'{metric_name}_bucket{{le="{edge:g}"}} {cumulative}')
+        lines.append(f'{metric_name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{metric_name}_sum {self.total:.6f}")
+        lines.append(f"{metric_name}_count {self.count}")
+        return lines
+
+
+def _metric_header(name, metric_type, description):
+    return [f"# HELP {name} {description}", f"# TYPE {name} {metric_type}"]
+
+
+def _get_handler(metrics):
+    "Return a request handler class that serves the given metrics"
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        "Serves the metrics at /metrics"
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            "Respond with the metrics text"
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = metrics.to_prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            "Don't log every scrape"
+
+    return MetricsRequestHandler
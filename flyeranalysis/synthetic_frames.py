@@ -0,0 +1,310 @@
+"""Synthetic high speed video frames of flyers with known properties
+
+Frames are rendered at the camera's resolution and look roughly like the real thing:
+a bright flyer on a darker background, blurred and noisy, with a date stamp band
+along the bottom and optional distractor blobs. The flyer is a circular cap (the part
+of a disk on one side of a chord) whose apex points down, rotated by a given angle.
+The ground truth for every frame is returned alongside it so analysis results can be
+checked for accuracy.
+
+Typical usage:
+    python -m flyeranalysis.synthetic_frames [output_directory] --n_frames 100
+"""
+
+# imports
+import pathlib
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+import cv2
+from PIL import Image
+
+# The (rows, columns) of frames from the camera
+FRAME_SHAPE = (250, 400)
+# The height of the date stamp band along the bottom of each frame
+DATE_STAMP_ROWS = 12
+# The number of rows above its leading point that the analysis looks for the flyer's
+# leading edge in, and the default fraction of the edge's width it fits around the
+# leading point (see FlyerDetectionCore.select_edge_points)
+LEADING_EDGE_ROWS = 30
+ANALYSIS_ARC_FRACTION = 0.3
+
+
+def render_flyer_frame(
+    center_row,
+    center_column,
+    radius,
+    rotation=0.0,
+    *,
+    depth=None,
+    shape=FRAME_SHAPE,
+    background_level=40,
+    flyer_level=200,
+    noise_sigma=4.0,
+    blur_sigma=1.0,
+    n_distractors=0,
+    date_stamp=True,
+    rng=None,
+):
+    """Render a single frame with a flyer in it
+
+    Args:
+        center_row, center_column: the center of the flyer's circular edge (pixels)
+        radius: the radius of the flyer's circular edge (pixels)
+        rotation: the angle (radians) between the cap's apex and straight down,
+            positive toward higher column numbers. This isn't the same quantity as
+            the tilt from the analysis (see get_ground_truth).
+        depth: the thickness of the cap from its apex to its chord (default is half
+            the radius)
+        shape: the (rows, columns) of the frame
+        background_level, flyer_level: gray levels of the background and the flyer
+        noise_sigma: standard deviation of the Gaussian noise added to every pixel
+        blur_sigma: standard deviation of the Gaussian blur applied to the flyer's
+            edges (no blur if 0)
+        n_distractors: the number of small bright blobs to add away from the flyer
+        date_stamp: if True, add a bright date stamp band along the bottom
+        rng: a numpy random Generator (default is a new unseeded one)
+
+    Returns: a (frame, mask) tuple, where frame is the uint8 image and mask is a
+        boolean array of the pixels covered by the flyer
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    if depth is None:
+        depth = radius / 2.0
+    rows, columns = np.ogrid[: shape[0], : shape[1]]
+    d_row = rows - center_row
+    d_column = columns - center_column
+    in_disk = d_row**2 + d_column**2 <= radius**2
+    # distance of every pixel along the apex direction
+    along_apex = d_row * np.cos(rotation) + d_column * np.sin(rotation)
+    mask = in_disk & (along_apex >= radius - depth)
+    frame = np.full(shape, background_level, dtype=np.float64)
+    frame[mask] = flyer_level
+    for _ in range(n_distractors):
+        blob_radius = rng.uniform(2, 8)
+        blob_row = rng.uniform(0, shape[0])
+        blob_column = rng.uniform(0, shape[1])
+        blob = (rows - blob_row) ** 2 + (columns - blob_column) ** 2 <= blob_radius**2
+        frame[blob & ~mask] = rng.uniform(0.5, 1.0) * flyer_level
+    if blur_sigma > 0:
+        # pylint: disable=no-member
+        frame = cv2.GaussianBlur(frame, (0, 0), blur_sigma)
+    frame += rng.normal(0.0, noise_sigma, shape)
+    if date_stamp:
+        band_top = shape[0] - DATE_STAMP_ROWS
+        frame[band_top:] = 255
+        # dark "characters" in the band
+        for column in range(5, shape[1] // 3, 8):
+            frame[band_top + 2 : shape[0] - 2, column : column + 5] = rng.choice(
+                [0, 255]
+            )
+    frame = np.clip(frame, 0, 255).astype(np.uint8)
+    return frame, mask
+
+
+def get_analyzed_rows(shape=FRAME_SHAPE):
+    "Return the number of rows the analysis keeps after cropping off the date stamp"
+    return int(17 * np.floor(shape[0] / 18))
+
+
+def get_ground_truth(mask, center_row, center_column, radius, rotation, depth=None):
+    """Return a dictionary of the true properties of a rendered flyer, in the same
+    terms as the analysis results (leading_row is None if the flyer isn't visible in
+    the rows that are analyzed, and tilt is None if it isn't defined; see get_true_tilt)
+    """
+    visible = mask[: get_analyzed_rows(mask.shape)]
+    flyer_rows = np.nonzero(visible)[0]
+    return {
+        "true_center_row": center_row,
+        "true_center_column": center_column,
+        "true_radius": radius,
+        "true_rotation": rotation,
+        "true_tilt": get_true_tilt(
+            center_row, center_column, radius, rotation, depth=depth, shape=mask.shape
+        ),
+        "true_leading_row": int(flyer_rows.max()) if len(flyer_rows) > 0 else None,
+    }
+
+
+def get_true_tilt(
+    center_row,
+    center_column,
+    radius,
+    rotation,
+    *,
+    depth=None,
+    shape=FRAME_SHAPE,
+    arc_fraction=ANALYSIS_ARC_FRACTION,
+):
+    """Return the tilt the analysis should find for a rendered flyer, worked out from
+    its geometry
+
+    The analysis doesn't measure the rotation of the cap. It fits a circle to the
+    lowest points of the flyer within LEADING_EDGE_ROWS rows of its leading point,
+    keeping only the columns within +/- arc_fraction of the width of those points
+    around the leading point (shifted to stay inside them), and its tilt is the angle
+    from the center to the edge point in the middle of those columns. On the circular
+    edge, the point at angle phi from straight down is at column
+    center_column + radius * sin(phi), and the angle from the center to it is phi.
+
+    Returns: the tilt in radians, or None if it isn't defined (the flyer isn't visible
+        in the rows that are analyzed, or its leading edge is cut off by the bottom
+        of them)
+    """
+    if depth is None:
+        depth = radius / 2.0
+    n_rows = get_analyzed_rows(shape)
+    # the visible arc is the part of the circle within +/- half_arc of the apex that's
+    # inside the frame's columns
+    half_arc = np.arccos(1.0 - depth / radius)
+    arc_start = max(
+        rotation - half_arc, np.arcsin(np.clip(-center_column / radius, -1.0, 1.0))
+    )
+    arc_end = min(
+        rotation + half_arc,
+        np.arcsin(np.clip((shape[1] - 1 - center_column) / radius, -1.0, 1.0)),
+    )
+    if arc_start > arc_end:
+        return None
+    # the leading point is the point on the arc closest to straight down
+    leading_angle = min(max(0.0, arc_start), arc_end)
+    leading_row = center_row + radius * np.cos(leading_angle)
+    if leading_row < 0 or leading_row > n_rows - 1:
+        return None
+    # the part of the arc within LEADING_EDGE_ROWS rows of the leading point
+    min_cos = np.cos(leading_angle) - LEADING_EDGE_ROWS / radius
+    band_half_angle = np.pi if min_cos <= -1.0 else np.arccos(min_cos)
+    band_start = max(arc_start, -band_half_angle)
+    band_end = min(arc_end, band_half_angle)
+    first_column = center_column + radius * np.sin(band_start)
+    last_column = center_column + radius * np.sin(band_end)
+    leading_column = center_column + radius * np.sin(leading_angle)
+    half_window = arc_fraction * (last_column - first_column)
+    window_start = leading_column - half_window
+    window_end = leading_column + half_window
+    if window_start < first_column:
+        window_end = min(window_end + first_column - window_start, last_column)
+        window_start = first_column
+    if window_end > last_column:
+        window_start = max(window_start - (window_end - last_column), first_column)
+        window_end = last_column
+    middle_column = (window_start + window_end) / 2.0
+    return float(np.arcsin((middle_column - center_column) / radius))
+
+
+def generate_video(
+    n_frames,
+    *,
+    seed=0,
+    shape=FRAME_SHAPE,
+    rows_per_frame=None,
+    radius=None,
+    center_column=None,
+    rotation=None,
+    noise_sigma=None,
+    n_distractors=None,
+):
+    """Generate the frames of a synthetic video of a flyer moving down the frame
+
+    Any property not given is drawn at random (using the seed), and stays the same
+    for every frame except the position of the flyer, which starts above the frame
+    and moves down by rows_per_frame each frame.
+
+    Returns: a list of (frame, ground truth dictionary) tuples
+    """
+    rng = np.random.default_rng(seed)
+    if radius is None:
+        radius = rng.uniform(100, 600)
+    if center_column is None:
+        center_column = rng.uniform(0.25 * shape[1], 0.75 * shape[1])
+    if rotation is None:
+        rotation = rng.uniform(-0.15, 0.15)
+    if noise_sigma is None:
+        noise_sigma = rng.uniform(2.0, 10.0)
+    if n_distractors is None:
+        n_distractors = int(rng.integers(0, 4))
+    if rows_per_frame is None:
+        rows_per_frame = 1.1 * get_analyzed_rows(shape) / max(n_frames - 1, 1)
+    frames = []
+    for iframe in range(n_frames):
+        # the apex (leading point) of the flyer
+        apex_row = -10.0 + iframe * rows_per_frame
+        center_row = apex_row - radius * np.cos(rotation)
+        apex_center_column = center_column - radius * np.sin(rotation)
+        frame, mask = render_flyer_frame(
+            center_row,
+            apex_center_column,
+            radius,
+            rotation,
+            shape=shape,
+            noise_sigma=noise_sigma,
+            n_distractors=n_distractors,
+            rng=rng,
+        )
+        truth = get_ground_truth(mask, center_row, apex_center_column, radius, rotation)
+        frames.append((frame, truth))
+    return frames
+
+
+def write_video(output_dir, frames, camera_name="Camera_1_1_1"):
+    """Write the frames of a synthetic video to .bmp files named the same way as real
+    frames, along with a ground_truth.csv file
+
+    Returns: a DataFrame of the ground truth for each frame file
+    """
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    rows = []
+    for iframe, (frame, truth) in enumerate(frames):
+        filename = f"{camera_name}_{iframe:04d}.bmp"
+        Image.fromarray(frame).save(output_dir / filename)
+        rows.append({"filename": filename, **truth})
+    truth_df = pd.DataFrame(rows)
+    truth_df.to_csv(output_dir / "ground_truth.csv", index=False)
+    return truth_df
+
+
+def get_command_line_options(args=None):
+    """Return the command line options given an (optional) list of args
+
+    Args:
+        args: a list of arguments to pass to the parser instead of using sys.argv
+
+    Returns: A namespace of parsed arguments
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "output_directory",
+        type=pathlib.Path,
+        help="The directory the .bmp frames and ground truth .csv file should go in",
+    )
+    parser.add_argument(
+        "--n_frames",
+        type=int,
+        default=100,
+        help="The number of frames in the video (default = 100)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="The random seed that determines the video (default = 0)",
+    )
+    parser.add_argument(
+        "--camera_name",
+        default="Camera_1_1_1",
+        help='The prefix for the frame filenames (default = "Camera_1_1_1")',
+    )
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    "Write a synthetic video from the command line"
+    options = get_command_line_options(args)
+    frames = generate_video(options.n_frames, seed=options.seed)
+    write_video(options.output_directory, frames, camera_name=options.camera_name)
+    print(f"Wrote {len(frames)} synthetic frames to {options.output_directory}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+"""Analyze every video in a tree of directories of frames
+
+Every directory under an input root that holds .bmp frames (and has no directories
+of frames under it) is treated as one video.
+Videos are analyzed in a pool of processes, largest first (so the longest videos
+don't end up running alone at the end), and each video's analysis images and a
+file of its results (.csv and/or .parquet) are written to the same relative location
+under an output root. A manifest of the videos that have been analyzed is updated as
+each one finishes, so an interrupted run can be started again without redoing them
+(a video is analyzed again if its frames have changed, or if its results haven't been
+written in every requested format). An index of every analyzed video and its result
+files is written to the output root at the end of each run.
+
+Writing results to Parquet files requires pyarrow.
+
+Typical usage:
+    FlyerTreeAnalysis [input_root] [output_root] --formats csv parquet
+"""
+
+# imports
+import os
+import json
+import time
+import pathlib
+import datetime
+import logging
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from .flyer_detection import Flyer_Detection
+
+
+class FlyerTreeAnalysis:
+    """Analyzes every directory of .bmp frames under an input root
+
+    Args:
+        input_root: path to the root of the tree of video directories
+        output_root: path to the directory the output should go in (the output for
+            each video goes in the same location relative to it as the video's
+            directory is relative to the input root)
+        formats: the formats to write each video's results in ("csv" and/or "parquet")
+        n_workers: the number of processes to use (default is the number of CPUs)
+        restart: if True, analyze every video again even if the manifest says it's done
+
+    Raises:
+        ValueError: the input root isn't a directory or a format is unknown
+    """
+
+    FORMATS = ("csv", "parquet")
+    MANIFEST_FILENAME = "flyer_analysis_manifest.json"
+    INDEX_FILENAME = "flyer_analysis_index.csv"
+
+    def __init__(
+        self,
+        input_root,
+        output_root,
+        *,
+        formats=("csv",),
+        n_workers=None,
+        restart=False,
+        logger=None,
+    ):
+        self.logger = (
+            logger if logger is not None else logging.getLogger(self.__class__.__name__)
+        )
+        self.input_root = pathlib.Path(input_root)
+        if not self.input_root.is_dir():
+            errmsg = f"ERROR: input root {self.input_root} is not a directory!"
+            self.logger.error(errmsg)
+            raise ValueError(errmsg)
+        for results_format in formats:
+            if results_format not in self.FORMATS:
+                errmsg = (
+                    f"ERROR: unknown results format {results_format} "
+                    f"(expected one of {', '.join(self.FORMATS)})"
+                )
+                self.logger.error(errmsg)
+                raise ValueError(errmsg)
+        if "parquet" in formats:
+            try:
+                import pyarrow  # pylint: disable=import-outside-toplevel, unused-import
+            except ImportError as exc:
+                raise ImportError(
+                    "ERROR: pyarrow is needed to write results to Parquet files. "
+                    "You can install it with 'pip install flyeranalysis[export]'."
+                ) from exc
+        self.output_root = pathlib.Path(output_root)
+        self.formats = tuple(formats)
+        self.n_workers = n_workers if n_workers is not None else os.cpu_count()
+        self.manifest_path = self.output_root / self.MANIFEST_FILENAME
+        self.manifest = {}
+        if self.manifest_path.is_file() and not restart:
+            with open(self.manifest_path, "r") as manifest:
+                self.manifest = json.load(manifest)
+            self.logger.info(
+                "Read manifest of %d analyzed videos from %s",
+                len(self.manifest),
+                self.manifest_path,
+            )
+        self.n_analyzed = 0
+        self.failed_videos = []
+
+    def find_videos(self):
+        """Return a list of (video directory, relative name, signature) tuples for
+        every video under the input root, largest first. A video's signature is a
+        dictionary of its number of frames, total size, and latest modification time.
+
+        Directories with other directories of frames under them are skipped (with a
+        warning), since a video's analysis images are written to the output directory
+        that the videos under it write theirs to, which is cleared before each video
+        is analyzed.
+        """
+        videos = []
+        output_root = self.output_root.resolve()
+        for dirpath, dirnames, filenames in os.walk(self.input_root):
+            # don't mistake analysis images for frames if the output is in the tree
+            dirnames[:] = [
+                name
+                for name in dirnames
+                if (pathlib.Path(dirpath) / name).resolve() != output_root
+            ]
+            frame_names = [name for name in filenames if name.endswith(".bmp")]
+            if len(frame_names) < 1:
+                continue
+            video_dir = pathlib.Path(dirpath)
+            stats = [os.stat(video_dir / name) for name in frame_names]
+            signature = {
+                "n_frames": len(frame_names),
+                "size": sum(stat.st_size for stat in stats),
+                "mtime_ns": max(stat.st_mtime_ns for stat in stats),
+            }
+            videos.append((video_dir, self.__get_video_name(video_dir), signature))
+        video_dirs = [video[0] for video in videos]
+        leaf_videos = []
+        for video in videos:
+            if any(video[0] in video_dir.parents for video_dir in video_dirs):
+                self.logger.warning(
+                    "Skipping the frames in %s because directories under it also "
+                    "hold frames",
+                    video[0],
+                )
+                continue
+            leaf_videos.append(video)
+        videos = leaf_videos
+        videos.sort(key=lambda video: (-video[2]["size"], video[1]))
+        return videos
+
+    def run(self):
+        """Analyze every video that hasn't been analyzed already, then write the index
+
+        Returns: the number of videos analyzed in this run
+        """
+        videos = self.find_videos()
+        to_analyze = [video for video in videos if self.__needs_analysis(*video[1:])]
+        self.logger.info(
+            "Found %d videos (%d already analyzed)",
+            len(videos),
+            len(videos) - len(to_analyze),
+        )
+        with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+            futures = {
+                executor.submit(
+                    _analyze_video,
+                    str(video_dir),
+                    str(self.__get_output_location(name)),
+                    self.formats,
+                ): (name, signature)
+                for video_dir, name, signature in to_analyze
+            }
+            for future in as_completed(futures):
+                name, signature = futures[future]
+                try:
+                    video_info = future.result()
+                except Exception as exc:
+                    self.failed_videos.append(name)
+                    self.logger.error("Failed to analyze video %s", name, exc_info=exc)
+                    continue
+                previous_info = self.manifest.get(name, {})
+                if previous_info.get("signature") == signature:
+                    # results written earlier in other formats are still up to date
+                    video_info["outputs"] = {
+                        **previous_info["outputs"],
+                        **video_info["outputs"],
+                    }
+                video_info["signature"] = signature
+                video_info["completed_at"] = datetime.datetime.now().isoformat()
+                self.manifest[name] = video_info
+                self.__write_manifest()
+                self.n_analyzed += 1
+                self.logger.info(
+                    "Analyzed %s (%d frames in %.1f s) [%d/%d]",
+                    name,
+                    video_info["n_results"],
+                    video_info["seconds"],
+                    self.n_analyzed,
+                    len(to_analyze),
+                )
+        self.__write_index()
+        if len(self.failed_videos) > 0:
+            self.logger.warning(
+                "%d videos failed and will be retried on the next run: %s",
+                len(self.failed_videos),
+                ", ".join(sorted(self.failed_videos)),
+            )
+        return self.n_analyzed
+
+    def __needs_analysis(self, name, signature):
+        """Return True if a video isn't in the manifest, its frames have changed since
+        it was analyzed, or its results are missing any of the requested formats
+        """
+        video_info = self.manifest.get(name)
+        if video_info is None or video_info["signature"] != signature:
+            return True
+        return len(set(self.formats) - set(video_info["outputs"])) > 0
+
+    def __get_video_name(self, video_dir):
+        "Return the name of a video (its directory's path relative to the input root)"
+        rel_path = video_dir.relative_to(self.input_root)
+        if rel_path == pathlib.Path("."):
+            return self.input_root.resolve().name
+        return rel_path.as_posix()
+
+    def __get_output_location(self, name):
+        "Return the directory that should hold the output for a video"
+        return (self.output_root / name).parent
+
+    def __write_manifest(self):
+        self.output_root.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.manifest_path.with_name(f"{self.manifest_path.name}.tmp")
+        with open(tmp_path, "w") as manifest:
+            json.dump(self.manifest, manifest, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def __write_index(self):
+        "Write a CSV file with one row for every analyzed video in the manifest"
+        rows = []
+        for name, video_info in sorted(self.manifest.items()):
+            row = {
+                "video": name,
+                "n_frames": video_info["signature"]["n_frames"],
+                "n_results": video_info["n_results"],
+                "n_fits": video_info["n_fits"],
+                "seconds": video_info["seconds"],
+                "completed_at": video_info["completed_at"],
+            }
+            for results_format in self.FORMATS:
+                row[f"{results_format}_path"] = video_info["outputs"].get(
+                    results_format
+                )
+            rows.append(row)
+        self.output_root.mkdir(parents=True, exist_ok=True)
+        pd.DataFrame(rows).to_csv(self.output_root / self.INDEX_FILENAME, index=False)
+
+    @classmethod
+    def get_command_line_options(cls, args=None):
+        """Return the command line options given an (optional) list of args
+
+        Args:
+            args: a list of arguments to pass to the parser instead of using sys.argv
+
+        Returns: A namespace of parsed arguments
+        """
+        parser = ArgumentParser()
+        parser.add_argument(
+            "input_root",
+            type=pathlib.Path,
+            help="The root of the tree of directories of .bmp frames to analyze",
+        )
+        parser.add_argument(
+            "output_root",
+            type=pathlib.Path,
+            help=(
+                "The directory that should hold the output. Each video's analysis "
+                "images and results go in the same relative location as its frames."
+            ),
+        )
+        parser.add_argument(
+            "--formats",
+            nargs="+",
+            choices=cls.FORMATS,
+            default=["csv"],
+            help="The formats to write each video's results in (default = csv)",
+        )
+        parser.add_argument(
+            "--n_workers",
+            type=int,
+            default=None,
+            help="The number of processes to use (default = number of CPUs)",
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Add this flag to ignore the manifest and analyze every video again",
+        )
+        return parser.parse_args(args)
+
+
+def _analyze_video(input_dir, output_location, formats):
+    """Analyze the frames in one video directory (in a worker process) and write its
+    results. Returns a dictionary describing the output.
+    """
+    start = time.perf_counter()
+    analyzer = Flyer_Detection()
+    analyzer.create_df_from_input_location(input_dir, output_location)
+    results_path_stem = os.path.join(output_location, os.path.basename(input_dir))
+    outputs = {}
+    if "csv" in formats:
+        outputs["csv"] = f"{results_path_stem}.csv"
+        analyzer.create_csv_from_df(outputs["csv"])
+    if "parquet" in formats:
+        outputs["parquet"] = f"{results_path_stem}.parquet"
+        analyzer.df.to_parquet(outputs["parquet"])
+    return {
+        "n_results": int(analyzer.df.shape[0]),
+        "n_fits": int((analyzer.df["exit_code"] == 0).sum()),
+        "outputs": outputs,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def main(args=None):
+    "Analyze a tree of videos from the command line"
+    options = FlyerTreeAnalysis.get_command_line_options(args)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(name)s %(asctime)s] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    tree_analysis = FlyerTreeAnalysis(
+        options.input_root,
+        options.output_root,
+        formats=options.formats,
+        n_workers=options.n_workers,
+        restart=options.restart,
+    )
+    n_analyzed = tree_analysis.run()
+    tree_analysis.logger.info(
+        "Done! %d videos analyzed, index written to %s",
+        n_analyzed,
+        tree_analysis.output_root / tree_analysis.INDEX_FILENAME,
+    )
+
+
+if __name__ == "__main__":
+    main()
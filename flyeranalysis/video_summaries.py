@@ -0,0 +1,389 @@
+"""Per-video summaries of the flyer analysis results, and queries over them
+
+Each video (metadata_links entry) has a row in the video_summaries table with running
+totals over its frames (the number of frames and successful fits, the sums for a
+least-squares fit of leading_row vs. frame index, and the results from its last
+successfully-fit frame), and a row in the video_exit_code_counts table for every exit
+code its frames have. The stream processor adds each frame to these tables as its
+result is written, so per-video quantities like the flyer velocity can be queried
+without scanning every frame's result.
+
+Typical usage (to rebuild every summary from the results already in a DB):
+    python -m flyeranalysis.video_summaries [connection_string]
+"""
+
+# imports
+import datetime
+from argparse import ArgumentParser
+import numpy as np
+from sqlalchemy import create_engine, inspect, select, update, delete, case, or_
+from .metadata_link_entry import MetadataLinkEntry
+from .flyer_analysis_entry import FlyerAnalysisEntry
+from .video_summary_entry import VideoSummaryEntry, VideoExitCodeCountEntry
+from .bulk_insert import bulk_insert, get_engine_kwargs
+
+# The maximum number of metadata_links IDs to put in a single query
+MAX_IDS_PER_QUERY = 500
+# The columns holding results from the last successfully-fit frame of each video
+FINAL_COLUMNS = ("final_leading_row", "final_radius", "final_tilt")
+
+
+def create_video_summary_tables(engine):
+    """Create the video summary tables if they don't exist yet, summarizing any
+    results that are already in the DB
+
+    Args:
+        engine: the SQLAlchemy Engine for the DB
+
+    Returns: the number of video summaries written (0 if the tables already existed)
+    """
+    if inspect(engine).has_table(VideoSummaryEntry.__tablename__):
+        VideoExitCodeCountEntry.__table__.create(bind=engine, checkfirst=True)
+        return 0
+    VideoSummaryEntry.__table__.create(bind=engine)
+    VideoExitCodeCountEntry.__table__.create(bind=engine, checkfirst=True)
+    if not inspect(engine).has_table(FlyerAnalysisEntry.__tablename__):
+        return 0
+    with engine.begin() as conn:
+        return rebuild_video_summaries(conn)
+
+
+def create_video_summary_rows(conn, metadata_link_id, exit_code):
+    """Add an empty summary row for a video, and an empty row for the number of its
+    frames with an exit code, if they don't exist yet (without committing)
+
+    Rows need to exist before add_result_to_video_summary is called. Callers adding
+    results from several threads or processes at once should commit these rows in
+    their own (short) transaction, holding a lock if they have one.
+
+    Args:
+        conn: an open SQLAlchemy Connection (or Session)
+        metadata_link_id: the ID of the video's metadata_links entry
+        exit_code: the exit code to add a row for
+    """
+    summary_table = VideoSummaryEntry.__table__
+    exit_code_table = VideoExitCodeCountEntry.__table__
+    summary_exists = conn.execute(
+        select(summary_table.c.metadata_link_ID).where(
+            summary_table.c.metadata_link_ID == metadata_link_id
+        )
+    ).first()
+    if not summary_exists:
+        conn.execute(
+            summary_table.insert(),
+            [_get_empty_summary_row(metadata_link_id)],
+        )
+    exit_code_exists = conn.execute(
+        select(exit_code_table.c.metadata_link_ID).where(
+            exit_code_table.c.metadata_link_ID == metadata_link_id,
+            exit_code_table.c.exit_code == exit_code,
+        )
+    ).first()
+    if not exit_code_exists:
+        conn.execute(
+            exit_code_table.insert(),
+            [
+                {
+                    "metadata_link_ID": metadata_link_id,
+                    "exit_code": exit_code,
+                    "n_frames": 0,
+                }
+            ],
+        )
+
+
+def add_result_to_video_summary(conn, analysis_entry):
+    """Add one frame's result to the summary of its video (without committing)
+
+    The totals are updated in single UPDATE statements, so results from several
+    threads or processes can be added at the same time.
+
+    Args:
+        conn: an open SQLAlchemy Connection (or Session)
+        analysis_entry: the FlyerAnalysisEntry for the frame's result
+    """
+    if analysis_entry.metadata_link_ID is None:
+        return
+    summary_table = VideoSummaryEntry.__table__
+    exit_code_table = VideoExitCodeCountEntry.__table__
+    increments, frame_index, final_values = _get_frame_contribution(
+        analysis_entry.rel_filepath,
+        analysis_entry.exit_code,
+        analysis_entry.radius,
+        analysis_entry.tilt,
+        analysis_entry.leading_row,
+    )
+    values = {name: summary_table.c[name] + inc for name, inc in increments.items()}
+    values["updated_at"] = datetime.datetime.now()
+    if final_values is not None:
+        is_final = or_(
+            summary_table.c.final_frame_index.is_(None),
+            summary_table.c.final_frame_index <= frame_index,
+        )
+        for name in FINAL_COLUMNS:
+            values[name] = case(
+                (is_final, final_values[name]), else_=summary_table.c[name]
+            )
+        # set last, for DBs that use already-updated values in later expressions
+        values["final_frame_index"] = case(
+            (is_final, frame_index), else_=summary_table.c.final_frame_index
+        )
+    conn.execute(
+        update(summary_table)
+        .where(summary_table.c.metadata_link_ID == analysis_entry.metadata_link_ID)
+        .values(values)
+    )
+    conn.execute(
+        update(exit_code_table)
+        .where(
+            exit_code_table.c.metadata_link_ID == analysis_entry.metadata_link_ID,
+            exit_code_table.c.exit_code == analysis_entry.exit_code,
+        )
+        .values(n_frames=exit_code_table.c.n_frames + 1)
+    )
+
+
+def rebuild_video_summaries(conn, metadata_link_ids=None):
+    """Recompute the summaries of videos from the results in the flyer analysis
+    results table, replacing any existing summaries (without committing)
+
+    Args:
+        conn: an open SQLAlchemy Connection
+        metadata_link_ids: the IDs of the metadata_links entries whose summaries
+            should be rebuilt (default is every video)
+
+    Returns: the number of video summaries written
+    """
+    summary_table = VideoSummaryEntry.__table__
+    exit_code_table = VideoExitCodeCountEntry.__table__
+    summaries = {}
+    exit_code_counts = {}
+    for id_condition in _get_id_conditions(
+        FlyerAnalysisEntry.metadata_link_ID, metadata_link_ids
+    ):
+        rows = conn.execute(
+            select(
+                FlyerAnalysisEntry.metadata_link_ID,
+                FlyerAnalysisEntry.rel_filepath,
+                FlyerAnalysisEntry.exit_code,
+                FlyerAnalysisEntry.radius,
+                FlyerAnalysisEntry.tilt,
+                FlyerAnalysisEntry.leading_row,
+            ).where(FlyerAnalysisEntry.metadata_link_ID.is_not(None), id_condition)
+        )
+        for link_id, rel_filepath, exit_code, radius, tilt, leading_row in rows:
+            summary = summaries.setdefault(link_id, _get_empty_summary_row(link_id))
+            increments, frame_index, final_values = _get_frame_contribution(
+                rel_filepath, exit_code, radius, tilt, leading_row
+            )
+            for name, inc in increments.items():
+                summary[name] += inc
+            if final_values is not None and (
+                summary["final_frame_index"] is None
+                or summary["final_frame_index"] <= frame_index
+            ):
+                summary.update(final_values)
+                summary["final_frame_index"] = frame_index
+            key = (link_id, exit_code)
+            exit_code_counts[key] = exit_code_counts.get(key, 0) + 1
+    for table in (summary_table, exit_code_table):
+        for id_condition in _get_id_conditions(
+            table.c.metadata_link_ID, metadata_link_ids
+        ):
+            conn.execute(delete(table).where(id_condition))
+    bulk_insert(conn, summary_table, list(summaries.values()))
+    bulk_insert(
+        conn,
+        exit_code_table,
+        [
+            {"metadata_link_ID": link_id, "exit_code": exit_code, "n_frames": n_frames}
+            for (link_id, exit_code), n_frames in exit_code_counts.items()
+        ],
+    )
+    return len(summaries)
+
+
+def get_video_summaries(
+    conn, *, metadata_link_ids=None, start_date=None, end_date=None, min_fits=0
+):
+    """Return a dataframe of video summaries along with the fields of their
+    metadata_links entries
+
+    Args:
+        conn: an open SQLAlchemy Connection (or Session)
+        metadata_link_ids: only return the summaries of these videos
+        start_date: only return the summaries of videos on or after this date
+        end_date: only return the summaries of videos on or before this date
+        min_fits: only return the summaries of videos with at least this many
+            successfully-fit frames
+
+    Returns: a dataframe with one row per video, including the number of frames
+        ("n_frames"), the number and fraction of them that were successfully fit
+        ("n_fits" and "fit_fraction"), the mean radius of the fits ("mean_radius"),
+        the slope of leading_row vs. frame index in rows per frame ("velocity"), and
+        the results from the last successfully-fit frame ("final_*")
+    """
+    # (imported here since pandas is slow to import)
+    import pandas as pd  # pylint: disable=import-outside-toplevel
+
+    summary_table = VideoSummaryEntry.__table__
+    links_table = MetadataLinkEntry.__table__
+    conditions = []
+    if start_date is not None:
+        conditions.append(links_table.c.datestamp >= start_date)
+    if end_date is not None:
+        conditions.append(links_table.c.datestamp <= end_date)
+    if min_fits:
+        conditions.append(summary_table.c.n_fits >= min_fits)
+    stmt = select(
+        summary_table,
+        links_table.c.datestamp,
+        links_table.c.experiment_day_counter,
+        links_table.c.camera_filename,
+    ).join(links_table, summary_table.c.metadata_link_ID == links_table.c.ID)
+    rows = []
+    for id_condition in _get_id_conditions(
+        summary_table.c.metadata_link_ID, metadata_link_ids
+    ):
+        rows.extend(conn.execute(stmt.where(id_condition, *conditions)).all())
+    summaries_df = pd.DataFrame(rows, columns=list(stmt.selected_columns.keys()))
+    n_fits = summaries_df["n_fits"].to_numpy(dtype=float)
+    n_indexed = summaries_df["n_indexed_fits"].to_numpy(dtype=float)
+    sum_x = summaries_df["sum_frame_index"].to_numpy(dtype=float)
+    denominator = (
+        n_indexed * summaries_df["sum_frame_index_sq"].to_numpy(dtype=float) - sum_x**2
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        summaries_df["fit_fraction"] = n_fits / summaries_df["n_frames"].to_numpy(
+            dtype=float
+        )
+        summaries_df["mean_radius"] = np.where(
+            n_fits > 0,
+            summaries_df["sum_radius"].to_numpy(dtype=float) / n_fits,
+            np.nan,
+        )
+        summaries_df["velocity"] = np.where(
+            (n_indexed >= 2) & (denominator != 0),
+            (
+                n_indexed
+                * summaries_df["sum_frame_index_leading_row"].to_numpy(dtype=float)
+                - sum_x * summaries_df["sum_leading_row"].to_numpy(dtype=float)
+            )
+            / denominator,
+            np.nan,
+        )
+    return summaries_df.sort_values("metadata_link_ID", ignore_index=True)
+
+
+def get_exit_code_counts(conn, metadata_link_ids=None):
+    """Return a dataframe of the number of frames with each exit code in each video
+
+    Args:
+        conn: an open SQLAlchemy Connection (or Session)
+        metadata_link_ids: only return the counts for these videos
+
+    Returns: a dataframe indexed by metadata_links ID with a column for each exit code
+    """
+    # (imported here since pandas is slow to import)
+    import pandas as pd  # pylint: disable=import-outside-toplevel
+
+    exit_code_table = VideoExitCodeCountEntry.__table__
+    rows = []
+    for id_condition in _get_id_conditions(
+        exit_code_table.c.metadata_link_ID, metadata_link_ids
+    ):
+        rows.extend(conn.execute(select(exit_code_table).where(id_condition)).all())
+    counts_df = pd.DataFrame(
+        rows, columns=["metadata_link_ID", "exit_code", "n_frames"]
+    )
+    return counts_df.pivot_table(
+        index="metadata_link_ID",
+        columns="exit_code",
+        values="n_frames",
+        aggfunc="sum",
+        fill_value=0,
+    )
+
+
+def _get_empty_summary_row(metadata_link_id):
+    entry = VideoSummaryEntry(metadata_link_id)
+    return {
+        column.name: getattr(entry, column.name)
+        for column in VideoSummaryEntry.__table__.columns
+    }
+
+
+def _get_frame_contribution(rel_filepath, exit_code, radius, tilt, leading_row):
+    """Return the amounts a frame's result adds to each running total of its video's
+    summary, the frame's index, and its final_* values (None if it wasn't fit or has
+    no frame index or leading row)
+    """
+    increments = {"n_frames": 1}
+    if exit_code != 0:
+        return increments, None, None
+    increments["n_fits"] = 1
+    increments["sum_radius"] = radius if radius is not None else 0.0
+    frame_index = VideoSummaryEntry.get_frame_index(rel_filepath)
+    if frame_index is None or leading_row is None:
+        return increments, frame_index, None
+    increments["n_indexed_fits"] = 1
+    increments["sum_frame_index"] = frame_index
+    increments["sum_frame_index_sq"] = frame_index**2
+    increments["sum_leading_row"] = leading_row
+    increments["sum_frame_index_leading_row"] = frame_index * leading_row
+    final_values = {
+        "final_leading_row": leading_row,
+        "final_radius": radius,
+        "final_tilt": tilt,
+    }
+    return increments, frame_index, final_values
+
+
+def _get_id_conditions(column, metadata_link_ids):
+    "Yield conditions selecting (chunks of) a list of IDs, or everything if it's None"
+    if metadata_link_ids is None:
+        yield column.is_not(None)
+        return
+    metadata_link_ids = sorted(set(metadata_link_ids))
+    for start in range(0, len(metadata_link_ids), MAX_IDS_PER_QUERY):
+        yield column.in_(metadata_link_ids[start : start + MAX_IDS_PER_QUERY])
+
+
+def get_command_line_options(args=None):
+    """Return the command line options given an (optional) list of args
+
+    Args:
+        args: a list of arguments to pass to the parser instead of using sys.argv
+
+    Returns: A namespace of parsed arguments
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "db_connection_str",
+        help="The SQLAlchemy connection string for the database to use",
+    )
+    parser.add_argument(
+        "--metadata_link_ids",
+        type=int,
+        nargs="+",
+        help="Only rebuild the summaries of videos with these metadata_links IDs",
+    )
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    "Rebuild video summaries from the command line"
+    options = get_command_line_options(args)
+    engine = create_engine(
+        options.db_connection_str, **get_engine_kwargs(options.db_connection_str)
+    )
+    VideoSummaryEntry.__table__.create(bind=engine, checkfirst=True)
+    VideoExitCodeCountEntry.__table__.create(bind=engine, checkfirst=True)
+    with engine.begin() as conn:
+        n_summaries = rebuild_video_summaries(conn, options.metadata_link_ids)
+    engine.dispose()
+    print(f"Rebuilt the summaries of {n_summaries} videos")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""ORMs for rows in the per-video summary tables"""
+
+# imports
+import re
+import datetime
+from sqlalchemy import Integer, SmallInteger, Float, DateTime, ForeignKey
+from sqlalchemy.orm import mapped_column
+from .orm_base import ORMBase
+from .metadata_link_entry import MetadataLinkEntry
+
+# Regex for the frame index at the end of a frame's filename (i.e. "Camera_hh_mm_ss_0012.bmp")
+FRAME_INDEX_REGEX = re.compile(r"_(\d+)\.bmp$")
+
+
+class VideoSummaryEntry(ORMBase):
+    """
+    A class describing entries in a table summarizing the analysis results for all of
+    the frames linked to each metadata_links entry (video)
+
+    Holds running totals that can be updated one frame at a time, including the sums
+    needed for a least-squares fit of leading_row vs. frame index for the frames
+    that were fit successfully (see video_summaries.py)
+    """
+
+    __tablename__ = "video_summaries"
+
+    metadata_link_ID = mapped_column(
+        ForeignKey(f"{MetadataLinkEntry.__tablename__}.ID"), primary_key=True
+    )
+    n_frames = mapped_column(Integer, nullable=False, default=0)
+    n_fits = mapped_column(Integer, nullable=False, default=0)
+    sum_radius = mapped_column(Float, nullable=False, default=0.0)
+    # sums over the successful fits with a frame index and leading row
+    n_indexed_fits = mapped_column(Integer, nullable=False, default=0)
+    sum_frame_index = mapped_column(Float, nullable=False, default=0.0)
+    sum_frame_index_sq = mapped_column(Float, nullable=False, default=0.0)
+    sum_leading_row = mapped_column(Float, nullable=False, default=0.0)
+    sum_frame_index_leading_row = mapped_column(Float, nullable=False, default=0.0)
+    # results from the successful fit with the highest frame index
+    final_frame_index = mapped_column(Integer)
+    final_leading_row = mapped_column(SmallInteger)
+    final_radius = mapped_column(Float)
+    final_tilt = mapped_column(Float)
+    updated_at = mapped_column(DateTime)
+
+    def __init__(self, metadata_link_ID):
+        super().__init__()
+        self.metadata_link_ID = metadata_link_ID
+        self.n_frames = 0
+        self.n_fits = 0
+        self.sum_radius = 0.0
+        self.n_indexed_fits = 0
+        self.sum_frame_index = 0.0
+        self.sum_frame_index_sq = 0.0
+        self.sum_leading_row = 0.0
+        self.sum_frame_index_leading_row = 0.0
+        self.updated_at = datetime.datetime.now()
+
+    @property
+    def mean_radius(self):
+        "The mean radius of the successful fits (None if there aren't any)"
+        return self.sum_radius / self.n_fits if self.n_fits else None
+
+    @property
+    def velocity(self):
+        """
+        The slope of leading_row vs. frame index from a least-squares fit to the
+        successful fits, in rows per frame (None if there aren't enough frames)
+        """
+        denominator = (
+            self.n_indexed_fits * self.sum_frame_index_sq - self.sum_frame_index**2
+        )
+        if self.n_indexed_fits < 2 or denominator == 0:
+            return None
+        return (
+            self.n_indexed_fits * self.sum_frame_index_leading_row
+            - self.sum_frame_index * self.sum_leading_row
+        ) / denominator
+
+    @staticmethod
+    def get_frame_index(rel_filepath):
+        """
+        Given the relative filepath for a frame .bmp file, return the index of the
+        frame in its video (the number at the end of its filename), or None if the
+        filename doesn't have one
+        """
+        match = FRAME_INDEX_REGEX.search(str(rel_filepath))
+        return int(match.group(1)) if match else None
+
+
+class VideoExitCodeCountEntry(ORMBase):
+    """
+    A class describing entries in a table of the number of frames linked to each
+    metadata_links entry (video) with each analysis exit code
+    """
+
+    __tablename__ = "video_exit_code_counts"
+
+    metadata_link_ID = mapped_column(
+        ForeignKey(f"{MetadataLinkEntry.__tablename__}.ID"), primary_key=True
+    )
+    exit_code = mapped_column(SmallInteger, primary_key=True, autoincrement=False)
+    n_frames = mapped_column(Integer, nullable=False, default=0)
+
+    def __init__(self, metadata_link_ID, exit_code, n_frames=0):
+        super().__init__()
+        self.metadata_link_ID = metadata_link_ID
+        self.exit_code = exit_code
+        self.n_frames = n_frames
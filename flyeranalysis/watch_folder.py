@@ -0,0 +1,325 @@
+"""Analyze the frames of a video incrementally as they land in a directory
+
+Meant for acquisition computers, where frames are written to a directory one at a
+time while a video is being recorded. The directory is polled for new .bmp frames,
+and only frames that haven't been analyzed yet are analyzed (frames are only picked
+up once they haven't been modified for a moment, so partially-written files are
+skipped until they're complete). Their analysis images are added to the output
+directory and their results are appended to the video's .csv file, in the same
+layout that Flyer_Detection().create_df_from_input_location uses.
+
+Progress is checkpointed to a small JSON state file, so a watcher that's stopped
+and started again picks up where it left off instead of starting over. Watching
+stops once the flyer reaches the last row of a frame (just like a full analysis of
+the directory), or after a given amount of time without any new frames.
+
+Typical usage:
+    python -m flyeranalysis.watch_folder [input_directory] [output_location]
+"""
+
+# imports
+import os
+import json
+import time
+import pathlib
+import logging
+from argparse import ArgumentParser
+from .flyer_detection_core import FlyerDetectionCore
+from .flyer_results_table import FlyerResultsTable
+from .overlay_writer import OverlayWriter
+
+
+class FlyerWatchFolder:
+    """Analyzes new frames in a directory each time it's polled
+
+    Args:
+        input_location: path to the directory that frames are written to
+        output_location: the directory that should hold the output (analysis images
+            go in a subdirectory named after the video, next to a .csv file of results)
+        state_file: path to the JSON file used to record progress (default is
+            "[video name]_watch_state.json" in the output location)
+        settle_seconds: frames are only analyzed once they haven't been modified
+            for this many seconds
+        checkpoint_every: the number of frames to analyze between checkpoints
+        overlay_writer: the OverlayWriter to use to write analysis images
+            (a default one is created if not given)
+    """
+
+    DEF_POLL_INTERVAL = 2.0
+    DEF_SETTLE_SECONDS = 1.0
+    DEF_CHECKPOINT_EVERY = 100
+
+    @property
+    def finished(self):
+        "True once the flyer has reached the last row of a frame"
+        return self.__finished
+
+    def __init__(
+        self,
+        input_location,
+        output_location,
+        *,
+        state_file=None,
+        settle_seconds=DEF_SETTLE_SECONDS,
+        checkpoint_every=DEF_CHECKPOINT_EVERY,
+        overlay_writer=None,
+        logger=None,
+    ):
+        self.logger = (
+            logger if logger is not None else logging.getLogger(self.__class__.__name__)
+        )
+        self.input_location = pathlib.Path(input_location)
+        self.output_location = pathlib.Path(output_location)
+        video_name = self.input_location.resolve().name
+        self.output_dir = self.output_location / video_name
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.csv_path = self.output_location / f"{video_name}.csv"
+        self.state_file = (
+            pathlib.Path(state_file)
+            if state_file is not None
+            else self.output_location / f"{video_name}_watch_state.json"
+        )
+        self.settle_seconds = settle_seconds
+        self.checkpoint_every = checkpoint_every
+        self.__own_overlay_writer = overlay_writer is None
+        self.overlay_writer = (
+            overlay_writer if overlay_writer is not None else OverlayWriter()
+        )
+        self.analyzer = FlyerDetectionCore(overlay_writer=self.overlay_writer)
+        self.__analyzed_frames = set()
+        self.n_results = 0
+        self.__csv_size = 0
+        self.__finished = False
+        if self.state_file.is_file():
+            with open(self.state_file, "r") as state:
+                state_dict = json.load(state)
+            self.__analyzed_frames = set(state_dict["analyzed_frames"])
+            self.n_results = state_dict["n_results"]
+            self.__csv_size = state_dict["csv_size"]
+            self.__finished = state_dict["finished"]
+            self.logger.info(
+                "Resuming from state in %s (%d frames already analyzed)",
+                self.state_file,
+                self.n_results,
+            )
+        # drop any results appended after the last checkpoint (they'll be redone)
+        if self.csv_path.is_file():
+            with open(self.csv_path, "r+b") as csv_file:
+                csv_file.truncate(self.__csv_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_new_frames(self):
+        "Return a sorted list of paths to new frames that are ready to be analyzed"
+        now = time.time()
+        new_frames = []
+        with os.scandir(self.input_location) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".bmp"):
+                    continue
+                if entry.name in self.__analyzed_frames:
+                    continue
+                if now - entry.stat().st_mtime < self.settle_seconds:
+                    continue
+                new_frames.append(pathlib.Path(entry.path))
+        return sorted(new_frames)
+
+    def poll(self):
+        """Analyze every new frame that's ready, checkpointing along the way
+
+        Returns: the number of frames analyzed
+        """
+        if self.__finished:
+            return 0
+        n_analyzed = 0
+        results = FlyerResultsTable(capacity=self.checkpoint_every)
+        frame_names = []
+        for frame_path in self.get_new_frames():
+            with open(frame_path, "rb") as image_file:
+                fc, touches_last_row = self.analyzer.analyze_frame(
+                    os.path.join(str(self.input_location), frame_path.name),
+                    str(self.output_dir),
+                    frame_bytes=image_file.read(),
+                )
+            results.append(fc)
+            frame_names.append(frame_path.name)
+            n_analyzed += 1
+            if touches_last_row:
+                self.__finished = True
+                self.logger.info("Flyer reached the last row in %s", frame_path.name)
+                break
+            if len(results) >= self.checkpoint_every:
+                self.__checkpoint(results, frame_names)
+                results = FlyerResultsTable(capacity=self.checkpoint_every)
+                frame_names = []
+        self.__checkpoint(results, frame_names)
+        return n_analyzed
+
+    def run(self, poll_interval=DEF_POLL_INTERVAL, idle_timeout=None):
+        """Poll for new frames until the flyer reaches the last row of a frame (or
+        until no new frames have arrived for idle_timeout seconds, if given)
+
+        Returns: the total number of frames analyzed
+        """
+        last_new_frame = time.monotonic()
+        while not self.__finished:
+            n_analyzed = self.poll()
+            if n_analyzed > 0:
+                self.logger.info(
+                    "Analyzed %d new frames (%d total)", n_analyzed, self.n_results
+                )
+                last_new_frame = time.monotonic()
+            elif (
+                idle_timeout is not None
+                and time.monotonic() - last_new_frame > idle_timeout
+            ):
+                self.logger.info("No new frames in %s seconds, stopping", idle_timeout)
+                break
+            if not self.__finished:
+                time.sleep(poll_interval)
+        return self.n_results
+
+    def close(self):
+        "Finish writing any queued analysis images"
+        if self.__own_overlay_writer:
+            self.overlay_writer.close()
+        else:
+            self.overlay_writer.flush()
+
+    def __checkpoint(self, results, frame_names):
+        """Make sure a batch of results' analysis images are written, append the
+        results to the .csv file, and record them in the state file
+        """
+        self.overlay_writer.flush()
+        if len(results) > 0:
+            df = results.to_dataframe()
+            df.index += self.n_results
+            with open(self.csv_path, "a") as csv_file:
+                df.to_csv(csv_file, header=self.__csv_size == 0)
+            self.__csv_size = self.csv_path.stat().st_size
+            self.n_results += len(results)
+            self.__analyzed_frames.update(frame_names)
+        tmp_path = self.state_file.with_name(f"{self.state_file.name}.tmp")
+        with open(tmp_path, "w") as state:
+            json.dump(
+                {
+                    "input_location": str(self.input_location),
+                    "analyzed_frames": sorted(self.__analyzed_frames),
+                    "n_results": self.n_results,
+                    "csv_size": self.__csv_size,
+                    "finished": self.__finished,
+                },
+                state,
+            )
+        os.replace(tmp_path, self.state_file)
+
+
+def get_command_line_options(args=None):
+    """Return the command line options given an (optional) list of args
+
+    Args:
+        args: a list of arguments to pass to the parser instead of using sys.argv
+
+    Returns: A namespace of parsed arguments
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "input_location",
+        type=pathlib.Path,
+        help="The directory that .bmp frames are being written to",
+    )
+    parser.add_argument(
+        "output_location",
+        type=pathlib.Path,
+        help=(
+            "The directory that should hold the output. Analysis images go in a "
+            "subdirectory named after the video, next to a .csv file of the results."
+        ),
+    )
+    parser.add_argument(
+        "--state_file",
+        type=pathlib.Path,
+        help=(
+            "Path to the JSON file used to record progress (default = "
+            "[video name]_watch_state.json in the output location)"
+        ),
+    )
+    parser.add_argument(
+        "--poll_interval",
+        type=float,
+        default=FlyerWatchFolder.DEF_POLL_INTERVAL,
+        help=(
+            "Seconds to wait between checks for new frames "
+            f"(default = {FlyerWatchFolder.DEF_POLL_INTERVAL})"
+        ),
+    )
+    parser.add_argument(
+        "--settle_seconds",
+        type=float,
+        default=FlyerWatchFolder.DEF_SETTLE_SECONDS,
+        help=(
+            "Only analyze frames that haven't been modified for this many seconds "
+            f"(default = {FlyerWatchFolder.DEF_SETTLE_SECONDS})"
+        ),
+    )
+    parser.add_argument(
+        "--idle_timeout",
+        type=float,
+        help="Stop watching if no new frames arrive for this many seconds",
+    )
+    parser.add_argument(
+        "--overlay_format",
+        choices=OverlayWriter.IMAGE_FORMATS,
+        default="bmp",
+        help=(
+            "The format to write analysis images in: uncompressed .bmp files, or "
+            ".png files compressed with --png_compression (default = bmp)"
+        ),
+    )
+    parser.add_argument(
+        "--png_compression",
+        type=int,
+        choices=range(10),
+        default=OverlayWriter.DEF_PNG_COMPRESSION,
+        help=(
+            "The compression level (0-9) for .png analysis images "
+            f"(default = {OverlayWriter.DEF_PNG_COMPRESSION})"
+        ),
+    )
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    "Watch a directory for new frames from the command line"
+    options = get_command_line_options(args)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(name)s %(asctime)s] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    with OverlayWriter(
+        options.overlay_format, png_compression=options.png_compression
+    ) as overlay_writer, FlyerWatchFolder(
+        options.input_location,
+        options.output_location,
+        state_file=options.state_file,
+        settle_seconds=options.settle_seconds,
+        overlay_writer=overlay_writer,
+    ) as watcher:
+        try:
+            watcher.run(
+                poll_interval=options.poll_interval, idle_timeout=options.idle_timeout
+            )
+        except KeyboardInterrupt:
+            watcher.logger.info("Stopped watching")
+        watcher.logger.info(
+            "%d results written to %s", watcher.n_results, watcher.csv_path
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -25,6 +25,8 @@ setupkwargs = dict(
     entry_points={
         "console_scripts": [
             "FlyerAnalysisStreamProcessor=flyeranalysis.flyer_analysis_stream_processor:main",
+            "FlyerReanalysisBackfill=flyeranalysis.reanalysis_backfill:main",
+            "FlyerTreeAnalysis=flyeranalysis.tree_analysis:main",
         ],
     },
     python_requires=">=3.9",
@@ -43,6 +45,10 @@ setupkwargs = dict(
         "sqlalchemy",
     ],
     extras_require={
+        "export": [
+            "h5py",
+            "pyarrow",
+        ],
         "dev": [
             "twine",
         ],